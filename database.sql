@@ -35,7 +35,8 @@ CREATE TABLE `user_subscriptions` (
   PRIMARY KEY (`id`),
   KEY `user_id` (`user_id`),
   KEY `plan_id` (`plan_id`),
-  KEY `idx_user_subscriptions_user_app` (`user_id`, `app_id`),
+  KEY `idx_user_subscriptions_user_app_status_end` (`user_id`, `app_id`, `status`, `current_period_end` DESC),
+  KEY `idx_user_subscriptions_user_app_status_created` (`user_id`, `app_id`, `status`, `created_at` DESC),
   KEY `idx_user_subscriptions_status` (`status`),
   KEY `idx_user_subscriptions_razorpay` (`razorpay_subscription_id`),
   KEY `idx_user_subscriptions_paypal` (`paypal_subscription_id`),
@@ -71,7 +72,7 @@ CREATE TABLE `subscription_invoices` (
   KEY `subscription_id` (`subscription_id`),
   KEY `user_id` (`user_id`),
   KEY `idx_subscription_invoices_razorpay_payment` (`razorpay_payment_id`),
-  KEY `idx_subscription_invoices_paypal_payment` (`paypal_payment_id`),
+  UNIQUE KEY `uq_subscription_invoices_paypal_payment` (`paypal_payment_id`),
   KEY `idx_subscription_invoices_paypal_invoice` (`paypal_invoice_id`),
   CONSTRAINT `subscription_invoices_ibfk_1` FOREIGN KEY (`subscription_id`) REFERENCES `user_subscriptions` (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
@@ -101,6 +102,7 @@ CREATE TABLE `resource_usage` (
   KEY `subscription_id` (`subscription_id`),
   KEY `app_id` (`app_id`),
   KEY `billing_period_start_end` (`billing_period_start`,`billing_period_end`),
+  UNIQUE KEY `uq_resource_usage_user_sub_app` (`user_id`,`subscription_id`,`app_id`),
   CONSTRAINT `resource_usage_ibfk_1` FOREIGN KEY (`subscription_id`) REFERENCES `user_subscriptions` (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
@@ -114,7 +116,7 @@ CREATE TABLE `subscription_events_log` (
   `processed` tinyint(1) DEFAULT '0',
   `created_at` datetime DEFAULT CURRENT_TIMESTAMP,
   PRIMARY KEY (`id`),
-  KEY `idx_entity_id` (`entity_id`),
+  KEY `idx_entity_created` (`entity_id`, `created_at`),
   KEY `idx_provider` (`provider`),
   KEY `idx_user_id` (`user_id`),
   KEY `idx_event_type` (`event_type`),
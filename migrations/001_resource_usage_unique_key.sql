@@ -0,0 +1,13 @@
+-- One resource_usage row per (user, subscription, app), required by the
+-- INSERT ... ON DUPLICATE KEY UPDATE in _save_quota_record_with_originals.
+
+-- Drop older duplicates, keeping the most recent row for each key
+DELETE ru FROM `resource_usage` ru
+JOIN `resource_usage` newer
+  ON newer.`user_id` = ru.`user_id`
+ AND newer.`subscription_id` = ru.`subscription_id`
+ AND newer.`app_id` = ru.`app_id`
+ AND newer.`id` > ru.`id`;
+
+ALTER TABLE `resource_usage`
+  ADD UNIQUE KEY `uq_resource_usage_user_sub_app` (`user_id`,`subscription_id`,`app_id`);
@@ -0,0 +1,9 @@
+-- Serves the active-subscription lookups
+--   WHERE user_id = ? AND app_id = ? AND status = ? ORDER BY current_period_end DESC LIMIT 1
+-- with an index seek instead of a filesort.
+ALTER TABLE `user_subscriptions`
+  ADD KEY `idx_user_subscriptions_user_app_status_end` (`user_id`, `app_id`, `status`, `current_period_end` DESC);
+
+-- resource_usage lookups by (user_id, subscription_id, app_id) are served by
+-- uq_resource_usage_user_sub_app from 001: with at most one row per key the
+-- ORDER BY created_at DESC LIMIT 1 no longer sorts anything.
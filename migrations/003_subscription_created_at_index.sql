@@ -0,0 +1,11 @@
+-- Serves the subscription lookups ordered by creation time
+--   WHERE user_id = ? AND app_id = ? AND status = ? ORDER BY created_at DESC LIMIT 1
+-- (active subscription for the quota paths, latest pending/existing subscription)
+-- and the blocking-status check (status IN (...)) with an index range scan
+-- instead of a filesort over every subscription the user has had.
+-- InnoDB appends the primary key, so lookups that select only `id` are index-only.
+-- idx_user_subscriptions_user_app (user_id, app_id) is a prefix of this key and
+-- of idx_user_subscriptions_user_app_status_end, so it is dropped.
+ALTER TABLE `user_subscriptions`
+  ADD KEY `idx_user_subscriptions_user_app_status_created` (`user_id`, `app_id`, `status`, `created_at` DESC),
+  DROP KEY `idx_user_subscriptions_user_app`;
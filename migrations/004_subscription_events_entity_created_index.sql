@@ -0,0 +1,10 @@
+-- Serves audit-log reads for one entity in time order
+--   WHERE entity_id = ? ORDER BY created_at
+-- with an index range scan instead of a filesort over the entity's events.
+-- It replaces idx_entity_id, which is a prefix of the new key.
+--
+-- webhook_events_processed needs nothing here: unique_event_provider
+-- (event_id, provider) already answers WHERE event_id = ? AND provider = ?.
+ALTER TABLE `subscription_events_log`
+  ADD KEY `idx_entity_created` (`entity_id`, `created_at`),
+  DROP KEY `idx_entity_id`;
@@ -0,0 +1,12 @@
+-- One invoice per PayPal payment, required by the
+-- INSERT ... ON DUPLICATE KEY UPDATE in PayPalService._upsert_paypal_invoice
+-- (PayPal retries payment webhooks). NULLs (Razorpay invoices) do not collide.
+--
+-- Invoices are financial records, so duplicates are not deleted here. If the
+-- ALTER fails, reconcile the payments listed by this query first:
+--   SELECT paypal_payment_id, COUNT(*) FROM subscription_invoices
+--   WHERE paypal_payment_id IS NOT NULL
+--   GROUP BY paypal_payment_id HAVING COUNT(*) > 1;
+ALTER TABLE `subscription_invoices`
+  ADD UNIQUE KEY `uq_subscription_invoices_paypal_payment` (`paypal_payment_id`),
+  DROP KEY `idx_subscription_invoices_paypal_payment`;
@@ -4,68 +4,211 @@ Payment Gateway Integration Package
 A shared package for payment gateway integrations including Razorpay and PayPal
 to be used across different Flask applications.
 """
+import importlib
+import logging
+import threading
+from typing import NamedTuple, TYPE_CHECKING
 
-__version__ = '0.1.0'
+if TYPE_CHECKING:
+    from .service import PaymentService
+    from .paypal_service import PayPalService
 
-from .service import PaymentService
-from .paypal_service import PayPalService
-from .base_subscription_service import BaseSubscriptionService
-from .routes import init_payment_routes
+logger = logging.getLogger('payment_gateway')
+
+# Public names resolved on first access (PEP 562) so consumers only pay for
+# the gateway modules they actually touch
+_LAZY = {
+    'PaymentService': ('.service', 'PaymentService'),
+    'PayPalService': ('.paypal_service', 'PayPalService'),
+    'BaseSubscriptionService': ('.base_subscription_service', 'BaseSubscriptionService'),
+    'init_payment_routes': ('.routes', 'init_payment_routes'),
+    'invalidate_plan_cache': ('.base_subscription_service', 'invalidate_plan_cache'),
+    'invalidate_active_subscription_cache': ('.base_subscription_service', 'invalidate_active_subscription_cache'),
+}
+
+def __getattr__(name):
+    """Import lazily exported names (and __version__) on first access"""
+    if name == '__version__':
+        # Read from the installed distribution so setup.py stays the single source
+        from importlib.metadata import version, PackageNotFoundError
+        try:
+            value = version('payment_gateway')
+        except PackageNotFoundError:
+            value = '0+unknown'
+        globals()['__version__'] = value
+        return value
+    if name in _LAZY:
+        module_name, attr = _LAZY[name]
+        obj = getattr(importlib.import_module(module_name, __name__), attr)
+        globals()[name] = obj
+        return obj
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY) | {'__version__'})
+
+_SERVICE_CLASSES = {
+    'razorpay': 'PaymentService',
+    'paypal': 'PayPalService',
+}
+
+def _build(kind, app=None, db_config=None):
+    """Construct the service for a gateway kind, importing its module on first use"""
+    name = _SERVICE_CLASSES[kind]
+    cls = globals().get(name) or __getattr__(name)
+    return cls(app, db_config)
+
+class PaymentServices(NamedTuple):
+    """Both gateway services, as returned by init_both_payment_services"""
+    payment_service: 'PaymentService'
+    paypal_service: 'PayPalService'
+
+    def __getitem__(self, key):
+        # Keep the previous dict-style access (services['payment_service']) working
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+# Every submodule of the package, for build steps that precompile or freeze it
+# (scripts/freeze.py refuses to build when a module is missing here)
+_MANIFEST = (
+    '.config',
+    '.db',
+    '.utils',
+    '.utils.helpers',
+    '.utils.request_cache',
+    '.base_subscription_service',
+    '.models',
+    '.providers',
+    '.providers.razorpay_provider',
+    '.providers.paypal_provider',
+    '.service',
+    '.paypal_service',
+    '.webhooks',
+    '.webhooks.razorpay_handler',
+    '.webhooks.paypal_handler',
+    '.routes',
+)
+
+_PREWARM_MODULES = ('.paypal_service', '.webhooks')
+
+def _prewarm_modules():
+    """Import the lazily loaded gateway modules off the request path"""
+    def warm():
+        for module_name in _PREWARM_MODULES:
+            try:
+                importlib.import_module(module_name, __name__)
+            except Exception as e:
+                logger.warning(f"Prewarming {module_name} failed: {str(e)}")
+
+    threading.Thread(target=warm, daemon=True, name='pg-warmup').start()
 
 # Backward compatible function
-def init_payment_gateway(app=None, db_config=None, return_both_services=False):
+def init_payment_gateway(app=None, db_config=None, return_both_services=False, *,
+                         enable_razorpay=True, enable_paypal=False):
     """
     Initialize the payment gateway with a Flask app and database configuration
     
     Args:
         app: Flask application
         db_config: Database configuration
-        return_both_services: If True, returns dict with both services. If False, returns only PaymentService for backward compatibility.
+        return_both_services: If True, returns a PaymentServices tuple with both services. If False, returns only PaymentService for backward compatibility.
+        enable_razorpay: Build the Razorpay PaymentService (default True)
+        enable_paypal: Build the PayPalService up front (default False). When disabled,
+            the routes build one only if they are registered. Forced on by return_both_services.
     
     Returns:
-        PaymentService instance (default) or dict with both services
+        PaymentService instance (default), PayPalService if Razorpay is disabled,
+        or PaymentServices with both services
+    
+    Raises:
+        ValueError: If both enable_razorpay and enable_paypal are False
     """
-    # Initialize both services
-    payment_service = PaymentService(app, db_config)
-    paypal_service = PayPalService(app, db_config)
+    if app is not None and 'payment_gateway' in app.extensions:
+        # Already initialized for this app (app factory re-entry, reloads) - reuse
+        # the services instead of building a second set and re-registering routes
+        services = app.extensions['payment_gateway']
+        if return_both_services:
+            if services['paypal_service'] is None:
+                if services['payment_service'] is not None:
+                    services['paypal_service'] = services['payment_service'].paypal_service
+                else:
+                    services['paypal_service'] = _build('paypal', app, db_config)
+            return PaymentServices(services['payment_service'], services['paypal_service'])
+        return services['payment_service'] or services['paypal_service']
+
+    if return_both_services:
+        enable_razorpay = enable_paypal = True
+    elif not (enable_razorpay or enable_paypal):
+        raise ValueError("init_payment_gateway needs enable_razorpay or enable_paypal")
+
+    payment_service = None
+    paypal_service = None
+
+    if enable_razorpay:
+        payment_service = _build('razorpay', app, db_config)
+
+    if enable_paypal:
+        paypal_service = _build('paypal', app, db_config)
+    
+    if payment_service is not None and paypal_service is not None:
+        # Store paypal_service in payment_service for access if needed; without
+        # one, payment_service.paypal_service builds it on first access
+        payment_service.paypal_service = paypal_service
     
     if app:
-        # Initialize routes with both services
+        app.extensions['payment_gateway'] = {
+            'payment_service': payment_service,
+            'paypal_service': paypal_service
+        }
+        # Per-request memoization of plan/user/subscription lookups
+        from .utils.request_cache import reset_request_cache, clear_request_cache
+        app.before_request(reset_request_cache)
+        app.teardown_request(clear_request_cache)
+        # The PayPal service and the webhook handlers are loaded by the routes on
+        # first use; without Razorpay only its specific routes are left out
+        from .routes import init_payment_routes
         init_payment_routes(app, payment_service, paypal_service)
+        if payment_service is None:
+            logger.info("Razorpay service disabled - Razorpay routes not registered")
+
+        from .config import PAYMENT_GATEWAY_PREWARM
+        if PAYMENT_GATEWAY_PREWARM:
+            _prewarm_modules()
     
     # For backward compatibility, return only payment_service by default
     if return_both_services:
-        return {
-            'payment_service': payment_service,
-            'paypal_service': paypal_service
-        }
+        return PaymentServices(payment_service, paypal_service)
+    elif payment_service is None:
+        return paypal_service
     else:
-        # Store paypal_service in payment_service for access if needed
-        payment_service.paypal_service = paypal_service
         return payment_service
 
 # New function for those who want both services explicitly
 def init_both_payment_services(app=None, db_config=None):
-    """Initialize both payment services and return as dictionary"""
+    """Initialize both payment services and return them as a PaymentServices tuple"""
     return init_payment_gateway(app, db_config, return_both_services=True)
 
 # Alternative: Individual service initialization functions
 def init_razorpay_service(app=None, db_config=None):
     """Initialize only Razorpay payment service"""
-    return PaymentService(app, db_config)
+    return _build('razorpay', app, db_config)
 
 def init_paypal_service(app=None, db_config=None):
     """Initialize only PayPal payment service"""
-    return PayPalService(app, db_config)
+    return _build('paypal', app, db_config)
 
 # Export all services for direct import
 __all__ = [
     'PaymentService',
     'PayPalService', 
     'BaseSubscriptionService',
+    'PaymentServices',
     'init_payment_gateway',
     'init_both_payment_services',
     'init_razorpay_service',
     'init_paypal_service',
-    'init_payment_routes'
+    'init_payment_routes',
+    'invalidate_plan_cache',
+    'invalidate_active_subscription_cache'
 ]
\ No newline at end of file
@@ -2,71 +2,586 @@
 Base subscription service with shared methods
 Used by both PaymentService and PayPalService to eliminate duplication
 """
+import atexit
+import copy
 import json
 import logging
-import traceback
+import threading
+import time
+from collections import defaultdict
 from datetime import datetime, timedelta,timezone
-from decimal import Decimal
+
+import mysql.connector
 
 from .db import DatabaseManager
-from .utils.helpers import generate_id, parse_json_field, calculate_period_end
-from .config import setup_logging, DB_TABLE_SUBSCRIPTION_PLANS, DB_TABLE_USER_SUBSCRIPTIONS, DB_TABLE_RESOURCE_USAGE
+from .utils.helpers import generate_id, parse_json_field, calculate_period_end, TTLCache, LazyJSON
+from .utils.request_cache import request_cached, invalidate_request_cache
+from .config import (
+    setup_logging, DB_TABLE_SUBSCRIPTION_PLANS, DB_TABLE_USER_SUBSCRIPTIONS, DB_TABLE_RESOURCE_USAGE,
+    DB_TABLE_SUBSCRIPTION_INVOICES,
+    PLAN_CACHE_SIZE, PLAN_CACHE_TTL, ACTIVE_SUBSCRIPTION_CACHE_SIZE, ACTIVE_SUBSCRIPTION_CACHE_TTL,
+    QUOTA_INSERT_BATCH_SIZE, QUOTA_FLUSH_MS, QUOTA_FLUSH_MAX_BACKOFF_MS
+)
 
 logger = logging.getLogger('payment_gateway')
 
+# All statuses that indicate a subscription is not fully active
+PROBLEMATIC_SUBSCRIPTION_STATUSES = (
+    'pending',          # Payment pending (Razorpay)
+    'halted',           # Payment failed, subscription suspended (Razorpay)
+    'authenticated',    # Payment method authenticated but not active (Razorpay)
+    'payment_failed',   # Failed payment (PayPal)
+    'suspended'         # Suspended subscription (PayPal)
+)
+
+# Placeholders for PROBLEMATIC_SUBSCRIPTION_STATUSES, built once - statuses are always bound as parameters
+_STATUS_PLACEHOLDERS = ', '.join(['%s'] * len(PROBLEMATIC_SUBSCRIPTION_STATUSES))
+
+# Outcomes of a single guarded quota decrement
+DECREMENT_OK = 'ok'
+DECREMENT_INSUFFICIENT = 'insufficient'
+DECREMENT_ERROR = 'error'
+
+# Billing period assumed when a subscription has no period dates of its own
+DEFAULT_BILLING_PERIOD = timedelta(days=30)
+
+# Resource types and the resource_usage columns that hold their balance
+RESOURCE_QUOTA_COLUMNS = {
+    'document_pages': 'document_pages_quota',
+    'perplexity_requests': 'perplexity_requests_quota',
+    'requests': 'requests_quota'
+}
+
+# Quota-relevant plan features, extracted by MySQL as integers (NULL when absent)
+PLAN_QUOTA_FEATURES = ('document_pages', 'perplexity_requests', 'requests')
+PLAN_QUOTA_FEATURE_COLUMNS = ',\n'.join(
+    f"CAST(sp.features->>'$.{feature}' AS SIGNED) AS {feature}" for feature in PLAN_QUOTA_FEATURES
+)
+
+# Plan columns for internal lookups - amount comes back as a float so proration
+# math never touches Decimal
+PLAN_COLUMNS = """id, name, description, CAST(amount AS DOUBLE) AS amount, currency, `interval`,
+        interval_count, features, app_id, paypal_plan_id, is_active, created_at,
+        razorpay_plan_id, plan_type, payment_gateways"""
+
+# SQL is built once at import time - table names are module-level constants
+SQL_GET_PLAN = f"SELECT {PLAN_COLUMNS} FROM {DB_TABLE_SUBSCRIPTION_PLANS} WHERE id = %s OR razorpay_plan_id = %s OR paypal_plan_id = %s"
+
+SQL_GET_SUB_DETAILS = f"""
+    SELECT us.*, sp.name as plan_name, sp.amount, sp.currency, sp.interval
+    FROM {DB_TABLE_USER_SUBSCRIPTIONS} us
+    JOIN {DB_TABLE_SUBSCRIPTION_PLANS} sp ON us.plan_id = sp.id
+    WHERE us.id = %s
+"""
+
+SQL_GET_SUB_FOR_CANCEL = f"""
+    SELECT id, user_id, plan_id, app_id, status, razorpay_subscription_id,
+        paypal_subscription_id, current_period_start, current_period_end
+    FROM {DB_TABLE_USER_SUBSCRIPTIONS}
+    WHERE id = %s AND user_id = %s
+"""
+
+SQL_UPDATE_SUB_PLAN = f"""
+    UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
+    SET plan_id = %s, updated_at = NOW()
+    WHERE id = %s
+"""
+
+SQL_GET_SUB_WITH_FEATURES = f"""
+    SELECT us.id, us.user_id, us.current_period_start, us.current_period_end, sp.app_id,
+        {PLAN_QUOTA_FEATURE_COLUMNS}
+    FROM {DB_TABLE_USER_SUBSCRIPTIONS} us
+    JOIN {DB_TABLE_SUBSCRIPTION_PLANS} sp ON us.plan_id = sp.id
+    WHERE us.id = %s
+"""
+
+SQL_GET_CURRENT_USAGE = f"""
+    SELECT 
+        document_pages_quota,
+        perplexity_requests_quota,
+        requests_quota,
+        original_document_pages_quota,
+        original_perplexity_requests_quota,
+        original_requests_quota,
+        current_addon_document_pages,
+        current_addon_perplexity_requests,
+        current_addon_requests,
+        billing_period_start,
+        billing_period_end
+    FROM {DB_TABLE_RESOURCE_USAGE}
+    WHERE user_id = %s AND subscription_id = %s AND app_id = %s
+    ORDER BY created_at DESC LIMIT 1
+"""
+
+# Proration only looks at the app's own resources (see calculate_resource_utilization)
+_PRORATION_USAGE_COLUMNS = {
+    'marketfit': """document_pages_quota, perplexity_requests_quota,
+        original_document_pages_quota, original_perplexity_requests_quota,
+        current_addon_document_pages, current_addon_perplexity_requests""",
+    'saleswit': """requests_quota, original_requests_quota, current_addon_requests"""
+}
+SQL_GET_PRORATION_USAGE = {
+    app: f"""
+    SELECT {columns}, billing_period_start, billing_period_end
+    FROM {DB_TABLE_RESOURCE_USAGE}
+    WHERE user_id = %s AND subscription_id = %s AND app_id = %s
+    ORDER BY created_at DESC LIMIT 1
+"""
+    for app, columns in _PRORATION_USAGE_COLUMNS.items()
+}
+
+SQL_GET_QUOTA_RECORD = f"""
+    SELECT document_pages_quota, perplexity_requests_quota, requests_quota
+    FROM {DB_TABLE_RESOURCE_USAGE}
+    WHERE user_id = %s AND subscription_id = %s AND app_id = %s
+    ORDER BY created_at DESC LIMIT 1
+"""
+
+SQL_GET_FREE_PLAN = f"""
+    SELECT {PLAN_COLUMNS} FROM {DB_TABLE_SUBSCRIPTION_PLANS}
+    WHERE app_id = %s AND amount = 0 AND is_active = TRUE
+    LIMIT 1
+"""
+
+SQL_GET_AVAILABLE_PLANS = f"""
+    SELECT id, name, description, amount, currency, `interval`, 
+        interval_count, features, app_id, plan_type, payment_gateways,
+        paypal_plan_id, razorpay_plan_id
+    FROM {DB_TABLE_SUBSCRIPTION_PLANS}
+    WHERE app_id = %s AND is_active = TRUE
+    ORDER BY amount ASC
+"""
+
+# Subscription bookkeeping - one constant per statement so no SQL is formatted per call
+SQL_CLEAR_UPGRADE_PENDING_METADATA = f"""
+    UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
+    SET metadata = JSON_REMOVE(
+        IFNULL(metadata, '{{}}'),
+        '$.upgrade_pending_approval',
+        '$.pending_plan_id',
+        '$.upgrade_initiated_at',
+        '$.upgrade_type'
+    ),
+    updated_at = NOW()
+    WHERE id = %s
+"""
+
+SQL_CLEAR_SIMPLE_UPGRADE_METADATA = f"""
+    UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
+    SET metadata = JSON_REMOVE(
+        IFNULL(metadata, '{{}}'),
+        '$.simple_upgrade_pending',
+        '$.upgraded_to_plan',
+        '$.upgrade_timestamp',
+        '$.upgrade_type',
+        '$.temporary_resources_added'
+    ),
+    updated_at = NOW()
+    WHERE id = %s
+"""
+
+SQL_UPDATE_SUB_PLAN_AND_METADATA = f"""
+    UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
+    SET plan_id = %s,
+        metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s),
+        updated_at = NOW()
+    WHERE id = %s
+"""
+
+SQL_GET_BILLING_HISTORY = f"""
+    SELECT i.*
+    FROM {DB_TABLE_SUBSCRIPTION_INVOICES} i
+    JOIN {DB_TABLE_USER_SUBSCRIPTIONS} s ON i.subscription_id = s.id
+    WHERE i.user_id = %s AND s.app_id = %s
+    ORDER BY i.invoice_date DESC
+"""
+
+# Backticks around the reserved keyword 'interval'
+SQL_GET_PLAN_INTERVAL = f"""
+    SELECT `interval`, interval_count
+    FROM {DB_TABLE_SUBSCRIPTION_PLANS}
+    WHERE id = %s
+"""
+
+SQL_GET_ACTIVE_SUBSCRIPTION = f"""
+    SELECT us.*, sp.name as plan_name, sp.features, sp.amount, sp.currency, sp.interval
+    FROM {DB_TABLE_USER_SUBSCRIPTIONS} us
+    JOIN {DB_TABLE_SUBSCRIPTION_PLANS} sp ON us.plan_id = sp.id
+    WHERE us.user_id = %s AND us.app_id = %s AND us.status = 'active'
+    ORDER BY us.created_at DESC LIMIT 1
+"""
+
+SQL_GET_PENDING_SUBSCRIPTION = f"""
+    SELECT us.*, sp.name as plan_name, sp.features, sp.amount, sp.currency, sp.interval
+    FROM {DB_TABLE_USER_SUBSCRIPTIONS} us
+    JOIN {DB_TABLE_SUBSCRIPTION_PLANS} sp ON us.plan_id = sp.id
+    WHERE us.user_id = %s AND us.app_id = %s AND us.status = 'created'
+    ORDER BY us.created_at DESC LIMIT 1
+"""
+
+SQL_GET_PLAN_FEATURE_VALUES = f"""
+    SELECT {PLAN_QUOTA_FEATURE_COLUMNS}
+    FROM {DB_TABLE_SUBSCRIPTION_PLANS} sp
+    WHERE sp.id = %s
+"""
+
+SQL_ACTIVATE_SUB_WITH_PERIOD = f"""
+    UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
+    SET status = 'active',
+        current_period_start = %s,
+        current_period_end = %s,
+        updated_at = NOW(),
+        metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s)
+    WHERE razorpay_subscription_id = %s
+"""
+
+SQL_GET_EXISTING_SUB = f"""
+    SELECT * FROM {DB_TABLE_USER_SUBSCRIPTIONS}
+    WHERE user_id = %s AND app_id = %s AND status = 'active'
+"""
+
+SQL_CHANGE_FREE_SUB_PLAN = f"""
+    UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
+    SET plan_id = %s, current_period_start = NOW(),
+        current_period_end = DATE_ADD(NOW(), INTERVAL %s MONTH)
+    WHERE id = %s
+"""
+
+# Add double the free plan's resources to a quota record, reading the free plan
+# features in the same statement (one variant per app)
+_FREE_PLAN_JOIN = f"""
+    JOIN {DB_TABLE_SUBSCRIPTION_PLANS} sp
+      ON sp.app_id = ru.app_id AND sp.amount = 0 AND sp.is_active = TRUE
+"""
+
+SQL_ADD_TEMP_RESOURCES_MARKETFIT = f"""
+    UPDATE {DB_TABLE_RESOURCE_USAGE} ru
+    {_FREE_PLAN_JOIN}
+    SET ru.document_pages_quota = ru.document_pages_quota + IFNULL(CAST(sp.features->>'$.document_pages' AS UNSIGNED), 40) * 2,
+        ru.perplexity_requests_quota = ru.perplexity_requests_quota + IFNULL(CAST(sp.features->>'$.perplexity_requests' AS UNSIGNED), 2) * 2,
+        ru.updated_at = NOW()
+    WHERE ru.user_id = %s AND ru.subscription_id = %s AND ru.app_id = %s
+"""
+
+SQL_ADD_TEMP_RESOURCES_SALESWIT = f"""
+    UPDATE {DB_TABLE_RESOURCE_USAGE} ru
+    {_FREE_PLAN_JOIN}
+    SET ru.requests_quota = ru.requests_quota + IFNULL(CAST(sp.features->>'$.requests' AS UNSIGNED), 2) * 2,
+        ru.updated_at = NOW()
+    WHERE ru.user_id = %s AND ru.subscription_id = %s AND ru.app_id = %s
+"""
+
+# Hot-path lookups, run as server-side prepared statements (reused by identity)
+SQL_GET_USER_INFO = "SELECT google_uid, email, display_name FROM users WHERE id = %s OR google_uid = %s"
+
+SQL_GET_ACTIVE_SUB_ID = f"""
+    SELECT id FROM {DB_TABLE_USER_SUBSCRIPTIONS}
+    WHERE user_id = %s AND app_id = %s AND status = 'active'
+    ORDER BY current_period_end DESC LIMIT 1
+"""
+
+SQL_GET_ACTIVE_SUB_WITH_QUOTA = f"""
+    SELECT us.id AS subscription_id,
+           ru.id AS quota_record_id,
+           ru.document_pages_quota,
+           ru.perplexity_requests_quota,
+           ru.requests_quota,
+           (SELECT ps.status FROM {DB_TABLE_USER_SUBSCRIPTIONS} ps
+            WHERE ps.user_id = us.user_id AND ps.app_id = us.app_id
+              AND ps.status IN ({_STATUS_PLACEHOLDERS})
+            ORDER BY ps.created_at DESC LIMIT 1) AS blocking_status
+    FROM {DB_TABLE_USER_SUBSCRIPTIONS} us
+    LEFT JOIN {DB_TABLE_RESOURCE_USAGE} ru
+      ON ru.subscription_id = us.id AND ru.user_id = us.user_id AND ru.app_id = us.app_id
+    WHERE us.user_id = %s AND us.app_id = %s AND us.status = 'active'
+    ORDER BY us.current_period_end DESC, ru.created_at DESC
+    LIMIT 1
+"""
+
+# Decrement one quota column of the active subscription's latest record, only if
+# enough is left and no subscription is in a blocking state (one statement per column)
+SQL_DECREMENT_QUOTA = {
+    column_name: f"""
+    UPDATE {DB_TABLE_RESOURCE_USAGE}
+    SET {column_name} = {column_name} - %s,
+        updated_at = NOW()
+    WHERE user_id = %s AND app_id = %s AND {column_name} >= %s
+      AND subscription_id = (
+          SELECT id FROM {DB_TABLE_USER_SUBSCRIPTIONS}
+          WHERE user_id = %s AND app_id = %s AND status = 'active'
+          ORDER BY current_period_end DESC LIMIT 1
+      )
+      AND NOT EXISTS (
+          SELECT 1 FROM {DB_TABLE_USER_SUBSCRIPTIONS}
+          WHERE user_id = %s AND app_id = %s AND status IN ({_STATUS_PLACEHOLDERS})
+      )
+    ORDER BY created_at DESC LIMIT 1
+"""
+    for column_name in RESOURCE_QUOTA_COLUMNS.values()
+}
+
+# Apply aggregated usage to the active subscription's latest quota record,
+# clamped at zero (one statement per column; see QuotaFlusher)
+SQL_APPLY_QUOTA_USAGE = {
+    column_name: f"""
+    UPDATE {DB_TABLE_RESOURCE_USAGE}
+    SET {column_name} = GREATEST(0, {column_name} - %s),
+        updated_at = NOW()
+    WHERE user_id = %s AND app_id = %s
+      AND subscription_id = (
+          SELECT id FROM {DB_TABLE_USER_SUBSCRIPTIONS}
+          WHERE user_id = %s AND app_id = %s AND status = 'active'
+          ORDER BY current_period_end DESC LIMIT 1
+      )
+    ORDER BY created_at DESC LIMIT 1
+"""
+    for column_name in RESOURCE_QUOTA_COLUMNS.values()
+}
+
+# Add purchased addon units to a quota column and its addon tracking column
+# (one statement per resource type - never splice caller input into SQL)
+SQL_ADD_ADDON_TO_QUOTA = {
+    resource_type: f"""
+    UPDATE {DB_TABLE_RESOURCE_USAGE}
+    SET {column_name} = {column_name} + %s,
+        current_addon_{resource_type} = current_addon_{resource_type} + %s,
+        updated_at = NOW()
+    WHERE user_id = %s AND subscription_id = %s AND app_id = %s
+"""
+    for resource_type, column_name in RESOURCE_QUOTA_COLUMNS.items()
+}
+
+# Sent right after SQL_DECREMENT_QUOTA in the same round-trip
+SQL_READ_QUOTA_AFTER_DECREMENT = f"""
+    SELECT ROW_COUNT() AS updated, document_pages_quota, perplexity_requests_quota, requests_quota
+    FROM {DB_TABLE_RESOURCE_USAGE}
+    WHERE user_id = %s AND app_id = %s
+      AND subscription_id = (
+          SELECT id FROM {DB_TABLE_USER_SUBSCRIPTIONS}
+          WHERE user_id = %s AND app_id = %s AND status = 'active'
+          ORDER BY current_period_end DESC LIMIT 1
+      )
+    ORDER BY created_at DESC LIMIT 1
+"""
+
+# Latest subscription in a state that blocks resource usage
+SQL_GET_BLOCKING_STATUS = f"""
+    SELECT id, status FROM {DB_TABLE_USER_SUBSCRIPTIONS}
+    WHERE user_id = %s AND app_id = %s AND status IN ({_STATUS_PLACEHOLDERS})
+    ORDER BY created_at DESC LIMIT 1
+"""
+
+# Everything ensure_user_has_resource_quota needs to know, sent as one
+# multi-statement batch: blocking status, then the active subscription with its quota record id
+SQL_ENSURE_QUOTA_LOOKUP = f"""
+    {SQL_GET_BLOCKING_STATUS};
+    SELECT us.id, us.plan_id, us.status, us.current_period_start, us.current_period_end,
+           ru.id AS quota_record_id
+    FROM {DB_TABLE_USER_SUBSCRIPTIONS} us
+    LEFT JOIN {DB_TABLE_RESOURCE_USAGE} ru
+      ON ru.subscription_id = us.id AND ru.user_id = us.user_id AND ru.app_id = us.app_id
+    WHERE us.user_id = %s AND us.app_id = %s AND us.status = 'active'
+    ORDER BY us.created_at DESC
+    LIMIT 1
+"""
+
+SQL_INSERT_FREE_SUBSCRIPTION = f"""
+    INSERT INTO {DB_TABLE_USER_SUBSCRIPTIONS}
+    (id, user_id, plan_id, status, app_id, current_period_start, current_period_end)
+    VALUES (%s, %s, %s, 'active', %s, %s, %s)
+"""
+
+# Idempotent on the UNIQUE (user_id, subscription_id, app_id) key: a concurrent
+# first request that already created the entry leaves it untouched
+SQL_INSERT_QUOTA_ENTRY = f"""
+    INSERT INTO {DB_TABLE_RESOURCE_USAGE}
+    (user_id, subscription_id, app_id, billing_period_start, billing_period_end,
+    document_pages_quota, perplexity_requests_quota, requests_quota)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE id = id
+"""
+
+# Create or reset a quota record - relies on the UNIQUE (user_id, subscription_id, app_id) key
+UPSERT_QUOTA_RECORD_SQL = f"""
+    INSERT INTO {DB_TABLE_RESOURCE_USAGE}
+    (user_id, subscription_id, app_id, billing_period_start, billing_period_end,
+    document_pages_quota, perplexity_requests_quota, requests_quota,
+    original_document_pages_quota, original_perplexity_requests_quota, original_requests_quota,
+    current_addon_document_pages, current_addon_perplexity_requests, current_addon_requests)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 0, 0, 0)
+    ON DUPLICATE KEY UPDATE
+        document_pages_quota = VALUES(document_pages_quota),
+        perplexity_requests_quota = VALUES(perplexity_requests_quota),
+        requests_quota = VALUES(requests_quota),
+        original_document_pages_quota = VALUES(original_document_pages_quota),
+        original_perplexity_requests_quota = VALUES(original_perplexity_requests_quota),
+        original_requests_quota = VALUES(original_requests_quota),
+        current_addon_document_pages = 0,
+        current_addon_perplexity_requests = 0,
+        current_addon_requests = 0,
+        updated_at = NOW()
+"""
+
+# Plan rows only change at deploy time, so lookups are cached per process
+_plan_cache = TTLCache(maxsize=PLAN_CACHE_SIZE, ttl=PLAN_CACHE_TTL)
+
+def invalidate_plan_cache():
+    """Drop cached plan lookups - call after creating or editing subscription plans"""
+    _plan_cache.clear()
+    invalidate_request_cache()
+
+def _cached_plan_lookup(key, load):
+    """Return a copy of the cached value for key, loading it on a miss (None is not cached)"""
+    value = _plan_cache.get(key)
+    if value is None:
+        value = load()
+        if value is None:
+            return None
+        _plan_cache.set(key, value)
+    return copy.deepcopy(value)
+
+# Active subscription id per (user_id, app_id)
+_active_subscription_cache = TTLCache(maxsize=ACTIVE_SUBSCRIPTION_CACHE_SIZE, ttl=ACTIVE_SUBSCRIPTION_CACHE_TTL)
+
+def invalidate_active_subscription_cache(user_id=None, app_id=None):
+    """
+    Drop the cached active subscription id for a user and app, for every app of
+    a user when app_id is None, or every entry if no user is given
+    """
+    if user_id is None:
+        _active_subscription_cache.clear()
+    elif app_id is not None:
+        _active_subscription_cache.pop((user_id, app_id))
+    else:
+        # Webhook payloads carry user ids as strings
+        user_key = str(user_id)
+        _active_subscription_cache.evict_where(lambda key: str(key[0]) == user_key)
+    invalidate_request_cache()
+
+class QuotaFlusher:
+    """
+    Aggregates usage decrements in memory and writes them in batches
+    
+    Deltas for the same (user_id, app_id, column) are summed and written every
+    QUOTA_FLUSH_MS by a background thread, all keys in one multi-statement
+    round-trip and one transaction. A failed flush is re-queued and retried
+    with exponential backoff (up to QUOTA_FLUSH_MAX_BACKOFF_MS); a crash loses
+    the usage not yet written.
+    """
+    
+    def __init__(self, db, interval_ms=None):
+        self.db = db
+        self.interval = (QUOTA_FLUSH_MS if interval_ms is None else interval_ms) / 1000.0
+        self._pending = defaultdict(int)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._failures = 0
+    
+    def enqueue(self, user_id, app_id, column_name, count):
+        """Queue a decrement of column_name for the user's active quota record"""
+        with self._lock:
+            self._pending[(user_id, app_id, column_name)] += count
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='pg-quota-flusher')
+                self._thread.start()
+                atexit.register(self.flush_now)
+        self._wakeup.set()
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            delay = self.interval
+            if self._failures:
+                # Back off while the database keeps failing
+                delay = min(self.interval * 2 ** min(self._failures, 16), QUOTA_FLUSH_MAX_BACKOFF_MS / 1000.0)
+            time.sleep(delay)
+            self._wakeup.clear()
+            self.flush_now()
+    
+    def flush_now(self):
+        """
+        Write all queued decrements immediately
+        
+        Returns:
+            int: Number of aggregated (user, app, column) updates written
+        """
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+        if not pending:
+            return 0
+        
+        statements = []
+        params = []
+        for (user_id, app_id, column_name), count in pending.items():
+            statements.append(SQL_APPLY_QUOTA_USAGE[column_name])
+            params.extend((count, user_id, app_id, user_id, app_id))
+        
+        try:
+            with self.db.get_connection() as conn, conn.cursor() as cursor:
+                try:
+                    for _ in cursor.execute(';'.join(statements), params, multi=True):
+                        pass
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            
+            self._failures = 0
+            return len(pending)
+            
+        except Exception as e:
+            logger.error("[AZURE DEBUG] Error flushing quota usage, re-queueing %s updates: %s", len(pending), e, exc_info=True)
+            with self._lock:
+                for key, count in pending.items():
+                    self._pending[key] += count
+                self._failures += 1
+            # Retry without waiting for the next enqueue
+            self._wakeup.set()
+            return 0
+
 class BaseSubscriptionService:
     """
     Base service class with shared subscription management methods
     """
     
+    __slots__ = ('db', '_quota_flusher')
+    
     def __init__(self, db_config=None):
         """Initialize the base service"""
         self.db = DatabaseManager(db_config)
+        # Cheap to build: its writer thread starts on the first enqueue
+        self._quota_flusher = QuotaFlusher(self.db)
         setup_logging()
 
-    def _ensure_float(self, value):
-        """Convert Decimal/any numeric type to float for calculations"""
-        if isinstance(value, Decimal):
-            return float(value)
-        return float(value) if value is not None else 0.0
-
     # =============================================================================
     # SHARED DATABASE METHODS
     # =============================================================================
 
+    @request_cached
     def _get_plan(self, plan_id):
         """Get plan details with isolated connection - handles internal ID, Razorpay ID, or PayPal ID"""
+        def load():
+            with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                # Enhanced query to handle internal ID, Razorpay ID, or PayPal ID
+                cursor.execute(SQL_GET_PLAN, (plan_id, plan_id, plan_id))
+                return cursor.fetchone()
+        
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            # Enhanced query to handle internal ID, Razorpay ID, or PayPal ID
-            cursor.execute(
-                f"SELECT * FROM {DB_TABLE_SUBSCRIPTION_PLANS} WHERE id = %s OR razorpay_plan_id = %s OR paypal_plan_id = %s",
-                (plan_id, plan_id, plan_id)
-            )
-            plan = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
-            return plan
+            return _cached_plan_lookup(('plan', plan_id), load)
             
         except Exception as e:
             logger.error(f"Error getting plan: {str(e)}")
             raise
 
+    @request_cached
     def _get_user_info(self, user_id):
         """Get user info with isolated connection"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute("SELECT google_uid, email, display_name FROM users WHERE id = %s OR google_uid = %s", (user_id, user_id))
-            user = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
+            with self.db.get_read_connection() as conn:
+                rows = self.db.execute_prepared(conn, SQL_GET_USER_INFO, (user_id, user_id), dictionary=True)
             
+            user = rows[0] if rows else None
             if not user:
                 raise ValueError("Account verification failed. Please sign out and sign in again, or contact support if the issue persists.")
             
@@ -79,24 +594,16 @@ class BaseSubscriptionService:
     def _get_subscription_details(self, subscription_id):
         """Get subscription details with isolated connection"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                SELECT us.*, sp.name as plan_name, sp.amount, sp.currency, sp.interval
-                FROM {DB_TABLE_USER_SUBSCRIPTIONS} us
-                JOIN {DB_TABLE_SUBSCRIPTION_PLANS} sp ON us.plan_id = sp.id
-                WHERE us.id = %s
-            """, (subscription_id,))
-            
-            subscription = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
+            with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                cursor.execute(SQL_GET_SUB_DETAILS, (subscription_id,))
+                
+                subscription = cursor.fetchone()
         
             if not subscription:
                 raise ValueError("Unable to locate your subscription. Please verify your account or contact support for assistance.")
         
+            # Callers read metadata as a dict - parse it once here
+            subscription['metadata'] = parse_json_field(subscription.get('metadata'))
             return subscription
             
         except Exception as e:
@@ -106,18 +613,10 @@ class BaseSubscriptionService:
     def _get_subscription_for_cancellation(self, user_id, subscription_id):
         """Get subscription for cancellation with isolated connection"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                SELECT * FROM {DB_TABLE_USER_SUBSCRIPTIONS}
-                WHERE id = %s AND user_id = %s
-            """, (subscription_id, user_id))
-            
-            subscription = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
+            with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                cursor.execute(SQL_GET_SUB_FOR_CANCEL, (subscription_id, user_id))
+                
+                subscription = cursor.fetchone()
             
             if not subscription:
                 logger.error(f"Subscription not found or not owned by user: {subscription_id}")
@@ -132,25 +631,10 @@ class BaseSubscriptionService:
     def _clear_upgrade_pending_metadata(self, subscription_id):
         """Clear upgrade pending metadata (for cancellations)"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute(f"""
-                UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
-                SET metadata = JSON_REMOVE(
-                    IFNULL(metadata, '{{}}'), 
-                    '$.upgrade_pending_approval',
-                    '$.pending_plan_id',
-                    '$.upgrade_initiated_at',
-                    '$.upgrade_type'
-                ),
-                updated_at = NOW()
-                WHERE id = %s
-            """, (subscription_id,))
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with self.db.get_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_CLEAR_UPGRADE_PENDING_METADATA, (subscription_id,))
+                
+                conn.commit()
             
             logger.info(f"Cleared upgrade pending metadata for subscription {subscription_id}")
             
@@ -166,46 +650,76 @@ class BaseSubscriptionService:
             if not plan:
                 raise ValueError(f"Plan {new_plan_id} not found")
             
-            conn = self.db.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute(f"""
-                UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
-                SET plan_id = %s, updated_at = NOW()
-                WHERE id = %s
-            """, (plan['id'], subscription_id))  # ← FIXED: Use internal database plan ID
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with self.db.get_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_UPDATE_SUB_PLAN, (plan['id'], subscription_id))  # ← FIXED: Use internal database plan ID
+                
+                conn.commit()
             
         except Exception as e:
             logger.error(f"Error updating subscription plan: {str(e)}")
             raise
-    
+
+    def change_plan_and_reinit(self, user_id, subscription_id, new_plan_id, app_id, time_factor=1.0):
+        """
+        Switch a subscription to a new plan and reset its resource quota in one transaction
+
+        Args:
+            user_id: The user's ID (None to take it from the subscription row)
+            subscription_id: The subscription ID
+            new_plan_id: Internal, Razorpay or PayPal plan ID
+            app_id: The application ID (None to take it from the new plan)
+            time_factor: Optional time factor for mid-cycle upgrades
+
+        Returns:
+            bool: True once the plan change and quota reset are committed
+        """
+        try:
+            plan = self._get_plan(new_plan_id)
+            if not plan:
+                raise ValueError(f"Plan {new_plan_id} not found")
+
+            with self.db.get_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                try:
+                    cursor.execute(SQL_UPDATE_SUB_PLAN, (plan['id'], subscription_id))
+                    self._reset_quota_in_transaction(cursor, user_id, subscription_id, app_id, time_factor)
+
+                    conn.commit()
+
+                except Exception:
+                    conn.rollback()
+                    raise
+
+            return True
+
+        except Exception as e:
+            logger.error("Error changing plan and reinitializing quota: %s", e, exc_info=True)
+            raise
+
+    def _reset_quota_in_transaction(self, cursor, user_id, subscription_id, app_id, time_factor=1.0):
+        """Reset a subscription's quota on the caller's dictionary cursor; the caller commits"""
+        # Read back through the same transaction so the caller's subscription changes are used
+        cursor.execute(SQL_GET_SUB_WITH_FEATURES, (subscription_id,))
+        subscription_details = cursor.fetchone()
+        if not subscription_details:
+            raise ValueError(f"Subscription {subscription_id} not found")
+
+        user_id = user_id or subscription_details['user_id']
+        app_id = app_id or subscription_details['app_id']
+        quota_values = self._calculate_quota_values(
+            app_id, self._plan_feature_values(subscription_details), time_factor
+        )
+        cursor.execute(
+            UPSERT_QUOTA_RECORD_SQL,
+            self._quota_record_params(user_id, subscription_id, app_id, subscription_details, quota_values)
+        )
+
     def _clear_simple_upgrade_metadata(self, subscription_id):
         """Clear simple upgrade metadata after completion"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute(f"""
-                UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
-                SET metadata = JSON_REMOVE(
-                    IFNULL(metadata, '{{}}'), 
-                    '$.simple_upgrade_pending',
-                    '$.upgraded_to_plan',
-                    '$.upgrade_timestamp',
-                    '$.upgrade_type',
-                    '$.temporary_resources_added'
-                ),
-                updated_at = NOW()
-                WHERE id = %s
-            """, (subscription_id,))
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with self.db.get_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_CLEAR_SIMPLE_UPGRADE_METADATA, (subscription_id,))
+                
+                conn.commit()
             
             logger.info(f"Cleared simple upgrade metadata for subscription {subscription_id}")
             
@@ -221,20 +735,10 @@ class BaseSubscriptionService:
             if not plan:
                 raise ValueError(f"Plan {new_plan_id} not found")
             
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
-                SET plan_id = %s,
-                    metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s),
-                    updated_at = NOW()
-                WHERE id = %s
-            """, (plan['id'], json.dumps(upgrade_metadata), subscription_id))  # ← FIXED: Use internal database plan ID
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with self.db.get_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_UPDATE_SUB_PLAN_AND_METADATA, (plan['id'], json.dumps(upgrade_metadata), subscription_id))  # ← FIXED: Use internal database plan ID
+                
+                conn.commit()
             
             logger.info(f"Updated subscription {subscription_id} to plan {new_plan_id} with upgrade metadata")
             
@@ -245,53 +749,45 @@ class BaseSubscriptionService:
     def _get_subscription_with_features(self, subscription_id):
         """Get subscription with features using isolated connection"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                SELECT us.*, sp.features, sp.app_id 
-                FROM {DB_TABLE_USER_SUBSCRIPTIONS} us
-                JOIN {DB_TABLE_SUBSCRIPTION_PLANS} sp ON us.plan_id = sp.id
-                WHERE us.id = %s
-            """, (subscription_id,))
-            
-            subscription = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
+            with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                cursor.execute(SQL_GET_SUB_WITH_FEATURES, (subscription_id,))
+                
+                subscription = cursor.fetchone()
             return subscription
             
         except Exception as e:
             logger.error(f"Error getting subscription with features: {str(e)}")
             raise
 
+    def _get_subscriptions_with_features(self, subscription_ids, chunk_size=1000):
+        """Get subscriptions with plan features for many subscription IDs, keyed by subscription ID"""
+        subscription_ids = list(dict.fromkeys(subscription_ids))
+        subscriptions = {}
+        
+        with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+            for start in range(0, len(subscription_ids), chunk_size):
+                chunk = subscription_ids[start:start + chunk_size]
+                placeholders = ', '.join(['%s'] * len(chunk))
+                cursor.execute(f"""
+                    SELECT us.id, us.current_period_start, us.current_period_end, sp.app_id,
+                        {PLAN_QUOTA_FEATURE_COLUMNS}
+                    FROM {DB_TABLE_USER_SUBSCRIPTIONS} us
+                    JOIN {DB_TABLE_SUBSCRIPTION_PLANS} sp ON us.plan_id = sp.id
+                    WHERE us.id IN ({placeholders})
+                """, tuple(chunk))
+                
+                for subscription in cursor.fetchall():
+                    subscriptions[subscription['id']] = subscription
+        
+        return subscriptions
+
     def get_current_usage(self, user_id, subscription_id, app_id):
-        """Get current resource usage for proration calculation"""
+        """Get the full current resource usage record (quotas, originals, addons and billing period)"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                SELECT 
-                    document_pages_quota,
-                    perplexity_requests_quota,
-                    requests_quota,
-                    original_document_pages_quota,
-                    original_perplexity_requests_quota,
-                    original_requests_quota,
-                    current_addon_document_pages,
-                    current_addon_perplexity_requests,
-                    current_addon_requests,
-                    billing_period_start,
-                    billing_period_end
-                FROM {DB_TABLE_RESOURCE_USAGE}
-                WHERE user_id = %s AND subscription_id = %s AND app_id = %s
-                ORDER BY created_at DESC LIMIT 1
-            """, (user_id, subscription_id, app_id))
-            
-            usage = cursor.fetchone()
-            cursor.close()
-            conn.close()
+            with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                cursor.execute(SQL_GET_CURRENT_USAGE, (user_id, subscription_id, app_id))
+                
+                usage = cursor.fetchone()
             
             return usage
             
@@ -299,6 +795,21 @@ class BaseSubscriptionService:
             logger.error(f"Error getting current usage: {str(e)}")
             return None
 
+    def get_proration_usage(self, user_id, subscription_id, app_id):
+        """Get only the usage columns proration needs for this app, plus the billing period"""
+        sql = SQL_GET_PRORATION_USAGE['marketfit' if app_id == 'marketfit' else 'saleswit']
+        try:
+            with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                cursor.execute(sql, (user_id, subscription_id, app_id))
+                
+                usage = cursor.fetchone()
+            
+            return usage
+            
+        except Exception as e:
+            logger.error(f"Error getting proration usage: {str(e)}")
+            return None
+
     # =============================================================================
     # SHARED RESOURCE QUOTA METHODS
     # =============================================================================
@@ -312,8 +823,7 @@ class BaseSubscriptionService:
                 logger.error(f"Subscription {subscription_id} not found")
                 return False
             
-            # Parse features
-            features = self._parse_subscription_features(subscription_details.get('features', '{}'))
+            features = self._plan_feature_values(subscription_details)
             
             # Set quota based on app with time factor
             quota_values = self._calculate_quota_values(app_id, features, time_factor)
@@ -322,19 +832,9 @@ class BaseSubscriptionService:
             return self._save_quota_record_with_originals(user_id, subscription_id, app_id, subscription_details, quota_values)
             
         except Exception as e:
-            logger.error(f"Error initializing resource quota: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.error("Error initializing resource quota: %s", e, exc_info=True)
             return False
 
-    def _parse_subscription_features(self, features_str):
-        """Parse subscription features JSON"""
-        if isinstance(features_str, str):
-            try:
-                return json.loads(features_str)
-            except json.JSONDecodeError:
-                return {}
-        return features_str or {}
-
     def _calculate_quota_values(self, app_id, features, time_factor=1.0):
         """Calculate quota values based on app and features with optional time factor for mid-cycle upgrades"""
         import math
@@ -368,133 +868,164 @@ class BaseSubscriptionService:
     def _save_quota_record_with_originals(self, user_id, subscription_id, app_id, subscription_details, quota_values):
         """Save or update quota record with original quota tracking"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            # Check if existing record exists
-            cursor.execute(f"""
-                SELECT id FROM {DB_TABLE_RESOURCE_USAGE}
-                WHERE user_id = %s AND subscription_id = %s AND app_id = %s
-                ORDER BY created_at DESC LIMIT 1
-            """, (user_id, subscription_id, app_id))
-            
-            quota_record = cursor.fetchone()
-            
-            if quota_record:
-                # Update existing record
-                cursor.execute(f"""
-                    UPDATE {DB_TABLE_RESOURCE_USAGE}
-                    SET document_pages_quota = %s,
-                        perplexity_requests_quota = %s,
-                        requests_quota = %s,
-                        original_document_pages_quota = %s,
-                        original_perplexity_requests_quota = %s,
-                        original_requests_quota = %s,
-                        current_addon_document_pages = 0,
-                        current_addon_perplexity_requests = 0,
-                        current_addon_requests = 0,
-                        updated_at = NOW()
-                    WHERE id = %s
-                """, (
-                    quota_values['document_pages_quota'],
-                    quota_values['perplexity_requests_quota'],
-                    quota_values['requests_quota'],
-                    quota_values['original_document_pages_quota'],
-                    quota_values['original_perplexity_requests_quota'],
-                    quota_values['original_requests_quota'],
-                    quota_record['id']
-                ))
-                logger.info(f"Updated existing quota record {quota_record['id']}")
-            else:
-                # Create new record
-                cursor.execute(f"""
-                    INSERT INTO {DB_TABLE_RESOURCE_USAGE}
-                    (user_id, subscription_id, app_id, billing_period_start, billing_period_end,
-                    document_pages_quota, perplexity_requests_quota, requests_quota,
-                    original_document_pages_quota, original_perplexity_requests_quota, original_requests_quota,
-                    current_addon_document_pages, current_addon_perplexity_requests, current_addon_requests)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 0, 0, 0)
-                """, (
-                    user_id,
-                    subscription_id,
-                    app_id,
-                    subscription_details.get('current_period_start') or datetime.now(),
-                    subscription_details.get('current_period_end') or (datetime.now() + timedelta(days=30)),
-                    quota_values['document_pages_quota'],
-                    quota_values['perplexity_requests_quota'],
-                    quota_values['requests_quota'],
-                    quota_values['original_document_pages_quota'],
-                    quota_values['original_perplexity_requests_quota'],
-                    quota_values['original_requests_quota']
-                ))
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with self.db.get_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(
+                    UPSERT_QUOTA_RECORD_SQL,
+                    self._quota_record_params(user_id, subscription_id, app_id, subscription_details, quota_values)
+                )
+                
+                conn.commit()
             
             return True
             
         except Exception as e:
             logger.error(f"Error saving quota record: {str(e)}")
             raise
+
+    def _billing_period(self, subscription):
+        """Billing period start and end for a quota record, defaulting to DEFAULT_BILLING_PERIOD from now"""
+        period_start = subscription.get('current_period_start')
+        period_end = subscription.get('current_period_end')
+        if not period_start or not period_end:
+            now = datetime.now()
+            period_start = period_start or now
+            period_end = period_end or (now + DEFAULT_BILLING_PERIOD)
+        return period_start, period_end
+
+    def _quota_record_params(self, user_id, subscription_id, app_id, subscription_details, quota_values):
+        """Build the UPSERT_QUOTA_RECORD_SQL parameters for one quota record"""
+        return (
+            user_id,
+            subscription_id,
+            app_id,
+            *self._billing_period(subscription_details),
+            quota_values['document_pages_quota'],
+            quota_values['perplexity_requests_quota'],
+            quota_values['requests_quota'],
+            quota_values['original_document_pages_quota'],
+            quota_values['original_perplexity_requests_quota'],
+            quota_values['original_requests_quota']
+        )
+
+    def initialize_resource_quotas_bulk(self, records, time_factor=1.0, batch_size=None):
+        """
+        Initialize or reset resource quotas for many subscriptions at once
         
-    def _add_temporary_resources(self, user_id, subscription_id, app_id):
-        """Add double free plan resources temporarily"""
+        Subscription details are fetched with one query per 1000 subscriptions and
+        quota records are written with one multi-row upsert per batch.
+        
+        Args:
+            records: Iterable of (user_id, subscription_id, app_id) tuples
+            time_factor: Optional time factor applied to every quota
+            batch_size: Rows per INSERT statement (defaults to QUOTA_INSERT_BATCH_SIZE)
+            
+        Returns:
+            bool: True if every quota record was written
+        """
         try:
-            free_plan = self._get_free_plan(app_id)
-            if not free_plan:
-                logger.warning(f"No free plan found for {app_id}")
-                return
+            records = list(records)
+            batch_size = batch_size or QUOTA_INSERT_BATCH_SIZE
+            subscriptions = self._get_subscriptions_with_features([record[1] for record in records])
+            
+            rows = []
+            for user_id, subscription_id, app_id in records:
+                subscription_details = subscriptions.get(subscription_id)
+                if not subscription_details:
+                    logger.error(f"Subscription {subscription_id} not found")
+                    continue
+                
+                features = self._plan_feature_values(subscription_details)
+                quota_values = self._calculate_quota_values(app_id, features, time_factor)
+                rows.append(self._quota_record_params(user_id, subscription_id, app_id, subscription_details, quota_values))
+            
+            with self.db.get_connection() as conn, conn.cursor() as cursor:
+                for start in range(0, len(rows), batch_size):
+                    cursor.executemany(UPSERT_QUOTA_RECORD_SQL, rows[start:start + batch_size])
+                    conn.commit()
             
-            free_features = parse_json_field(free_plan.get('features', '{}'))
+            logger.info(f"Initialized {len(rows)} of {len(records)} quota records in bulk")
+            return len(rows) == len(records)
             
+        except Exception as e:
+            logger.error("Error initializing resource quotas in bulk: %s", e, exc_info=True)
+            return False
+
+    def create_quota_entries_bulk(self, records, batch_size=None):
+        """
+        Create missing resource quota entries for many subscriptions at once
+        
+        Unlike initialize_resource_quotas_bulk, existing entries are left
+        untouched, so this is safe to run for users who may already have a
+        quota (e.g. provisioning a batch of sign-ups).
+        
+        Args:
+            records: Iterable of (user_id, subscription_id, app_id) tuples
+            batch_size: Rows per INSERT statement (defaults to QUOTA_INSERT_BATCH_SIZE)
+            
+        Returns:
+            bool: True if an entry was written or already existed for every record
+        """
+        try:
+            records = list(records)
+            batch_size = batch_size or QUOTA_INSERT_BATCH_SIZE
+            subscriptions = self._get_subscriptions_with_features([record[1] for record in records])
+            
+            rows = []
+            for user_id, subscription_id, app_id in records:
+                subscription_details = subscriptions.get(subscription_id)
+                if not subscription_details:
+                    logger.error(f"Subscription {subscription_id} not found")
+                    continue
+                
+                quota_values = self._calculate_quota_values(app_id, self._plan_feature_values(subscription_details))
+                rows.append(self._quota_entry_params(user_id, subscription_details, app_id, quota_values))
+            
+            with self.db.get_connection() as conn, conn.cursor() as cursor:
+                for start in range(0, len(rows), batch_size):
+                    cursor.executemany(SQL_INSERT_QUOTA_ENTRY, rows[start:start + batch_size])
+                    conn.commit()
+            
+            logger.info(f"Created {len(rows)} of {len(records)} quota entries in bulk")
+            return len(rows) == len(records)
+            
+        except Exception as e:
+            logger.error("Error creating quota entries in bulk: %s", e, exc_info=True)
+            return False
+
+    def _add_temporary_resources(self, user_id, subscription_id, app_id):
+        """Add double free plan resources temporarily"""
+        try:
             if app_id == 'marketfit':
-                temp_doc_pages = free_features.get('document_pages', 40) * 2
-                temp_perplexity = free_features.get('perplexity_requests', 2) * 2
-                temp_requests = 0
+                update_query = SQL_ADD_TEMP_RESOURCES_MARKETFIT
             else:  # saleswit
-                temp_doc_pages = 0
-                temp_perplexity = 0
-                temp_requests = free_features.get('requests', 2) * 2
-            
-            conn = self.db.get_connection()
-            cursor = conn.cursor()
+                update_query = SQL_ADD_TEMP_RESOURCES_SALESWIT
             
-            cursor.execute(f"""
-                UPDATE {DB_TABLE_RESOURCE_USAGE}
-                SET document_pages_quota = document_pages_quota + %s,
-                    perplexity_requests_quota = perplexity_requests_quota + %s,
-                    requests_quota = requests_quota + %s,
-                    updated_at = NOW()
-                WHERE user_id = %s AND subscription_id = %s AND app_id = %s
-            """, (temp_doc_pages, temp_perplexity, temp_requests, user_id, subscription_id, app_id))
+            with self.db.get_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(update_query, (user_id, subscription_id, app_id))
+                updated = cursor.rowcount
+                
+                conn.commit()
             
-            conn.commit()
-            cursor.close()
-            conn.close()
+            if not updated:
+                logger.warning(f"No free plan or quota record found for {app_id} - temporary resources not added")
+                return
             
-            logger.info(f"Added temporary resources: {temp_doc_pages} docs, {temp_perplexity} perplexity, {temp_requests} requests")
+            logger.info(f"Added temporary {app_id} resources for subscription {subscription_id}")
             
         except Exception as e:
             logger.error(f"Error adding temporary resources: {str(e)}")
 
+    @request_cached
     def _get_free_plan(self, app_id):
         """Get free plan with isolated connection"""
+        def load():
+            with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                cursor.execute(SQL_GET_FREE_PLAN, (app_id,))
+                
+                return cursor.fetchone()
+        
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                SELECT * FROM {DB_TABLE_SUBSCRIPTION_PLANS}
-                WHERE app_id = %s AND amount = 0 AND is_active = TRUE
-                LIMIT 1
-            """, (app_id,))
-            
-            free_plan = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
-            return free_plan
+            return _cached_plan_lookup(('free_plan', app_id), load)
             
         except Exception as e:
             logger.error(f"Error getting free plan: {str(e)}")
@@ -533,36 +1064,26 @@ class BaseSubscriptionService:
         Returns:
             list: Available plans
         """
-        try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                SELECT id, name, description, amount, currency, `interval`, 
-                    interval_count, features, app_id, plan_type, payment_gateways,
-                    paypal_plan_id, razorpay_plan_id
-                FROM {DB_TABLE_SUBSCRIPTION_PLANS}
-                WHERE app_id = %s AND is_active = TRUE
-                ORDER BY amount ASC
-            """, (app_id,))
-            
-            plans = cursor.fetchall()
-            
-            cursor.close()
-            conn.close()
+        def load():
+            with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                cursor.execute(SQL_GET_AVAILABLE_PLANS, (app_id,))
+                
+                plans = cursor.fetchall()
             
-            # Process the plans - parse JSON fields
+            # Process the plans once at cache-fill time - features are parsed on first read
             for plan in plans:
                 if plan.get('features'):
-                    plan['features'] = parse_json_field(plan['features'])
+                    plan['features'] = LazyJSON(plan['features'])
                 
                 if plan.get('payment_gateways'):
                     plan['payment_gateways'] = parse_json_field(plan['payment_gateways'], ['razorpay'])
             
             return plans
+        
+        try:
+            return _cached_plan_lookup(('active_list', app_id), load)
         except Exception as e:
-            logger.error(f"Error getting available plans: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.error("Error getting available plans: %s", e, exc_info=True)
             return []
     
     def get_resource_quota(self, user_id, app_id):
@@ -586,21 +1107,75 @@ class BaseSubscriptionService:
            return quota
            
        except Exception as e:
-           logger.error(f"[AZURE DEBUG] Error in get_resource_quota: {str(e)}")
-           logger.error(traceback.format_exc())
+           logger.error("[AZURE DEBUG] Error in get_resource_quota: %s", e, exc_info=True)
            return self._initialize_quota_object(app_id)
 
+    def get_resource_quotas_bulk(self, user_ids, app_id, chunk_size=1000):
+       """
+       Get remaining resource quotas for many users with one query per chunk
+       
+       Args:
+           user_ids: User IDs to look up
+           app_id: The application ID
+           chunk_size: Maximum user IDs per IN (...) list
+           
+       Returns:
+           dict: {user_id: quota} for every requested user; users without an
+           active subscription or quota record get an empty quota object
+       """
+       user_ids = list(dict.fromkeys(user_ids))
+       quotas = {user_id: self._initialize_quota_object(app_id) for user_id in user_ids}
+       
+       try:
+           with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+               for start in range(0, len(user_ids), chunk_size):
+                   chunk = user_ids[start:start + chunk_size]
+                   placeholders = ', '.join(['%s'] * len(chunk))
+                   cursor.execute(f"""
+                       SELECT us.user_id, ru.id AS quota_record_id, ru.document_pages_quota, ru.perplexity_requests_quota, ru.requests_quota
+                       FROM {DB_TABLE_USER_SUBSCRIPTIONS} us
+                       LEFT JOIN {DB_TABLE_RESOURCE_USAGE} ru
+                         ON ru.subscription_id = us.id AND ru.user_id = us.user_id AND ru.app_id = us.app_id
+                       WHERE us.user_id IN ({placeholders}) AND us.app_id = %s AND us.status = 'active'
+                       ORDER BY us.user_id, us.current_period_end DESC, ru.created_at DESC
+                   """, (*chunk, app_id))
+                   
+                   seen = set()
+                   for row in cursor.fetchall():
+                       # First row per user is the latest active subscription, as in get_resource_quota
+                       if row['user_id'] in seen:
+                           continue
+                       seen.add(row['user_id'])
+                       if row['quota_record_id'] is not None and row['user_id'] in quotas:
+                           self._update_quota_from_record(app_id, quotas[row['user_id']], row)
+           
+           return quotas
+           
+       except Exception as e:
+           logger.error("[AZURE DEBUG] Error in get_resource_quotas_bulk: %s", e, exc_info=True)
+           return {user_id: self._initialize_quota_object(app_id) for user_id in user_ids}
+
     def check_resource_availability(self, user_id, app_id, resource_type, count=1):
         """Check if a user has enough resources for an action"""
         try:
-            # Ensure user has a resource quota entry
-            ensure_result = self.ensure_user_has_resource_quota(user_id, app_id)
-            if not ensure_result:
-                # This could be due to problematic subscription statuses or other errors
+            # Fetch subscription, quota and blocking status in one query
+            row = self._get_active_sub_with_quota(user_id, app_id)
+            
+            if not row or row['quota_record_id'] is None:
+                # No active subscription or quota entry yet - create them first
+                ensure_result = self.ensure_user_has_resource_quota(user_id, app_id)
+                if not ensure_result:
+                    # This could be due to problematic subscription statuses or other errors
+                    return False
+                row = self._get_active_sub_with_quota(user_id, app_id)
+                if not row or row['quota_record_id'] is None:
+                    return False
+            
+            if row['blocking_status']:
+                logger.warning(f"[AZURE DEBUG] Resources unavailable - user {user_id} has {row['blocking_status']} subscription")
                 return False
             
-            # Get the user's resource quota
-            quota = self.get_resource_quota(user_id, app_id)
+            quota = self._update_quota_from_record(app_id, self._initialize_quota_object(app_id), row)
             
             # Check if the quota is enough for the requested count
             if resource_type in quota:
@@ -612,8 +1187,7 @@ class BaseSubscriptionService:
             return False
                 
         except Exception as e:
-            logger.error(f"[AZURE DEBUG] Error in check_resource_availability: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.error("[AZURE DEBUG] Error in check_resource_availability: %s", e, exc_info=True)
             # Default to not available on error
             return False
 
@@ -621,56 +1195,117 @@ class BaseSubscriptionService:
        """Decrement resource quota for a user."""
        
        try:
-           # Check if resource is available
-           if not self.check_resource_availability(user_id, app_id, resource_type, count):
+           column_name = RESOURCE_QUOTA_COLUMNS.get(resource_type)
+           if not column_name:
+               logger.warning(f"[AZURE DEBUG] Resource type {resource_type} not found in quota for user {user_id}")
                return False
            
-           # Get subscription and quota record
-           subscription_id = self._get_active_subscription_id(user_id, app_id)
-           if not subscription_id:
-               return False
+           if count == 0:
+               # An UPDATE that changes nothing reports no affected rows, so a
+               # zero decrement only needs the availability check
+               return self.check_resource_availability(user_id, app_id, resource_type, count)
+           
+           # Check and decrement in one statement
+           result = self._decrement_quota_record(user_id, app_id, column_name, count)
+           if result != DECREMENT_INSUFFICIENT:
+               return result == DECREMENT_OK
            
-           quota_record_id = self._get_quota_record_id(user_id, subscription_id, app_id)
-           if not quota_record_id:
-               # Initialize quota first
-               init_result = self.initialize_resource_quota(user_id, subscription_id, app_id)
-               if init_result:
-                   return self.decrement_resource_quota(user_id, app_id, resource_type, count)
+           # Nothing updated - either there is no quota row yet or the balance is too low
+           row = self._get_active_sub_with_quota(user_id, app_id)
+           if row and (row['quota_record_id'] is not None or row['blocking_status']):
                return False
            
-           # Decrement the quota
-           return self._decrement_quota_record(quota_record_id, resource_type, count)
+           # Initialize quota first and retry once
+           if row:
+               initialized = self.initialize_resource_quota(user_id, row['subscription_id'], app_id)
+           else:
+               # No active subscription yet - this also creates the free subscription
+               initialized = self.ensure_user_has_resource_quota(user_id, app_id)
+           if not initialized:
+               return False
+           return self._decrement_quota_record(user_id, app_id, column_name, count) == DECREMENT_OK
            
        except Exception as e:
-           logger.error(f"[AZURE DEBUG] Error in decrement_resource_quota: {str(e)}")
-           logger.error(traceback.format_exc())
+           logger.error("[AZURE DEBUG] Error in decrement_resource_quota: %s", e, exc_info=True)
+           return False
+
+    def enqueue_resource_decrement(self, user_id, app_id, resource_type, count=1):
+       """
+       Record resource usage without waiting for the database
+       
+       For usage that has already been allowed (e.g. after
+       check_resource_availability): decrements are aggregated per user and
+       written in batches, clamped at zero. Use decrement_resource_quota when
+       the caller needs the quota to be enforced.
+       
+       Returns:
+           bool: True if the usage was queued
+       """
+       column_name = RESOURCE_QUOTA_COLUMNS.get(resource_type)
+       if not column_name:
+           logger.warning(f"[AZURE DEBUG] Resource type {resource_type} not found in quota for user {user_id}")
            return False
+       
+       self._quota_flusher.enqueue(user_id, app_id, column_name, count)
+       return True
+
+    def flush_resource_decrements(self):
+       """Write queued usage now (shutdown hooks and tests); returns the number of updates written"""
+       return self._quota_flusher.flush_now()
+
+    def decrement_resource_quota_and_read(self, user_id, app_id, resource_type, count=1):
+       """
+       Decrement resource quota for a user and return the remaining quota
+       
+       Returns:
+           dict or None: Remaining quota if the decrement succeeded, otherwise None
+       """
+       try:
+           column_name = RESOURCE_QUOTA_COLUMNS.get(resource_type)
+           if not column_name:
+               logger.warning(f"[AZURE DEBUG] Resource type {resource_type} not found in quota for user {user_id}")
+               return None
+           
+           quota_record = self._decrement_and_read_quota_record(user_id, app_id, column_name, count)
+           if quota_record:
+               return self._update_quota_from_record(app_id, self._initialize_quota_object(app_id), quota_record)
+           
+           # Slow path - let decrement_resource_quota tell a missing quota row from a low balance
+           if not self.decrement_resource_quota(user_id, app_id, resource_type, count):
+               return None
+           return self.get_resource_quota(user_id, app_id)
+           
+       except Exception as e:
+           logger.error("[AZURE DEBUG] Error in decrement_resource_quota_and_read: %s", e, exc_info=True)
+           return None
 
     def ensure_user_has_resource_quota(self, user_id, app_id='marketfit'):
         """Ensure a user has a resource quota entry in the database."""
         
         try:
-            # First check if there are any problematic subscription statuses
-            status_issue = self._check_subscription_status_issues(user_id, app_id)
+            # Status issues, active subscription and quota existence in one round-trip
+            status_issue, subscription, quota_exists = self._get_quota_setup_state(user_id, app_id)
             if status_issue:
                 logger.warning(f"[AZURE DEBUG] Cannot ensure quota - user {user_id} has {status_issue} subscription")
                 return False
             
-            # Get or create subscription (only returns active subscriptions)
-            subscription = self._get_or_create_subscription(user_id, app_id)
-            if not subscription:
-                return False
-            
-            # Check if quota entry exists
-            if self._quota_entry_exists(user_id, subscription['id'], app_id):
+            if subscription and quota_exists:
                 return True
             
+            # No active subscription - create a free one together with its quota entry
+            if not subscription:
+                free_plan = self._get_free_plan(app_id)
+                if not free_plan:
+                    logger.warning(f"[AZURE DEBUG] No free plan found for app {app_id}")
+                    return False
+                
+                return self._bootstrap_free_user(user_id, app_id, free_plan)
+            
             # Create quota entry
             return self._create_quota_entry(user_id, subscription, app_id)
             
         except Exception as e:
-            logger.error(f"[AZURE DEBUG] Error in ensure_user_has_resource_quota: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.error("[AZURE DEBUG] Error in ensure_user_has_resource_quota: %s", e, exc_info=True)
             return False
 
     def get_billing_history(self, user_id, app_id):
@@ -686,46 +1321,27 @@ class BaseSubscriptionService:
        """
        
        try:
-           conn = self.db.get_connection()
-           cursor = conn.cursor(dictionary=True)
-           
-           cursor.execute("""
-               SELECT i.* 
-               FROM subscription_invoices i
-               JOIN user_subscriptions s ON i.subscription_id = s.id
-               WHERE i.user_id = %s AND s.app_id = %s
-               ORDER BY i.invoice_date DESC
-           """, (user_id, app_id))
-           
-           invoices = cursor.fetchall()
-           cursor.close()
-           conn.close()
+           with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+               cursor.execute(SQL_GET_BILLING_HISTORY, (user_id, app_id))
+               
+               invoices = cursor.fetchall()
            
            return invoices
            
        except Exception as e:
-           logger.error(f"Error getting billing history: {str(e)}")
-           logger.error(traceback.format_exc())
+           logger.error("Error getting billing history: %s", e, exc_info=True)
            return []
 
     def _get_plan_interval_details(self, plan_id):
         """Get plan interval details with isolated connection"""
+        def load():
+            with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                cursor.execute(SQL_GET_PLAN_INTERVAL, (plan_id,))
+                
+                return cursor.fetchone()
+        
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            # Fixed SQL by adding backticks around the reserved keyword 'interval'
-            cursor.execute(f"""
-                SELECT `interval`, interval_count
-                FROM {DB_TABLE_SUBSCRIPTION_PLANS}
-                WHERE id = %s
-            """, (plan_id,))
-            
-            plan_details = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
-            return plan_details
+            return _cached_plan_lookup(('plan_interval', plan_id), load)
             
         except Exception as e:
             logger.error(f"Error getting plan interval details: {str(e)}")
@@ -734,21 +1350,10 @@ class BaseSubscriptionService:
     def _get_active_subscription(self, user_id, app_id):
         """Get active subscription with isolated connection"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                SELECT us.*, sp.name as plan_name, sp.features, sp.amount, sp.currency, sp.interval 
-                FROM {DB_TABLE_USER_SUBSCRIPTIONS} us
-                JOIN {DB_TABLE_SUBSCRIPTION_PLANS} sp ON us.plan_id = sp.id
-                WHERE us.user_id = %s AND us.app_id = %s AND us.status = 'active'
-                ORDER BY us.created_at DESC LIMIT 1
-            """, (user_id, app_id))
-            
-            subscription = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
+            with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                cursor.execute(SQL_GET_ACTIVE_SUBSCRIPTION, (user_id, app_id))
+                
+                subscription = cursor.fetchone()
             return subscription
             
         except Exception as e:
@@ -758,21 +1363,10 @@ class BaseSubscriptionService:
     def _get_pending_subscription(self, user_id, app_id):
         """Get pending subscription with isolated connection"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                SELECT us.*, sp.name as plan_name, sp.features, sp.amount, sp.currency, sp.interval 
-                FROM {DB_TABLE_USER_SUBSCRIPTIONS} us
-                JOIN {DB_TABLE_SUBSCRIPTION_PLANS} sp ON us.plan_id = sp.id
-                WHERE us.user_id = %s AND us.app_id = %s AND us.status = 'created'
-                ORDER BY us.created_at DESC LIMIT 1
-            """, (user_id, app_id))
-            
-            subscription = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
+            with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                cursor.execute(SQL_GET_PENDING_SUBSCRIPTION, (user_id, app_id))
+                
+                subscription = cursor.fetchone()
             return subscription
             
         except Exception as e:
@@ -780,34 +1374,33 @@ class BaseSubscriptionService:
             raise
 
     def _parse_subscription_json_fields(self, subscription):
-        """Parse JSON fields in subscription"""
+        """Wrap JSON fields in subscription so they are parsed on first read"""
         if subscription:
             if subscription.get('features'):
-                subscription['features'] = parse_json_field(subscription['features'])
+                subscription['features'] = LazyJSON(subscription['features'])
             
             if subscription.get('metadata'):
-                subscription['metadata'] = parse_json_field(subscription['metadata'])
+                subscription['metadata'] = LazyJSON(subscription['metadata'])
         
         return subscription
     
+    @request_cached
     def _get_active_subscription_id(self, user_id, app_id):
-       """Get active subscription ID with isolated connection"""
+       """Get active subscription ID, served from the per-worker cache when possible"""
+       subscription_id = _active_subscription_cache.get((user_id, app_id))
+       if subscription_id is not None:
+           return subscription_id
+       
        try:
-           conn = self.db.get_connection()
-           cursor = conn.cursor(dictionary=True)
+           with self.db.get_read_connection() as conn:
+               rows = self.db.execute_prepared(conn, SQL_GET_ACTIVE_SUB_ID, (user_id, app_id))
            
-           cursor.execute(f"""
-               SELECT id FROM {DB_TABLE_USER_SUBSCRIPTIONS}
-               WHERE user_id = %s AND app_id = %s AND status = 'active'
-               ORDER BY current_period_end DESC LIMIT 1
-           """, (user_id, app_id))
-           
-           subscription_result = cursor.fetchone()
-           
-           cursor.close()
-           conn.close()
+           if not rows:
+               return None
            
-           return subscription_result['id'] if subscription_result else None
+           subscription_id = rows[0][0]
+           _active_subscription_cache.set((user_id, app_id), subscription_id)
+           return subscription_id
            
        except Exception as e:
            logger.error(f"Error getting active subscription ID: {str(e)}")
@@ -816,19 +1409,10 @@ class BaseSubscriptionService:
     def _get_quota_record(self, user_id, subscription_id, app_id):
        """Get quota record with isolated connection"""
        try:
-           conn = self.db.get_connection()
-           cursor = conn.cursor(dictionary=True)
-           
-           cursor.execute(f"""
-               SELECT * FROM {DB_TABLE_RESOURCE_USAGE}
-               WHERE user_id = %s AND subscription_id = %s AND app_id = %s
-               ORDER BY created_at DESC LIMIT 1
-           """, (user_id, subscription_id, app_id))
-           
-           quota_result = cursor.fetchone()
-           
-           cursor.close()
-           conn.close()
+           with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+               cursor.execute(SQL_GET_QUOTA_RECORD, (user_id, subscription_id, app_id))
+               
+               quota_result = cursor.fetchone()
            
            return quota_result
            
@@ -836,6 +1420,25 @@ class BaseSubscriptionService:
            logger.error(f"Error getting quota record: {str(e)}")
            return None
 
+    def _get_active_sub_with_quota(self, user_id, app_id):
+       """
+       Get the active subscription, its latest quota record and any blocking
+       subscription status in a single round-trip.
+       Returns None if the user has no active subscription.
+       """
+       try:
+           with self.db.get_read_connection() as conn:
+               rows = self.db.execute_prepared(
+                   conn, SQL_GET_ACTIVE_SUB_WITH_QUOTA,
+                   (*PROBLEMATIC_SUBSCRIPTION_STATUSES, user_id, app_id), dictionary=True
+               )
+           
+           return rows[0] if rows else None
+           
+       except Exception as e:
+           logger.error(f"Error getting active subscription with quota: {str(e)}")
+           return None
+
     def _update_quota_from_record(self, app_id, quota, quota_result):
        """Update quota object from database record"""
        if app_id == 'marketfit':
@@ -860,100 +1463,57 @@ class BaseSubscriptionService:
            }
 
 
-    def _get_quota_record_id(self, user_id, subscription_id, app_id):
-       """Get quota record ID with isolated connection"""
-       try:
-           conn = self.db.get_connection()
-           cursor = conn.cursor(dictionary=True)
-           
-           cursor.execute(f"""
-               SELECT id FROM {DB_TABLE_RESOURCE_USAGE}
-               WHERE user_id = %s AND subscription_id = %s AND app_id = %s
-               ORDER BY created_at DESC LIMIT 1
-           """, (user_id, subscription_id, app_id))
-           
-           quota_record = cursor.fetchone()
-           
-           cursor.close()
-           conn.close()
-           
-           return quota_record['id'] if quota_record else None
-           
-       except Exception as e:
-           logger.error(f"Error getting quota record ID: {str(e)}")
-           return None
-
-    def _decrement_quota_record(self, quota_record_id, resource_type, count):
-       """Decrement quota record with isolated connection"""
+    def _decrement_quota_record(self, user_id, app_id, column_name, count):
+       """
+       Atomically decrement the active subscription's quota if enough is left.
+       
+       Returns:
+           str: DECREMENT_OK if a quota row was updated, DECREMENT_INSUFFICIENT if
+               nothing matched (low balance, missing row or blocked), DECREMENT_ERROR
+       """
        try:
-           conn = self.db.get_connection()
-           cursor = conn.cursor(dictionary=True)
-           
-           # Update the quota by decrementing the specified resource
-           column_name = f"{resource_type}_quota"
-           update_query = f"""
-               UPDATE {DB_TABLE_RESOURCE_USAGE}
-               SET {column_name} = GREATEST(0, {column_name} - %s),
-                   updated_at = NOW()
-               WHERE id = %s
-           """
+           with self.db.get_connection() as conn:
+               updated = self.db.execute_prepared_write(
+                   conn, SQL_DECREMENT_QUOTA[column_name], self._decrement_quota_params(user_id, app_id, count)
+               ) == 1
+               conn.commit()
            
-           cursor.execute(update_query, (count, quota_record_id))
-           conn.commit()
-           
-           cursor.close()
-           conn.close()
-           
-           return True
+           return DECREMENT_OK if updated else DECREMENT_INSUFFICIENT
            
        except Exception as e:
-           logger.error(f"[AZURE DEBUG] Error updating quota: {str(e)}")
-           logger.error(traceback.format_exc())
-           return False
+           logger.error("[AZURE DEBUG] Error updating quota: %s", e, exc_info=True)
+           return DECREMENT_ERROR
 
-    def _get_or_create_subscription(self, user_id, app_id):
-       """Get existing subscription or create free subscription"""
+    def _decrement_and_read_quota_record(self, user_id, app_id, column_name, count):
+       """
+       Decrement the active subscription's quota and read the balances back
+       in one round-trip (UPDATE and SELECT sent as a single multi-statement).
+       Returns the quota record if it was decremented, otherwise None.
+       """
        try:
-           # First try to get existing active subscription
-           subscription = self._get_active_subscription_for_quota(user_id, app_id)
-           if subscription:
-               return subscription
-           
-           # No active subscription, check for free plan
-           free_plan = self._get_free_plan(app_id)
-           if not free_plan:
-               logger.warning(f"[AZURE DEBUG] No free plan found for app {app_id}")
+           with self.db.get_connection() as conn, conn.cursor(dictionary=True) as cursor:
+               quota_record = None
+               results = cursor.execute(
+                   SQL_DECREMENT_QUOTA[column_name] + ';' + SQL_READ_QUOTA_AFTER_DECREMENT,
+                   (*self._decrement_quota_params(user_id, app_id, count), user_id, app_id, user_id, app_id),
+                   multi=True
+               )
+               for result in results:
+                   if result.with_rows:
+                       quota_record = result.fetchone()
+               conn.commit()
+           
+           if not quota_record or quota_record['updated'] != 1:
                return None
-           
-           # Create free subscription
-           return self._create_free_subscription_for_quota(user_id, free_plan, app_id)
+           return quota_record
            
        except Exception as e:
-           logger.error(f"Error getting or creating subscription: {str(e)}")
-           raise
+           logger.error("[AZURE DEBUG] Error updating quota: %s", e, exc_info=True)
+           return None
 
-    def _get_active_subscription_for_quota(self, user_id, app_id):
-       """Get active subscription for quota with isolated connection"""
-       try:
-           conn = self.db.get_connection()
-           cursor = conn.cursor(dictionary=True)
-           
-           cursor.execute(f"""
-               SELECT id, plan_id, status, current_period_start, current_period_end 
-               FROM {DB_TABLE_USER_SUBSCRIPTIONS}
-               WHERE user_id = %s AND app_id = %s AND status = 'active'
-               ORDER BY created_at DESC LIMIT 1
-           """, (user_id, app_id))
-           
-           subscription = cursor.fetchone()
-           
-           cursor.close()
-           conn.close()
-           return subscription
-           
-       except Exception as e:
-           logger.error(f"Error getting active subscription for quota: {str(e)}")
-           raise
+    def _decrement_quota_params(self, user_id, app_id, count):
+       """Build the SQL_DECREMENT_QUOTA parameters"""
+       return (count, user_id, app_id, count, user_id, app_id, user_id, app_id, *PROBLEMATIC_SUBSCRIPTION_STATUSES)
 
     def _check_subscription_status_issues(self, user_id, app_id):
         """
@@ -961,33 +1521,15 @@ class BaseSubscriptionService:
         Includes statuses from both Razorpay and PayPal webhooks
         """
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            # All statuses that indicate a subscription is not fully active
-            problematic_statuses = [
-                'pending',          # Payment pending (Razorpay) 
-                'halted',           # Payment failed, subscription suspended (Razorpay)
-                'authenticated',    # Payment method authenticated but not active (Razorpay)
-                'payment_failed',   # Failed payment (PayPal)
-                'suspended'         # Suspended subscription (PayPal)
-            ]
-            
-            status_list = ', '.join([f"'{status}'" for status in problematic_statuses])
-            
-            cursor.execute(f"""
-                SELECT id, status FROM {DB_TABLE_USER_SUBSCRIPTIONS}
-                WHERE user_id = %s AND app_id = %s AND status IN ({status_list})
-                ORDER BY created_at DESC LIMIT 1
-            """, (user_id, app_id))
-            
-            problematic_subscription = cursor.fetchone()
-            cursor.close()
-            conn.close()
+            with self.db.get_read_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_GET_BLOCKING_STATUS, (user_id, app_id, *PROBLEMATIC_SUBSCRIPTION_STATUSES))
+                
+                problematic_subscription = cursor.fetchone()
             
             if problematic_subscription:
-                logger.warning(f"[AZURE DEBUG] Found {problematic_subscription['status']} subscription for user {user_id}")
-                return problematic_subscription['status']
+                status = problematic_subscription[1]
+                logger.warning(f"[AZURE DEBUG] Found {status} subscription for user {user_id}")
+                return status
             
             return None
             
@@ -995,105 +1537,97 @@ class BaseSubscriptionService:
             logger.error(f"Error checking subscription status issues: {str(e)}")
             return None
 
-    def _create_free_subscription_for_quota(self, user_id, free_plan, app_id):
-       """Create free subscription for quota with isolated connection"""
-       try:
-           conn = self.db.get_connection()
-           cursor = conn.cursor(dictionary=True)
-           
-           subscription_id = generate_id('sub_')
-           current_period_start = datetime.now()
-           current_period_end = current_period_start + timedelta(days=30)
-           
-           cursor.execute(f"""
-               INSERT INTO {DB_TABLE_USER_SUBSCRIPTIONS}
-               (id, user_id, plan_id, status, app_id, current_period_start, current_period_end)
-               VALUES (%s, %s, %s, 'active', %s, %s, %s)
-           """, (
-               subscription_id, 
-               user_id, 
-               free_plan['id'], 
-               app_id,
-               current_period_start,
-               current_period_end
-           ))
-           
-           conn.commit()
-           cursor.close()
-           conn.close()
-           
-           
-           return {
-               'id': subscription_id,
-               'plan_id': free_plan['id'],
-               'current_period_start': current_period_start,
-               'current_period_end': current_period_end
-           }
-           
-       except Exception as e:
-           logger.error(f"Error creating free subscription for quota: {str(e)}")
-           raise
+    def _bootstrap_free_user(self, user_id, app_id, free_plan):
+       """
+       Create a free subscription and its quota entry in one transaction
+       (one connection, one commit). Retried once on a dropped connection;
+       the retry reuses the subscription id so it can never insert twice.
+       """
+       quota_values = self._calculate_quota_values(app_id, self._get_plan_feature_values(free_plan['id']))
+       subscription_id = generate_id('sub_')
+       current_period_start = datetime.now()
+       current_period_end = current_period_start + DEFAULT_BILLING_PERIOD
+       
+       for attempt in range(2):
+           try:
+               with self.db.get_connection() as conn, conn.cursor() as cursor:
+                   try:
+                       cursor.execute(SQL_INSERT_FREE_SUBSCRIPTION, (
+                           subscription_id,
+                           user_id,
+                           free_plan['id'],
+                           app_id,
+                           current_period_start,
+                           current_period_end
+                       ))
+                       cursor.execute(SQL_INSERT_QUOTA_ENTRY, (
+                           user_id,
+                           subscription_id,
+                           app_id,
+                           current_period_start,
+                           current_period_end,
+                           quota_values['document_pages_quota'],
+                           quota_values['perplexity_requests_quota'],
+                           quota_values['requests_quota']
+                       ))
+                       
+                       conn.commit()
+                   except Exception:
+                       conn.rollback()
+                       raise
+               break
+               
+           except mysql.connector.errors.OperationalError as e:
+               if attempt:
+                   logger.error(f"Error bootstrapping free subscription: {str(e)}")
+                   raise
+               logger.warning(f"[AZURE DEBUG] Retrying free subscription bootstrap for user {user_id}: {str(e)}")
+               time.sleep(0.1)
+               
+           except Exception as e:
+               logger.error(f"Error bootstrapping free subscription: {str(e)}")
+               raise
+       
+       invalidate_active_subscription_cache(user_id, app_id)
+       return True
 
-    def _quota_entry_exists(self, user_id, subscription_id, app_id):
-       """Check if quota entry exists with isolated connection"""
+    def _get_quota_setup_state(self, user_id, app_id):
+       """
+       Run SQL_ENSURE_QUOTA_LOOKUP as a single multi-statement round-trip
+       
+       Returns:
+           tuple: (blocking status or None, active subscription or None, whether its quota entry exists)
+       """
        try:
-           conn = self.db.get_connection()
-           cursor = conn.cursor(dictionary=True)
-           
-           cursor.execute(f"""
-               SELECT id 
-               FROM {DB_TABLE_RESOURCE_USAGE}
-               WHERE user_id = %s AND subscription_id = %s AND app_id = %s
-               ORDER BY created_at DESC LIMIT 1
-           """, (user_id, subscription_id, app_id))
-           
-           quota_entry = cursor.fetchone()
+           with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+               results = cursor.execute(
+                   SQL_ENSURE_QUOTA_LOOKUP,
+                   (user_id, app_id, *PROBLEMATIC_SUBSCRIPTION_STATUSES, user_id, app_id),
+                   multi=True
+               )
+               status_row, subscription = [result.fetchone() for result in results if result.with_rows]
            
-           cursor.close()
-           conn.close()
-           
-           return quota_entry is not None
+           quota_exists = bool(subscription) and subscription.pop('quota_record_id') is not None
+           return (status_row['status'] if status_row else None), subscription, quota_exists
            
        except Exception as e:
-           logger.error(f"Error checking quota entry existence: {str(e)}")
+           logger.error(f"Error getting quota setup state: {str(e)}")
            raise
 
     def _create_quota_entry(self, user_id, subscription, app_id):
        """Create quota entry with isolated connection"""
        try:
            # Get plan features
-           plan_features = self._get_plan_features(subscription['plan_id'])
+           features = self._get_plan_feature_values(subscription['plan_id'])
            
            # Calculate quota values
-           features = self._parse_subscription_features(plan_features)
            quota_values = self._calculate_quota_values(app_id, features)
            
            # Create quota record
-           conn = self.db.get_connection()
-           cursor = conn.cursor(dictionary=True)
-           
-           period_start = subscription.get('current_period_start') or datetime.now()
-           period_end = subscription.get('current_period_end') or (datetime.now() + timedelta(days=30))
-           
-           cursor.execute(f"""
-               INSERT INTO {DB_TABLE_RESOURCE_USAGE}
-               (user_id, subscription_id, app_id, billing_period_start, billing_period_end,
-               document_pages_quota, perplexity_requests_quota, requests_quota)
-               VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-           """, (
-               user_id,
-               subscription['id'],
-               app_id,
-               period_start,
-               period_end,
-               quota_values['document_pages_quota'],
-               quota_values['perplexity_requests_quota'],
-               quota_values['requests_quota']
-           ))
-           
-           conn.commit()
-           cursor.close()
-           conn.close()
+           with self.db.get_connection() as conn, conn.cursor() as cursor:
+               cursor.execute(SQL_INSERT_QUOTA_ENTRY, self._quota_entry_params(user_id, subscription, app_id, quota_values))
+               
+               conn.commit()
            
            return True
            
@@ -1101,28 +1635,38 @@ class BaseSubscriptionService:
            logger.error(f"Error creating quota entry: {str(e)}")
            raise
 
-    def _get_plan_features(self, plan_id):
-       """Get plan features with isolated connection"""
+    def _quota_entry_params(self, user_id, subscription, app_id, quota_values):
+       """Build the SQL_INSERT_QUOTA_ENTRY parameters for one quota entry"""
+       return (
+           user_id,
+           subscription['id'],
+           app_id,
+           *self._billing_period(subscription),
+           quota_values['document_pages_quota'],
+           quota_values['perplexity_requests_quota'],
+           quota_values['requests_quota']
+       )
+
+    def _get_plan_feature_values(self, plan_id):
+       """Get a plan's quota features as integers, extracted from the features JSON by MySQL"""
+       def load():
+           with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+               cursor.execute(SQL_GET_PLAN_FEATURE_VALUES, (plan_id,))
+               
+               plan = cursor.fetchone()
+           
+           return self._plan_feature_values(plan) if plan else None
+       
        try:
-           conn = self.db.get_connection()
-           cursor = conn.cursor(dictionary=True)
-           
-           cursor.execute(f"""
-               SELECT features FROM {DB_TABLE_SUBSCRIPTION_PLANS}
-               WHERE id = %s
-           """, (plan_id,))
-           
-           plan = cursor.fetchone()
-           
-           cursor.close()
-           conn.close()
-           
-           return plan['features'] if plan else '{}'
+           return _cached_plan_lookup(('plan_features', plan_id), load) or {}
            
        except Exception as e:
            logger.error(f"Error getting plan features: {str(e)}")
-           return '{}'
-    
+           return {}
+
+    def _plan_feature_values(self, row):
+       """Pick the quota features present in a row selected with PLAN_QUOTA_FEATURE_COLUMNS"""
+       return {feature: row[feature] for feature in PLAN_QUOTA_FEATURES if row.get(feature) is not None}
 
     def _calculate_subscription_period(self, subscription_data, plan_id):
         """Calculate subscription period dates"""
@@ -1150,7 +1694,7 @@ class BaseSubscriptionService:
            )
         else:
            # Default to 30 days if plan details not found
-           period_end = start_date + timedelta(days=30)
+           period_end = start_date + DEFAULT_BILLING_PERIOD
        
         return start_date, period_end
 
@@ -1158,22 +1702,10 @@ class BaseSubscriptionService:
     def _activate_subscription_with_period(self, subscription_id, start_date, period_end, subscription_data):
        """Activate subscription with period dates"""
        try:
-           conn = self.db.get_connection()
-           cursor = conn.cursor(dictionary=True)
-           
-           cursor.execute(f"""
-               UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
-               SET status = 'active', 
-                   current_period_start = %s,
-                   current_period_end = %s,
-                   updated_at = NOW(),
-                   metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s)
-               WHERE razorpay_subscription_id = %s
-           """, (start_date, period_end, json.dumps(subscription_data), subscription_id))
-           
-           conn.commit()
-           cursor.close()
-           conn.close()
+           with self.db.get_connection() as conn, conn.cursor() as cursor:
+               cursor.execute(SQL_ACTIVATE_SUB_WITH_PERIOD, (start_date, period_end, json.dumps(subscription_data), subscription_id))
+               
+               conn.commit()
            
        except Exception as e:
            logger.error(f"Error activating subscription with period: {str(e)}")
@@ -1208,25 +1740,16 @@ class BaseSubscriptionService:
             return self._parse_subscription_json_fields(subscription)
             
         except Exception as e:
-            logger.error(f"Error getting user subscription: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.error("Error getting user subscription: %s", e, exc_info=True)
             raise
 
     def _get_existing_subscription(self, user_id, app_id):
         """Get existing subscription with isolated connection"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                SELECT * FROM {DB_TABLE_USER_SUBSCRIPTIONS} 
-                WHERE user_id = %s AND app_id = %s AND status = 'active'
-            """, (user_id, app_id))
-            
-            existing = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
+            with self.db.get_read_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                cursor.execute(SQL_GET_EXISTING_SUB, (user_id, app_id))
+                
+                existing = cursor.fetchone()
             return existing
             
         except Exception as e:
@@ -1236,58 +1759,43 @@ class BaseSubscriptionService:
     def _handle_free_subscription(self, user_id, plan_id, app_id, plan, existing_subscription):
         """Handle free subscription creation with focused transaction"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            # Start transaction for free subscription
-            try:
-                if existing_subscription:
-                    # User already has a subscription, update if it's not the same plan
-                    if existing_subscription['plan_id'] != plan['id']:  # ← FIXED: Compare with internal plan ID
-                        cursor.execute(f"""
-                            UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
-                            SET plan_id = %s, current_period_start = NOW(), 
-                                current_period_end = DATE_ADD(NOW(), INTERVAL %s MONTH)
-                            WHERE id = %s
-                        """, (plan['id'], plan['interval_count'], existing_subscription['id']))  # ← FIXED: Use internal plan ID
-                        subscription_id = existing_subscription['id']
+            with self.db.get_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                # Start transaction for free subscription
+                try:
+                    if existing_subscription:
+                        # User already has a subscription, update if it's not the same plan
+                        if existing_subscription['plan_id'] != plan['id']:  # ← FIXED: Compare with internal plan ID
+                            cursor.execute(SQL_CHANGE_FREE_SUB_PLAN, (plan['id'], plan['interval_count'], existing_subscription['id']))  # ← FIXED: Use internal plan ID
+                            subscription_id = existing_subscription['id']
+                        else:
+                            subscription_id = existing_subscription['id']
                     else:
-                        subscription_id = existing_subscription['id']
-                else:
-                    # Create new subscription record
-                    subscription_id = generate_id('sub_')
-                    current_period_start = datetime.now()
-                    current_period_end = calculate_period_end(
-                        current_period_start, 
-                        plan['interval'], 
-                        plan['interval_count']
-                    )
+                        # Create new subscription record
+                        subscription_id = generate_id('sub_')
+                        current_period_start = datetime.now()
+                        current_period_end = calculate_period_end(
+                            current_period_start, 
+                            plan['interval'], 
+                            plan['interval_count']
+                        )
+                        
+                        cursor.execute(SQL_INSERT_FREE_SUBSCRIPTION, (subscription_id, user_id, plan['id'], app_id, current_period_start, current_period_end))  # ← FIXED: Use internal plan ID
                     
-                    cursor.execute(f"""
-                        INSERT INTO {DB_TABLE_USER_SUBSCRIPTIONS}
-                        (id, user_id, plan_id, status, current_period_start, current_period_end, app_id)
-                        VALUES (%s, %s, %s, 'active', %s, %s, %s)
-                    """, (subscription_id, user_id, plan['id'], current_period_start, current_period_end, app_id))  # ← FIXED: Use internal plan ID
-                
-                conn.commit()
-                
-                result = {
-                    'id': subscription_id,
-                    'user_id': user_id,
-                    'plan_id': plan_id,
-                    'status': 'active',
-                    'app_id': app_id
-                }
-                
-                cursor.close()
-                conn.close()
-                return result
-                
-            except Exception as e:
-                conn.rollback()
-                cursor.close()
-                conn.close()
-                raise
+                    conn.commit()
+                    
+                except Exception as e:
+                    conn.rollback()
+                    raise
+            
+            invalidate_active_subscription_cache(user_id, app_id)
+            
+            return {
+                'id': subscription_id,
+                'user_id': user_id,
+                'plan_id': plan_id,
+                'status': 'active',
+                'app_id': app_id
+            }
                 
         except Exception as e:
             logger.error(f"Error creating free subscription: {str(e)}")
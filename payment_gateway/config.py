@@ -2,11 +2,32 @@
 Configuration for the payment gateway package.
 """
 import os
+import atexit
 import logging
+import queue
+import threading
 from datetime import datetime
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-def setup_logging(name='payment_gateway'):
-    """Set up logging for the payment gateway"""
+_logging_lock = threading.Lock()
+
+def setup_logging(name='payment_gateway', log_file=None):
+    """
+    Set up logging for the payment gateway
+    
+    Records are handed to a queue and written by a background listener thread,
+    so request threads never block on log I/O. Logs go to stderr unless a
+    log_file (or the LOG_FILE environment variable) is given; the file is
+    rotated at LOG_FILE_MAX_BYTES (default 10 MB), keeping
+    LOG_FILE_BACKUP_COUNT (default 5) old files.
+    """
+    logger = logging.getLogger(name)
+    
+    # Check if logger already has handlers to avoid duplicates
+    if logger.handlers:
+        return logger
+    
     # Get log level from environment variable
     log_level_str = os.getenv('LOG_LEVEL', 'INFO').upper()
     try:
@@ -14,16 +35,29 @@ def setup_logging(name='payment_gateway'):
     except AttributeError:
         log_level = logging.INFO  # Fallback if invalid level provided
     
-    logger = logging.getLogger(name)
-    
-    # Check if logger already has handlers to avoid duplicates
-    if not logger.handlers:
-        handler = logging.StreamHandler()
-        handler.setLevel(log_level)  # Use environment variable
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        logger.setLevel(log_level)  # Use environment variable
+    with _logging_lock:
+        if not logger.handlers:
+            log_file = log_file or os.getenv('LOG_FILE')
+            if log_file:
+                handler = RotatingFileHandler(
+                    log_file,
+                    maxBytes=int(os.getenv('LOG_FILE_MAX_BYTES', str(10 * 1024 * 1024))),
+                    backupCount=int(os.getenv('LOG_FILE_BACKUP_COUNT', '5'))
+                )
+            else:
+                handler = logging.StreamHandler()
+            handler.setLevel(log_level)  # Use environment variable
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            handler.setFormatter(formatter)
+            
+            log_queue = queue.Queue(-1)
+            listener = QueueListener(log_queue, handler, respect_handler_level=True)
+            listener.start()
+            # Drain queued records on shutdown
+            atexit.register(listener.stop)
+            
+            logger.addHandler(QueueHandler(log_queue))
+            logger.setLevel(log_level)  # Use environment variable
     
     return logger
 
@@ -40,6 +74,13 @@ DEFAULT_DB_CONFIG = {
     'database': os.getenv('DB_NAME', 'app_database')
 }
 
+# Pooled MySQL connections per process and database, shared by its two pools:
+# transactional writes get half (at least one), autocommit reads and
+# single-statement writes the rest. Pools open every connection when they are
+# created, so each worker process holds this many connections; an exhausted
+# pool falls back to a dedicated connection per call.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+
 # Payment gateway credentials
 RAZORPAY_KEY_ID = os.getenv('RAZORPAY_KEY_ID', '')
 RAZORPAY_KEY_SECRET = os.getenv('RAZORPAY_KEY_SECRET', '')
@@ -65,14 +106,68 @@ DB_TABLE_SUBSCRIPTION_INVOICES = 'subscription_invoices'
 DB_TABLE_SUBSCRIPTION_EVENTS = 'subscription_events_log'
 DB_TABLE_RESOURCE_USAGE = 'resource_usage'
 
+# Brand shown on PayPal checkout pages, per app_id
+BRAND_NAMES = {
+    'marketfit': 'MarketFit',
+    'saleswit': 'SalesWit',
+}
+DEFAULT_BRAND_NAME = 'SalesWit'
+
+# On-disk cache for gateway metadata fetched at startup (stale-while-revalidate)
+GATEWAY_METADATA_CACHE_DIR = os.getenv(
+    'PAYMENT_GATEWAY_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'payment_gateway')
+)
+GATEWAY_METADATA_TTL = int(os.getenv('PAYMENT_GATEWAY_METADATA_TTL', '3600'))
+
+# Import the lazily loaded gateway modules in a background thread at init
+PAYMENT_GATEWAY_PREWARM = os.getenv('PAYMENT_GATEWAY_PREWARM', '0') == '1'
+
+# Connection pool size for the shared per-gateway HTTP sessions
+HTTP_POOL_SIZE = int(os.getenv('PAYMENT_GATEWAY_HTTP_POOL_SIZE', '32'))
+
+# URL prefix for the payment gateway blueprint
+PAYMENT_ROUTES_PREFIX = '/api/subscriptions'
+
+# In-process cache for subscription plan lookups (plans change at deploy time)
+PLAN_CACHE_TTL = int(os.getenv('PAYMENT_GATEWAY_PLAN_CACHE_TTL', '3600'))
+PLAN_CACHE_SIZE = int(os.getenv('PAYMENT_GATEWAY_PLAN_CACHE_SIZE', '256'))
+
+# Per-worker cache of each user's active subscription id. Kept short because
+# writes made by other workers can only be picked up once an entry expires
+ACTIVE_SUBSCRIPTION_CACHE_TTL = int(os.getenv('PAYMENT_GATEWAY_ACTIVE_SUB_CACHE_TTL', '60'))
+ACTIVE_SUBSCRIPTION_CACHE_SIZE = int(os.getenv('PAYMENT_GATEWAY_ACTIVE_SUB_CACHE_SIZE', '10000'))
+
+# Per-worker record of webhook events this worker claimed, so provider retries
+# of them are answered without a database round-trip
+CLAIMED_EVENT_CACHE_TTL = int(os.getenv('PAYMENT_GATEWAY_CLAIMED_EVENT_CACHE_TTL', '86400'))
+CLAIMED_EVENT_CACHE_SIZE = int(os.getenv('PAYMENT_GATEWAY_CLAIMED_EVENT_CACHE_SIZE', '50000'))
+
+# Rows per multi-row INSERT when initializing quotas in bulk (keeps packets under max_allowed_packet)
+QUOTA_INSERT_BATCH_SIZE = int(os.getenv('PAYMENT_GATEWAY_QUOTA_BATCH_SIZE', '500'))
+
+# How long queued usage decrements are aggregated before being written (milliseconds)
+QUOTA_FLUSH_MS = int(os.getenv('PAYMENT_GATEWAY_QUOTA_FLUSH_MS', '50'))
+# Longest wait before retrying a failed usage flush; retries back off exponentially (milliseconds)
+QUOTA_FLUSH_MAX_BACKOFF_MS = int(os.getenv('PAYMENT_GATEWAY_QUOTA_FLUSH_MAX_BACKOFF_MS', '30000'))
+
+# Subscription events are written in the background: up to EVENT_LOG_BATCH_SIZE
+# rows per INSERT, waiting at most EVENT_LOG_FLUSH_MS for a batch to fill
+EVENT_LOG_BATCH_SIZE = int(os.getenv('PAYMENT_GATEWAY_EVENT_LOG_BATCH_SIZE', '100'))
+EVENT_LOG_FLUSH_MS = int(os.getenv('PAYMENT_GATEWAY_EVENT_LOG_FLUSH_MS', '250'))
+# Events queued beyond this are written synchronously by the caller instead
+EVENT_LOG_QUEUE_SIZE = int(os.getenv('PAYMENT_GATEWAY_EVENT_LOG_QUEUE_SIZE', '10000'))
+
 
 # API Base URL function - using your existing variable names
+# URL helpers read the environment once per process (a missing variable is not cached)
+@lru_cache(maxsize=1)
 def get_api_base_url():
     """Get API base URL using the same variables as frontend"""
     
     # Priority 1: MarketFit variable (VITE_API_BASE_URL)
     vite_api_url = os.getenv('VITE_API_BASE_URL')
-    logger.info(f"DEBUG: VITE_API_BASE_URL = {vite_api_url}")
+    logger.debug(f"VITE_API_BASE_URL = {vite_api_url}")
 
     if vite_api_url:
         return vite_api_url
@@ -98,14 +193,17 @@ def get_api_base_url():
     )
 
 # Dynamic webhook and PayPal URL functions
+@lru_cache(maxsize=1)
 def get_webhook_base_url():
     """Get webhook base URL dynamically"""
     return get_api_base_url()
 
+@lru_cache(maxsize=1)
 def get_paypal_return_url():
     """Get PayPal return URL dynamically"""
     return f"{get_webhook_base_url()}/api/subscriptions/paypal-success"
 
+@lru_cache(maxsize=1)
 def get_paypal_cancel_url():
     """Get PayPal cancel URL dynamically"""
     return f"{get_webhook_base_url()}/api/subscriptions/paypal-cancel"
@@ -114,6 +212,7 @@ def get_paypal_cancel_url():
 # ADD these new environment variables
 PAYPAL_WEBHOOK_ID = os.getenv('PAYPAL_WEBHOOK_ID', '')
 
+@lru_cache(maxsize=1)
 def get_frontend_url():
     """Get frontend URL for redirects"""
     frontend_url = os.getenv('FRONTEND_URL')
@@ -1,13 +1,29 @@
 """
 Database utilities for the payment gateway package.
+
+Requires MySQL 8.0 or later (the schema uses utf8mb4_0900_ai_ci and
+descending index keys). Pooled connections are not reset between
+borrowers: nothing here keeps session state (temporary tables, user
+variables, session settings), and _ConnectionPool rolls back any open
+transaction when a connection is returned.
 """
 import mysql.connector
-import json
+from mysql.connector import errorcode, pooling
+import atexit
+import functools
 import logging
-import traceback
-from datetime import datetime
+import queue
+import threading
+import time
+from .utils.helpers import json_dumps, TTLCache
 from .config import (
     DEFAULT_DB_CONFIG, 
+    DB_POOL_SIZE,
+    EVENT_LOG_BATCH_SIZE,
+    EVENT_LOG_FLUSH_MS,
+    EVENT_LOG_QUEUE_SIZE,
+    CLAIMED_EVENT_CACHE_SIZE,
+    CLAIMED_EVENT_CACHE_TTL,
     DB_TABLE_SUBSCRIPTION_PLANS,
     DB_TABLE_USER_SUBSCRIPTIONS,
     DB_TABLE_SUBSCRIPTION_INVOICES,
@@ -17,6 +33,164 @@ from .config import (
 
 logger = logging.getLogger('payment_gateway')
 
+# Multi-row insert for EventLogWriter: SQL_LOG_EVENTS followed by one
+# SQL_LOG_EVENT_ROW per event, comma-separated
+SQL_LOG_EVENTS = f"""
+    INSERT INTO {DB_TABLE_SUBSCRIPTION_EVENTS}
+    (event_type, entity_id, provider, user_id, data, processed, created_at)
+    VALUES """
+# created_at is the database's NOW(), like every other table's timestamps; rows
+# reach it within EVENT_LOG_FLUSH_MS of being logged
+SQL_LOG_EVENT_ROW = "(%s, %s, %s, %s, %s, %s, NOW())"
+
+@functools.lru_cache(maxsize=128)
+def _log_events_sql(row_count):
+    """Multi-row event insert for row_count rows, built once per row count"""
+    return SQL_LOG_EVENTS + ', '.join([SQL_LOG_EVENT_ROW] * row_count)
+
+# Providers inferred from an event type that names them, checked in order
+_EVENT_PROVIDERS = ('razorpay', 'paypal', 'admin')
+
+# A cached prepared statement handle is unusable after these errors. The pure
+# Python driver reports an unknown handler once the pool has reconnected; the
+# C extension reports the closed statement or the lost connection instead.
+LOST_CONNECTION_ERRORS = frozenset((
+    errorcode.CR_SERVER_GONE_ERROR,
+    errorcode.CR_SERVER_LOST,
+    errorcode.CR_SERVER_LOST_EXTENDED,
+))
+STALE_PREPARED_STATEMENT_ERRORS = LOST_CONNECTION_ERRORS | frozenset((
+    errorcode.ER_UNKNOWN_STMT_HANDLER,
+    errorcode.CR_NO_PREPARE_STMT,
+    errorcode.CR_STMT_CLOSED,
+))
+
+# Hot webhook statements, run as server-side prepared statements (reused by identity)
+SQL_LOG_SUBSCRIPTION_ACTION = """
+    INSERT INTO subscription_audit_log
+    (subscription_id, action_type, details, initiated_by, created_at)
+    VALUES (%s, %s, %s, %s, NOW())
+"""
+
+# Answered from the UNIQUE (event_id, provider) key alone
+SQL_IS_EVENT_PROCESSED = """
+    SELECT 1 FROM webhook_events_processed
+    WHERE event_id = %s AND provider = %s
+    LIMIT 1
+"""
+
+SQL_MARK_EVENT_PROCESSED = """
+    INSERT IGNORE INTO webhook_events_processed
+    (event_id, provider, processed_at)
+    VALUES (%s, %s, NOW())
+"""
+
+SQL_RELEASE_EVENT = """
+    DELETE FROM webhook_events_processed
+    WHERE event_id = %s AND provider = %s
+"""
+
+# Connection pools shared by every DatabaseManager with the same config
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Event log writers, one per connection pool (keyed by pool name)
+_event_writers = {}
+
+# Webhook events claimed by this worker, keyed by (provider, event_id)
+_claimed_events = TTLCache(maxsize=CLAIMED_EVENT_CACHE_SIZE, ttl=CLAIMED_EVENT_CACHE_TTL)
+
+class _ConnectionPool(pooling.MySQLConnectionPool):
+    """
+    Connection pool that rolls back any transaction a caller left open.
+    The pool skips the per-checkout session reset, so an aborted write must
+    not leak into the next borrower's commit.
+    """
+    
+    def add_connection(self, cnx=None):
+        if cnx is not None:
+            try:
+                if cnx.in_transaction:
+                    cnx.rollback()
+            except mysql.connector.Error as e:
+                logger.warning("Error rolling back pooled connection: %s", e)
+        super().add_connection(cnx)
+
+class EventLogWriter:
+    """
+    Writes subscription events in the background, in batches
+    
+    Events are queued by log_event and written by a daemon thread as one
+    multi-row INSERT of up to batch_size rows, at most interval_ms after the
+    first event of a batch arrives. Whatever is still queued is written at
+    interpreter exit. A batch that fails to write is logged and dropped.
+    When more than max_queued events are waiting, enqueue writes the event
+    itself rather than let the backlog grow.
+    """
+    
+    def __init__(self, db, batch_size=None, interval_ms=None, max_queued=None):
+        self.db = db
+        self.batch_size = EVENT_LOG_BATCH_SIZE if batch_size is None else batch_size
+        self.interval = (EVENT_LOG_FLUSH_MS if interval_ms is None else interval_ms) / 1000.0
+        self._queue = queue.Queue(maxsize=EVENT_LOG_QUEUE_SIZE if max_queued is None else max_queued)
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def enqueue(self, row):
+        """Queue one event row (values in SQL_LOG_EVENT_ROW order)"""
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            logger.warning("Event log queue is full, writing event synchronously")
+            self._write([row])
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True, name='pg-event-log-writer')
+                    self._thread.start()
+                    atexit.register(self.flush)
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+    
+    def _drain(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+    
+    def flush(self):
+        """
+        Write all queued events immediately
+        
+        Returns:
+            int: Number of events written
+        """
+        written = 0
+        batch = self._drain()
+        while batch:
+            if self._write(batch):
+                written += len(batch)
+            batch = self._drain()
+        return written
+    
+    def _write(self, batch):
+        return self.db.insert_event_rows(batch)
+
 class DatabaseManager:
     """
     Database manager for payment gateway operations.
@@ -24,141 +198,389 @@ class DatabaseManager:
     """
     
     def __init__(self, db_config=None):
-        """Initialize the database manager"""
-        self.db_config = db_config or DEFAULT_DB_CONFIG
+        """
+        Initialize the database manager
         
-    def get_connection(self):
-        """Get a new database connection"""
+        db_config may set 'pool_size' to override DB_POOL_SIZE, the connection
+        budget its two pools share, and 'pool_reset_session' to reset each
+        connection's session (COM_RESET_CONNECTION) when it is borrowed.
+        """
+        self.db_config = db_config or DEFAULT_DB_CONFIG
+        self._pool = None
+        self._autocommit_pool = None
+        self._event_writer = None
+        if not mysql.connector.HAVE_CEXT:
+            logger.info("MySQL C extension not available, using the pure-Python driver")
+        # Connection arguments are built once, for both kinds of connection
+        self._connection_configs = {
+            autocommit: self._build_connection_config(autocommit) for autocommit in (False, True)
+        }
+    
+    def _connection_config(self, autocommit=False):
+        """Connection arguments for this manager's database"""
+        return self._connection_configs[autocommit]
+    
+    def _build_connection_config(self, autocommit):
         # Create a copy of config to avoid modifying the original
         config = self.db_config.copy()
+        # Pool settings are applied by the pool itself, not passed to connect()
+        config.pop('pool_size', None)
+        config.pop('pool_reset_session', None)
         # Set buffered=True, overriding any existing value
         config['buffered'] = True
-        return mysql.connector.connect(**config)
+        # Prefer the C extension; forcing use_pure=False without it installed
+        # makes connect() raise ImportError, so fall back to pure Python
+        config.setdefault('use_pure', not mysql.connector.HAVE_CEXT)
+        if autocommit:
+            config['autocommit'] = True
+        return config
+    
+    def _pool_size(self, autocommit):
+        """This pool's share of the per-database connection budget (pool_size or DB_POOL_SIZE)"""
+        budget = max(2, int(self.db_config.get('pool_size', DB_POOL_SIZE)))
+        transactional = budget // 2
+        return budget - transactional if autocommit else transactional
+    
+    def _get_pool(self, autocommit):
+        key = (autocommit, tuple(sorted((k, repr(v)) for k, v in self.db_config.items())))
+        pool_size = self._pool_size(autocommit)
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _ConnectionPool(
+                    pool_name=f"payment_gateway_{len(_pools)}",
+                    pool_size=pool_size,
+                    pool_reset_session=bool(self.db_config.get('pool_reset_session', False)),
+                    **self._connection_config(autocommit)
+                )
+                _pools[key] = pool
+                logger.info("Created database connection pool %s (size %d, autocommit=%s)", pool.pool_name, pool_size, autocommit)
+        return pool
+    
+    @property
+    def pool(self):
+        """Connection pool for this config, created on first use and shared across managers"""
+        if self._pool is None:
+            self._pool = self._get_pool(autocommit=False)
+        return self._pool
+    
+    @property
+    def autocommit_pool(self):
+        """Autocommit connection pool for reads and single-statement writes, created on first use and shared across managers"""
+        if self._autocommit_pool is None:
+            self._autocommit_pool = self._get_pool(autocommit=True)
+        return self._autocommit_pool
+        
+    def get_connection(self):
+        """
+        Get a pooled database connection. close() (or leaving a with block)
+        returns it to the pool. Falls back to a dedicated connection when the
+        pool is exhausted.
+        """
+        try:
+            return self.pool.get_connection()
+        except pooling.PoolError:
+            logger.warning("Database connection pool exhausted, opening a dedicated connection")
+            return mysql.connector.connect(**self._connection_config())
+    
+    def get_autocommit_connection(self):
+        """
+        Get a pooled autocommit connection for reads and single-statement writes.
+        
+        Every statement commits on its own: writes need no commit() round-trip,
+        and reads leave no transaction to roll back when the connection returns
+        to the pool. Never use it for writes that must commit together - use
+        get_connection for those.
+        """
+        try:
+            return self.autocommit_pool.get_connection()
+        except pooling.PoolError:
+            logger.warning("Database autocommit connection pool exhausted, opening a dedicated connection")
+            return mysql.connector.connect(**self._connection_config(autocommit=True))
+    
+    def get_read_connection(self):
+        """Get a pooled autocommit connection for SELECT-only work (see get_autocommit_connection)"""
+        return self.get_autocommit_connection()
+    
+    def get_prepared_cursor(self, conn, sql):
+        """
+        Get a server-side prepared cursor for sql on this connection.
+        
+        Cursors are kept on the underlying connection, which stays open while it
+        sits in the pool, so executing the same SQL string object again skips the
+        PREPARE round-trip. They are keyed by the server connection ID and
+        dropped when the pool has reconnected the connection since they were
+        prepared. Rows come back as tuples. Do not close the cursor.
+        """
+        cnx = self._physical_connection(conn)
+        connection_id = cnx.connection_id
+        cached = getattr(cnx, '_prepared_cursors', None)
+        if cached is None or cached[0] != connection_id:
+            cached = cnx._prepared_cursors = (connection_id, {})
+        
+        cursors = cached[1]
+        cursor = cursors.get(sql)
+        if cursor is None:
+            # Prepared cursors cannot be buffered
+            cursor = cnx.cursor(prepared=True, buffered=False)
+            cursors[sql] = cursor
+        return cursor
+    
+    @staticmethod
+    def _physical_connection(conn):
+        """The driver connection behind a pooled connection"""
+        return conn._cnx if isinstance(conn, pooling.PooledMySQLConnection) else conn
+    
+    def _run_prepared(self, conn, sql, params):
+        """Execute sql on its cached prepared cursor, re-preparing once if the statement was lost to a reconnect"""
+        cursor = self.get_prepared_cursor(conn, sql)
+        try:
+            cursor.execute(sql, params)
+        except mysql.connector.Error as e:
+            if e.errno not in STALE_PREPARED_STATEMENT_ERRORS:
+                raise
+            # The statement handle is gone; forget every statement prepared on this
+            # connection so no later checkout reuses a dead handle
+            cnx = self._physical_connection(conn)
+            cnx._prepared_cursors = None
+            if e.errno in LOST_CONNECTION_ERRORS and not cnx.is_connected():
+                raise
+            cursor = self.get_prepared_cursor(conn, sql)
+            cursor.execute(sql, params)
+        return cursor
+    
+    def execute_prepared(self, conn, sql, params=(), dictionary=False):
+        """
+        Run sql as a prepared statement and return all rows.
+        
+        sql should be a module-level constant: statements are reused by identity.
+        A statement lost to a reconnect is re-prepared once.
+        
+        Returns:
+            list: Rows as tuples, or as dicts keyed by column name if dictionary=True
+        """
+        cursor = self._run_prepared(conn, sql, params)
+        rows = cursor.fetchall()
+        if dictionary:
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in rows]
+        return rows
+    
+    def execute_prepared_write(self, conn, sql, params=()):
+        """
+        Run an INSERT/UPDATE/DELETE as a prepared statement. The caller commits (not needed on an autocommit connection).
+        
+        Returns:
+            int: Number of affected rows
+        """
+        return self._run_prepared(conn, sql, params).rowcount
     
     def init_tables(self):
         """Initialize database tables required for payment processing"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with self.get_connection() as conn:
+                conn.commit()
             
             logger.info("Payment gateway database tables initialized successfully")
             return True
             
         except Exception as e:
-            logger.error(f"Error initializing database tables: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error initializing database tables: %s", e)
             return False
         
+    @property
+    def event_writer(self):
+        """Background writer for log_event, shared by managers with the same config"""
+        if self._event_writer is None:
+            pool_name = self.pool.pool_name
+            with _pools_lock:
+                writer = _event_writers.get(pool_name)
+                if writer is None:
+                    writer = _event_writers[pool_name] = EventLogWriter(self)
+            self._event_writer = writer
+        return self._event_writer
+    
+    def _event_row(self, event_type, entity_id, user_id, data, provider=None, processed=False):
+        """Build one event log row (values in SQL_LOG_EVENT_ROW order)"""
+        # Convert data to JSON string if it's a dict or list
+        data_json = json_dumps(data) if isinstance(data, (dict, list)) else data
+        
+        # Ensure provider is never null
+        if provider is None:
+            # Determine provider based on event type if possible
+            event_type_lower = str(event_type).lower()
+            provider = next((name for name in _EVENT_PROVIDERS if name in event_type_lower), None)
+            if provider is None:
+                provider = 'admin' if str(user_id).lower() == 'admin' else 'system'  # Default fallback
+        
+        return (event_type, entity_id, provider, user_id, data_json, processed)
+    
+    def insert_event_rows(self, rows):
+        """
+        Write event log rows now, as one multi-row INSERT
+        
+        Returns:
+            bool: True if the rows were written
+        """
+        try:
+            with self.get_autocommit_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(_log_events_sql(len(rows)), [value for row in rows for value in row])
+            
+            return True
+            
+        except Exception as e:
+            logger.exception("Error writing %d logged events: %s", len(rows), e)
+            return False
+    
     def log_event(self, event_type, entity_id, user_id, data, provider=None, processed=False):
-        """Log a payment event for debugging and auditing"""
+        """
+        Log a payment event for debugging and auditing
+        
+        The event is queued and written in the background (see EventLogWriter),
+        so the caller never waits on the INSERT.
+        """
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            row = self._event_row(event_type, entity_id, user_id, data, provider, processed)
             
-            # Convert data to JSON string if it's a dict
-            data_json = json.dumps(data) if isinstance(data, dict) else data
+            logger.debug("Logging event: %s with provider: %s", event_type, row[2])
             
-            # Ensure provider is never null
-            if provider is None:
-                # Determine provider based on event type if possible
-                if 'razorpay' in str(event_type).lower():
-                    provider = 'razorpay'
-                elif 'paypal' in str(event_type).lower():
-                    provider = 'paypal'
-                elif 'admin' in str(event_type).lower() or str(user_id).lower() == 'admin':
-                    provider = 'admin'
-                else:
-                    provider = 'system'  # Default fallback
-            
-            logger.debug(f"Logging event: {event_type} with provider: {provider}")
-            
-            cursor.execute(f'''
-                INSERT INTO {DB_TABLE_SUBSCRIPTION_EVENTS}
-                (event_type, entity_id, provider, user_id, data, processed, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, NOW())
-            ''', (event_type, entity_id, provider, user_id, data_json, processed))
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            self.event_writer.enqueue(row)
             
             return True
         
         except Exception as e:
-            logger.error(f"Error logging event: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error logging event: %s", e)
+            return False
+    
+    def log_event_sync(self, event_type, entity_id, user_id, data, provider=None, processed=False):
+        """
+        Log a payment event now, bypassing the background queue
+        
+        For events that must be stored before the caller continues.
+        
+        Returns:
+            bool: True if the event was written
+        """
+        try:
+            row = self._event_row(event_type, entity_id, user_id, data, provider, processed)
+        except Exception as e:
+            logger.exception("Error logging event: %s", e)
+            return False
+        
+        return self.insert_event_rows([row])
+    
+    def close(self):
+        """Write any events still queued by log_event (call on shutdown)"""
+        if self._event_writer is not None:
+            self._event_writer.flush()
+    
+    def log_events_bulk(self, events, batch_size=None):
+        """
+        Log many payment events now, with one multi-row INSERT per batch
+        
+        Args:
+            events: Iterable of log_event argument tuples
+                (event_type, entity_id, user_id, data[, provider[, processed]])
+            batch_size: Rows per INSERT statement (defaults to EVENT_LOG_BATCH_SIZE)
+            
+        Returns:
+            bool: True if every event was written
+        """
+        try:
+            rows = [self._event_row(*event) for event in events]
+        except Exception as e:
+            logger.exception("Error logging events in bulk: %s", e)
             return False
         
+        batch_size = batch_size or EVENT_LOG_BATCH_SIZE
+        written = True
+        for start in range(0, len(rows), batch_size):
+            written = self.insert_event_rows(rows[start:start + batch_size]) and written
+        return written
+        
     def log_subscription_action(self, subscription_id, action_type, details, initiated_by='system'):
         """Log subscription changes for audit trail"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                INSERT INTO subscription_audit_log 
-                (subscription_id, action_type, details, initiated_by, created_at)
-                VALUES (%s, %s, %s, %s, NOW())
-            """, (subscription_id, action_type, json.dumps(details), initiated_by))
+            with self.get_autocommit_connection() as conn:
+                self.execute_prepared_write(
+                    conn, SQL_LOG_SUBSCRIPTION_ACTION, (subscription_id, action_type, json_dumps(details), initiated_by)
+                )
             
-            conn.commit()
-            cursor.close()
-            conn.close()
-            
-            logger.debug(f"Logged subscription action: {action_type} for {subscription_id}")
+            logger.debug("Logged subscription action: %s for %s", action_type, subscription_id)
             return True
             
         except Exception as e:
-            logger.error(f"Error logging subscription action: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error logging subscription action: %s", e)
             return False
 
     def is_event_processed(self, event_id, provider):
         """Check if webhook event has already been processed"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT id FROM webhook_events_processed 
-                WHERE event_id = %s AND provider = %s
-            """, (event_id, provider))
-            
-            result = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
+            with self.get_read_connection() as conn:
+                rows = self.execute_prepared(conn, SQL_IS_EVENT_PROCESSED, (event_id, provider))
             
-            return result is not None
+            return bool(rows)
             
         except Exception as e:
-            logger.error(f"Error checking event processed status: {str(e)}")
+            logger.error("Error checking event processed status: %s", e)
             return False
 
     def mark_event_processed(self, event_id, provider):
         """Mark webhook event as processed"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self.get_autocommit_connection() as conn:
+                self.execute_prepared_write(conn, SQL_MARK_EVENT_PROCESSED, (event_id, provider))
             
-            cursor.execute("""
-                INSERT IGNORE INTO webhook_events_processed 
-                (event_id, provider, processed_at)
-                VALUES (%s, %s, NOW())
-            """, (event_id, provider))
+            return True
+            
+        except Exception as e:
+            logger.exception("Error marking event as processed: %s", e)
+            return False
+
+    def claim_event(self, event_id, provider):
+        """
+        Atomically mark a webhook event as processed, in one round-trip
+        
+        Relies on the UNIQUE (event_id, provider) key: of several concurrent
+        deliveries of the same event, exactly one claims it. Call
+        release_event if processing the claimed event fails, so the
+        provider's retry is processed again.
+        
+        Retries of an event this worker claimed are rejected from
+        _claimed_events without a query.
+        
+        Returns:
+            bool: True if this call claimed the event (or the claim could not be
+                recorded), False if it had already been claimed
+        """
+        key = (provider, event_id)
+        if _claimed_events.get(key):
+            return False
+        
+        try:
+            with self.get_autocommit_connection() as conn:
+                claimed = self.execute_prepared_write(conn, SQL_MARK_EVENT_PROCESSED, (event_id, provider)) == 1
             
-            conn.commit()
-            cursor.close()
-            conn.close()
+        except Exception as e:
+            # Same as a failed is_event_processed check - process rather than drop the event
+            logger.error("Error claiming event: %s", e)
+            return True
+        
+        # Only our own claims are remembered: a claim held by another worker
+        # may still be released, and its retry must then reach the database
+        if claimed:
+            _claimed_events.set(key, True)
+        return claimed
+
+    def release_event(self, event_id, provider):
+        """Undo claim_event for an event whose processing failed"""
+        _claimed_events.pop((provider, event_id))
+        try:
+            with self.get_autocommit_connection() as conn:
+                self.execute_prepared_write(conn, SQL_RELEASE_EVENT, (event_id, provider))
             
             return True
             
         except Exception as e:
-            logger.error(f"Error marking event as processed: {str(e)}")
-            logger.error(traceback.format_exc())
-            return False
\ No newline at end of file
+            logger.exception("Error releasing event claim: %s", e)
+            return False
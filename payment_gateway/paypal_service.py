@@ -4,30 +4,103 @@ Handles all PayPal subscription management and webhook processing
 """
 import json
 import logging
-import traceback
 import os
 from datetime import datetime, timedelta, timezone
 
-from .base_subscription_service import BaseSubscriptionService
+from .base_subscription_service import BaseSubscriptionService, invalidate_active_subscription_cache
 from .providers.paypal_provider import PayPalProvider
-from .utils.helpers import generate_id, calculate_period_end, calculate_billing_cycle_info, calculate_resource_utilization, parse_json_field
-from .config import setup_logging, DB_TABLE_SUBSCRIPTION_PLANS, DB_TABLE_USER_SUBSCRIPTIONS, DB_TABLE_RESOURCE_USAGE
+from .utils.helpers import generate_id, calculate_period_end, calculate_billing_cycle_info, calculate_resource_utilization, parse_json_field, json_dumps
+from .config import setup_logging, DB_TABLE_USER_SUBSCRIPTIONS, DB_TABLE_RESOURCE_USAGE, BRAND_NAMES, DEFAULT_BRAND_NAME
 
 logger = logging.getLogger('payment_gateway')
 
+def _utcnow_iso():
+    """Current UTC time as an ISO 8601 string, for timestamps stored in metadata and logs"""
+    return datetime.now(timezone.utc).isoformat()
+
+# Hot write statements, run as server-side prepared statements (reused by identity)
+SQL_INSERT_PAYPAL_SUBSCRIPTION = f"""
+    INSERT INTO {DB_TABLE_USER_SUBSCRIPTIONS}
+    (id, user_id, plan_id, paypal_subscription_id, payment_gateway, 
+    status, app_id, gateway_metadata, created_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())
+"""
+
+SQL_STORE_APPROVAL_REQUIREMENT = f"""
+    UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
+    SET metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s),
+        updated_at = NOW()
+    WHERE id = %s
+"""
+
+SQL_CLEAR_APPROVAL_METADATA = f"""
+    UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
+    SET metadata = JSON_REMOVE(
+        IFNULL(metadata, '{{}}'), 
+        '$.paypal_approval_required',
+        '$.approval_url',
+        '$.pending_plan_id',
+        '$.approval_created_at'
+    ),
+    updated_at = NOW()
+    WHERE id = %s
+"""
+
+SQL_CLEAR_ALL_APPROVAL_STATE = f"""
+    UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
+    SET metadata = JSON_REMOVE(
+        IFNULL(metadata, '{{}}'), 
+        '$.paypal_approval_required',
+        '$.approval_url',
+        '$.pending_plan_id',
+        '$.approval_created_at',
+        '$.pending_paypal_upgrade'
+    ),
+    updated_at = NOW()
+    WHERE id = %s
+"""
+
+# One invoice per PayPal payment (UNIQUE paypal_payment_id): a retried
+# payment webhook marks the existing invoice paid instead of adding another
+SQL_UPSERT_PAYPAL_INVOICE = """
+    INSERT INTO subscription_invoices
+    (id, subscription_id, user_id, paypal_payment_id, amount, currency,
+    status, payment_method, invoice_date, paid_at, app_id)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW(), %s)
+    ON DUPLICATE KEY UPDATE status = 'paid', paid_at = COALESCE(paid_at, NOW())
+"""
+
+SQL_GET_INVOICE_BY_PAYPAL_PAYMENT = """
+    SELECT id FROM subscription_invoices
+    WHERE paypal_payment_id = %s
+"""
+
+# PayPal webhook event type -> PayPalService handler method name
+PAYPAL_WEBHOOK_HANDLERS = {
+    'BILLING.SUBSCRIPTION.CREATED': '_handle_subscription_created',
+    'BILLING.SUBSCRIPTION.ACTIVATED': '_handle_subscription_activated',
+    'PAYMENT.SALE.COMPLETED': '_handle_payment_sale_completed',
+    'PAYMENT.CAPTURE.COMPLETED': '_handle_payment_capture_completed',
+    'BILLING.SUBSCRIPTION.PAYMENT.FAILED': '_handle_subscription_payment_failed',
+    'BILLING.SUBSCRIPTION.CANCELLED': '_handle_subscription_cancelled',
+    'BILLING.SUBSCRIPTION.SUSPENDED': '_handle_subscription_suspended',
+}
+
 class PayPalService(BaseSubscriptionService):
     """
     PayPal-specific payment service class
     Handles PayPal subscriptions, upgrades, cancellations, and webhook processing
     """
     
-    def __init__(self, app=None, db_config=None):
-        """Initialize the PayPal service"""
+    __slots__ = ('paypal', 'app')
+    
+    def __init__(self, app=None, db_config=None, session=None):
+        """Initialize the PayPal service; the provider shares the PayPal HTTP session unless session is given"""
         # Initialize base service
         super().__init__(db_config)
         
         # Initialize PayPal provider
-        self.paypal = PayPalProvider()
+        self.paypal = PayPalProvider(session)
         
         # Initialize Flask app if provided
         self.app = app
@@ -60,7 +133,7 @@ class PayPalService(BaseSubscriptionService):
         Returns:
             dict: Subscription creation result with approval URL
         """
-        logger.info(f"Creating PayPal subscription for user {user_id}, plan {plan_id}")
+        logger.info("Creating PayPal subscription for user %s, plan %s", user_id, plan_id)
         
         try:
             # Phase 1: Get plan details
@@ -77,7 +150,7 @@ class PayPalService(BaseSubscriptionService):
             
             customer_info.update({
                 'user_id': user_id,
-                'brand_name': 'MarketFit' if app_id == 'marketfit' else 'SalesWit'
+                'brand_name': BRAND_NAMES.get(app_id, DEFAULT_BRAND_NAME)
             })
             
             # Phase 3: Create subscription with PayPal
@@ -99,10 +172,10 @@ class PayPalService(BaseSubscriptionService):
                 'payment_gateway': 'paypal',
                 'status': 'pending_approval',
                 'app_id': app_id,
-                'gateway_metadata': paypal_result
+                'gateway_metadata': self._slim_paypal_result(paypal_result)
             }
             
-            subscription_id = self._store_subscription(subscription_data)
+            subscription_id = self._store_subscription(subscription_data, plan=plan)
             
             # Phase 5: Log the creation
             self.db.log_subscription_action(
@@ -127,45 +200,46 @@ class PayPalService(BaseSubscriptionService):
             }
             
         except Exception as e:
-            logger.error(f"Error creating PayPal subscription: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error creating PayPal subscription: %s", e)
             raise
 
-    def _store_subscription(self, subscription_data):
-        """Store subscription in database"""
+    @staticmethod
+    def _slim_paypal_result(paypal_result):
+        """Keep only the PayPal create-subscription fields worth storing in gateway_metadata"""
+        paypal_response = paypal_result.get('paypal_response') or {}
+        return {
+            'subscription_id': paypal_result.get('subscription_id'),
+            'approval_url': paypal_result.get('approval_url'),
+            'status': paypal_result.get('status'),
+            'plan_id': paypal_response.get('plan_id'),
+            'create_time': paypal_response.get('create_time')
+        }
+
+    def _store_subscription(self, subscription_data, plan=None):
+        """Store subscription in database (plan: the already-fetched plan record, if any)"""
         try:
             # Get the plan record to ensure we use internal ID
-            plan = self._get_plan(subscription_data['plan_id'])
+            if plan is None:
+                plan = self._get_plan(subscription_data['plan_id'])
             if not plan:
                 raise ValueError(f"Plan {subscription_data['plan_id']} not found")
             
-            conn = self.db.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute(f"""
-                INSERT INTO {DB_TABLE_USER_SUBSCRIPTIONS}
-                (id, user_id, plan_id, paypal_subscription_id, payment_gateway, 
-                status, app_id, gateway_metadata, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())
-            """, (
-                subscription_data['id'],
-                subscription_data['user_id'],
-                plan['id'],  # ← FIXED: Use internal database plan ID
-                subscription_data['paypal_subscription_id'],
-                subscription_data['payment_gateway'],
-                subscription_data['status'],
-                subscription_data['app_id'],
-                json.dumps(subscription_data['gateway_metadata'])
-            ))
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with self.db.get_autocommit_connection() as conn:
+                self.db.execute_prepared_write(conn, SQL_INSERT_PAYPAL_SUBSCRIPTION, (
+                    subscription_data['id'],
+                    subscription_data['user_id'],
+                    plan['id'],  # ← FIXED: Use internal database plan ID
+                    subscription_data['paypal_subscription_id'],
+                    subscription_data['payment_gateway'],
+                    subscription_data['status'],
+                    subscription_data['app_id'],
+                    json_dumps(subscription_data['gateway_metadata'])
+                ))
             
             return subscription_data['id']
             
         except Exception as e:
-            logger.error(f"Error storing subscription: {str(e)}")
+            logger.error("Error storing subscription: %s", e)
             raise
 
     def activate_subscription(self, subscription_id):
@@ -186,7 +260,7 @@ class PayPalService(BaseSubscriptionService):
             )
             
             if not quota_result:
-                logger.error(f"Failed to initialize resource quota for subscription {subscription_id}")
+                logger.error("Failed to initialize resource quota for subscription %s", subscription_id)
             
             self.db.log_subscription_action(
                 subscription_id,
@@ -202,7 +276,7 @@ class PayPalService(BaseSubscriptionService):
             }
             
         except Exception as e:
-            logger.error(f"Error activating PayPal subscription: {str(e)}")
+            logger.error("Error activating PayPal subscription: %s", e)
             return {'error': True, 'message': str(e)}
 
     def cancel_pending_subscription(self, subscription_id):
@@ -220,7 +294,7 @@ class PayPalService(BaseSubscriptionService):
             return {'success': True, 'message': 'Pending subscription cancelled'}
             
         except Exception as e:
-            logger.error(f"Error cancelling pending subscription: {str(e)}")
+            logger.error("Error cancelling pending subscription: %s", e)
             return {'error': True, 'message': str(e)}
 
     # =============================================================================
@@ -234,7 +308,7 @@ class PayPalService(BaseSubscriptionService):
         Args:
             provider: Should be 'paypal'
             event_type: PayPal event type
-            event_id: Event ID for idempotency
+            event_id: Event ID for idempotency (claimed by the caller with DatabaseManager.claim_event)
             payload: Webhook payload
             
         Returns:
@@ -257,8 +331,9 @@ class PayPalService(BaseSubscriptionService):
             # Route to appropriate handler
             result = self._handle_paypal_webhook(event_type, payload)
             
-            # Mark event as processed
-            self.db.mark_event_processed(event_id, provider)
+            # The user's subscription rows may have changed status - drop their cached
+            # active ids (all of them if the payload did not identify the user)
+            invalidate_active_subscription_cache(user_id)
             
             # Log completion
             self.db.log_event(
@@ -273,8 +348,7 @@ class PayPalService(BaseSubscriptionService):
             return {'success': True, 'message': f'Processed {event_type} event', 'result': result}
             
         except Exception as e:
-            logger.error(f"Error processing PayPal webhook event: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error processing PayPal webhook event: %s", e)
             return {'success': False, 'message': str(e)}
 
     # Add these methods to your PayPalService class in paypal_service.py
@@ -282,81 +356,57 @@ class PayPalService(BaseSubscriptionService):
     def _store_approval_requirement(self, subscription_id, new_plan_id, approval_url):
         """Store approval requirement in subscription metadata"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor()
-            
             approval_metadata = {
                 'paypal_approval_required': True,
                 'approval_url': approval_url,
                 'pending_plan_id': new_plan_id,
-                'approval_created_at': datetime.now().isoformat()
+                'approval_created_at': _utcnow_iso()
             }
             
-            cursor.execute(f"""
-                UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
-                SET metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s),
-                    updated_at = NOW()
-                WHERE id = %s
-            """, (json.dumps(approval_metadata), subscription_id))
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with self.db.get_autocommit_connection() as conn:
+                self.db.execute_prepared_write(conn, SQL_STORE_APPROVAL_REQUIREMENT, (json_dumps(approval_metadata), subscription_id))
             
-            logger.info(f"Stored approval requirement for subscription {subscription_id}")
+            logger.info("Stored approval requirement for subscription %s", subscription_id)
             
         except Exception as e:
-            logger.error(f"Error storing approval requirement: {str(e)}")
+            logger.error("Error storing approval requirement: %s", e)
             raise
 
     def _complete_upgrade_locally(self, subscription_id, new_plan_id):
         """Complete upgrade in local database"""
         try:
-            subscription = self._get_subscription_details(subscription_id)
-            if not subscription:
-                raise ValueError("Subscription not found")
-            
-            self._update_subscription_plan(subscription_id, new_plan_id)
-            self.initialize_resource_quota(
-                subscription['user_id'], 
-                subscription_id, 
-                subscription['app_id']
-            )
+            # User and app come from the subscription row read inside the transaction
+            self.change_plan_and_reinit(None, subscription_id, new_plan_id, None)
             self._clear_pending_upgrade(subscription_id)
             
-            logger.info(f"Completed upgrade locally: subscription {subscription_id} to plan {new_plan_id}")
+            logger.info("Completed upgrade locally: subscription %s to plan %s", subscription_id, new_plan_id)
             
         except Exception as e:
-            logger.error(f"Error completing upgrade locally: {str(e)}")
+            logger.error("Error completing upgrade locally: %s", e)
             raise
 
     def _clear_approval_metadata(self, subscription_id):
         """Clear approval metadata after completion"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor()
+            with self.db.get_autocommit_connection() as conn:
+                self.db.execute_prepared_write(conn, SQL_CLEAR_APPROVAL_METADATA, (subscription_id,))
             
-            cursor.execute(f"""
-                UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
-                SET metadata = JSON_REMOVE(
-                    IFNULL(metadata, '{{}}'), 
-                    '$.paypal_approval_required',
-                    '$.approval_url',
-                    '$.pending_plan_id',
-                    '$.approval_created_at'
-                ),
-                updated_at = NOW()
-                WHERE id = %s
-            """, (subscription_id,))
+            logger.info("Cleared approval metadata for subscription %s", subscription_id)
             
-            conn.commit()
-            cursor.close()
-            conn.close()
+        except Exception as e:
+            logger.error("Error clearing approval metadata: %s", e)
+            raise
+
+    def _clear_all_approval_state(self, subscription_id):
+        """Clear approval metadata and the pending upgrade in one UPDATE"""
+        try:
+            with self.db.get_autocommit_connection() as conn:
+                self.db.execute_prepared_write(conn, SQL_CLEAR_ALL_APPROVAL_STATE, (subscription_id,))
             
-            logger.info(f"Cleared approval metadata for subscription {subscription_id}")
+            logger.info("Cleared approval state for subscription %s", subscription_id)
             
         except Exception as e:
-            logger.error(f"Error clearing approval metadata: {str(e)}")
+            logger.error("Error clearing approval state: %s", e)
             raise
 
     def complete_approved_upgrade(self, subscription_id):
@@ -366,15 +416,7 @@ class PayPalService(BaseSubscriptionService):
             if not subscription:
                 return {'error': True, 'message': 'Subscription not found'}
             
-            # Parse metadata safely
-            metadata = subscription.get('metadata', {})
-            if isinstance(metadata, str):
-                try:
-                    metadata = json.loads(metadata)
-                    logger.info(f"[DEBUG] Parsed metadata: {metadata}")
-                except Exception as e:
-                    logger.error(f"[DEBUG] JSON parse error: {e}")
-                    metadata = {}
+            metadata = subscription['metadata']
             
             # Handle proration-based approval completion
             if metadata.get('paypal_approval_required'):
@@ -382,7 +424,7 @@ class PayPalService(BaseSubscriptionService):
                 new_plan_id = pending_upgrade.get('new_plan_id')
                 time_factor = pending_upgrade.get('time_factor', 1.0)
                 
-                logger.info(f"[DEBUG] Pending plan ID: {new_plan_id}")
+                logger.info("[DEBUG] Pending plan ID: %s", new_plan_id)
                 
                 if not new_plan_id:
                     return {'error': True, 'message': 'No pending plan found in proration upgrade'}
@@ -391,8 +433,7 @@ class PayPalService(BaseSubscriptionService):
                 self._complete_upgrade_locally_with_time_factor(subscription_id, new_plan_id, time_factor)
                 
                 # Clear both approval metadata keys
-                self._clear_approval_metadata(subscription_id)
-                self._clear_pending_upgrade(subscription_id)
+                self._clear_all_approval_state(subscription_id)
                 
                 # Log the completion
                 self.db.log_subscription_action(
@@ -401,7 +442,7 @@ class PayPalService(BaseSubscriptionService):
                     {
                         'new_plan_id': new_plan_id,
                         'time_factor': time_factor,
-                        'completed_at': datetime.now().isoformat()
+                        'completed_at': _utcnow_iso()
                     },
                     f"user_{subscription['user_id']}"
                 )
@@ -420,29 +461,20 @@ class PayPalService(BaseSubscriptionService):
                 }
             
         except Exception as e:
-            logger.error(f"Error completing approved upgrade: {str(e)}")
+            logger.error("Error completing approved upgrade: %s", e)
             return {'error': True, 'message': str(e)}
 
     def handle_proration_completion(self, order_id):
         """Handle completion of PayPal proration payment with proportional resource allocation"""
         try:
-            capture_result = self.paypal.capture_order_payment(order_id)
-            
-            if capture_result.get('error'):
-                return {'error': True, 'message': 'Failed to capture payment'}
-            
+            # Resolve the pending upgrade before calling PayPal, so an order that
+            # cannot be applied fails without capturing the payment
             subscription = self._find_subscription_by_proration_payment(order_id)
             if not subscription:
                 return {'error': True, 'message': 'Subscription not found'}
             
             # Get pending upgrade details
-            metadata = subscription.get('metadata', {})
-            if isinstance(metadata, str):
-                try:
-                    metadata = json.loads(metadata)
-                except:
-                    metadata = {}
-                    
+            metadata = subscription['metadata']
             pending_upgrade = metadata.get('pending_paypal_upgrade', {})
             new_plan_id = pending_upgrade.get('new_plan_id')
             time_factor = pending_upgrade.get('time_factor', 1.0)  # Get stored time factor
@@ -450,10 +482,17 @@ class PayPalService(BaseSubscriptionService):
             if not new_plan_id:
                 return {'error': True, 'message': 'No pending upgrade found'}
             
+            new_paypal_plan_id = self._get_plan(new_plan_id)['paypal_plan_id']
+            
+            capture_result = self.paypal.capture_order_payment(order_id)
+            
+            if capture_result.get('error'):
+                return {'error': True, 'message': 'Failed to capture payment'}
+            
             # Update PayPal subscription
             paypal_result = self.paypal.update_subscription_plan_only(
                 subscription['paypal_subscription_id'],
-                self._get_plan(new_plan_id)['paypal_plan_id']
+                new_paypal_plan_id
             )
             
             # Check for errors
@@ -472,7 +511,7 @@ class PayPalService(BaseSubscriptionService):
                     paypal_result.get('approval_url')
                 )
                 
-                logger.info(f"PayPal approval required for subscription {subscription['id']}")
+                logger.info("PayPal approval required for subscription %s", subscription['id'])
                 
                 return {
                     'success': True,
@@ -508,32 +547,28 @@ class PayPalService(BaseSubscriptionService):
             }
             
         except Exception as e:
-            logger.error(f"Error handling PayPal proration completion: {str(e)}")
+            logger.error("Error handling PayPal proration completion: %s", e)
             return {'error': True, 'message': str(e)}
 
     def _complete_upgrade_locally_with_time_factor(self, subscription_id, new_plan_id, time_factor):
         """Complete upgrade in local database with proportional resource allocation"""
         try:
-            subscription = self._get_subscription_details(subscription_id)
-            if not subscription:
-                raise ValueError("Subscription not found")
-            
-            self._update_subscription_plan(subscription_id, new_plan_id)
-            
-            # Initialize resource quota with time factor for proportional allocation
-            self.initialize_resource_quota(
-                subscription['user_id'], 
+            # Change plan and initialize resource quota with time factor for proportional allocation;
+            # user and app come from the subscription row read inside the transaction
+            self.change_plan_and_reinit(
+                None,
                 subscription_id, 
-                subscription['app_id'],
+                new_plan_id,
+                None,
                 time_factor  # Pass time factor for proportional resources
             )
             
             self._clear_pending_upgrade(subscription_id)
             
-            logger.info(f"Completed upgrade locally: subscription {subscription_id} to plan {new_plan_id} with {time_factor:.2%} proportional resources")
+            logger.info("Completed upgrade locally: subscription %s to plan %s with %.2f%% proportional resources", subscription_id, new_plan_id, time_factor * 100)
             
         except Exception as e:
-            logger.error(f"Error completing upgrade locally: {str(e)}")
+            logger.error("Error completing upgrade locally: %s", e)
             raise
 
 
@@ -544,7 +579,7 @@ class PayPalService(BaseSubscriptionService):
             resource = payload.get('resource', {})
             payment_id = resource.get('id')
             
-            logger.info(f"Processing PAYMENT.CAPTURE.COMPLETED: {payment_id}")
+            logger.info("Processing PAYMENT.CAPTURE.COMPLETED: %s", payment_id)
             
             # Extract order ID from supplementary data
             supplementary_data = resource.get('supplementary_data', {})
@@ -552,7 +587,7 @@ class PayPalService(BaseSubscriptionService):
             order_id = related_ids.get('order_id')
             
             if not order_id:
-                logger.warning(f"No order_id found in payment capture {payment_id}")
+                logger.warning("No order_id found in payment capture %s", payment_id)
                 return {'status': 'ignored', 'reason': 'no_order_id'}
             
             # Check if this is a proration payment
@@ -560,7 +595,7 @@ class PayPalService(BaseSubscriptionService):
             
             if subscription:
                 # This is a proration payment - create invoice
-                logger.info(f"Found proration payment for subscription {subscription['id']}")
+                logger.info("Found proration payment for subscription %s", subscription['id'])
                 
                 # Create invoice for proration payment
                 invoice_id = self._create_proration_invoice(
@@ -577,7 +612,7 @@ class PayPalService(BaseSubscriptionService):
                 }
             else:
                 # This is a standalone one-time payment
-                logger.info(f"No subscription found for order {order_id} - treating as standalone payment")
+                logger.info("No subscription found for order %s - treating as standalone payment", order_id)
                 return {
                     'success': True,
                     'payment_id': payment_id,
@@ -586,27 +621,35 @@ class PayPalService(BaseSubscriptionService):
                 }
                 
         except Exception as e:
-            logger.error(f"Error handling payment capture completed: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error handling payment capture completed: %s", e)
             return {'status': 'error', 'message': str(e)}
 
     def _create_proration_invoice(self, subscription, resource, order_id):
         """Create invoice for proration payment"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor()
-            
-            invoice_id = generate_id('inv_')
             payment_id = resource.get('id')
             amount = float(resource.get('amount', {}).get('value', 0))
             currency = resource.get('amount', {}).get('currency_code', 'USD')
             
-            cursor.execute("""
-                INSERT INTO subscription_invoices
-                (id, subscription_id, user_id, paypal_payment_id, amount, currency,
-                status, payment_method, invoice_date, paid_at, app_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW(), %s)
-            """, (
+            invoice_id = self._upsert_paypal_invoice(subscription, payment_id, amount, currency, 'paypal_proration')
+            
+            logger.info("Created proration invoice %s for payment %s", invoice_id, payment_id)
+            return invoice_id
+            
+        except Exception as e:
+            logger.error("Error creating proration invoice: %s", e)
+            raise
+
+    def _upsert_paypal_invoice(self, subscription, payment_id, amount, currency, payment_method):
+        """
+        Record a paid invoice for a PayPal payment, once per payment
+        
+        Returns:
+            str: The new invoice ID, or the existing one if the payment was already invoiced
+        """
+        invoice_id = generate_id('inv_')
+        with self.db.get_autocommit_connection() as conn:
+            inserted = self.db.execute_prepared_write(conn, SQL_UPSERT_PAYPAL_INVOICE, (
                 invoice_id,
                 subscription['id'],
                 subscription['user_id'],
@@ -614,40 +657,25 @@ class PayPalService(BaseSubscriptionService):
                 amount,
                 currency,
                 'paid',
-                'paypal_proration',
+                payment_method,
                 subscription['app_id']
-            ))
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            )) == 1
             
-            logger.info(f"Created proration invoice {invoice_id} for payment {payment_id}")
-            return invoice_id
-            
-        except Exception as e:
-            logger.error(f"Error creating proration invoice: {str(e)}")
-            raise
+            if not inserted:
+                rows = self.db.execute_prepared(conn, SQL_GET_INVOICE_BY_PAYPAL_PAYMENT, (payment_id,))
+                if rows:
+                    invoice_id = rows[0][0]
+                    logger.info("PayPal payment %s already invoiced as %s", payment_id, invoice_id)
+        
+        return invoice_id
 
     # Update the existing _handle_paypal_webhook method
     def _handle_paypal_webhook(self, event_type, payload):
-        """Route PayPal webhook events to appropriate handlers"""
-        if event_type == 'BILLING.SUBSCRIPTION.CREATED':
-            return self._handle_subscription_created(payload)
-        elif event_type == 'BILLING.SUBSCRIPTION.ACTIVATED':
-            return self._handle_subscription_activated(payload)
-        elif event_type == 'PAYMENT.SALE.COMPLETED':
-            return self._handle_payment_sale_completed(payload)
-        elif event_type == 'PAYMENT.CAPTURE.COMPLETED':  # ✅ ADD THIS LINE
-            return self._handle_payment_capture_completed(payload)
-        elif event_type == 'BILLING.SUBSCRIPTION.PAYMENT.FAILED':
-            return self._handle_subscription_payment_failed(payload)
-        elif event_type == 'BILLING.SUBSCRIPTION.CANCELLED':
-            return self._handle_subscription_cancelled(payload)
-        elif event_type == 'BILLING.SUBSCRIPTION.SUSPENDED':
-            return self._handle_subscription_suspended(payload)
-        else:
+        """Route PayPal webhook events to appropriate handlers (see PAYPAL_WEBHOOK_HANDLERS)"""
+        handler_name = PAYPAL_WEBHOOK_HANDLERS.get(event_type)
+        if handler_name is None:
             return {'status': 'ignored', 'message': f'Unhandled event type: {event_type}'}
+        return getattr(self, handler_name)(payload)
 
     def _handle_subscription_created(self, payload):
         """Handle BILLING.SUBSCRIPTION.CREATED - mirror Razorpay authenticated"""
@@ -662,7 +690,7 @@ class PayPalService(BaseSubscriptionService):
             subscription = self._get_subscription_by_paypal_id(paypal_subscription_id)
             
             if not subscription:
-                logger.error(f"Subscription not found for PayPal ID: {paypal_subscription_id}")
+                logger.error("Subscription not found for PayPal ID: %s", paypal_subscription_id)
                 return {'status': 'error', 'message': 'Subscription not found'}
             
             # Update subscription status to created (authenticated equivalent)
@@ -672,12 +700,11 @@ class PayPalService(BaseSubscriptionService):
                 resource
             )
             
-            logger.info(f"PayPal subscription created: {paypal_subscription_id}")
+            logger.info("PayPal subscription created: %s", paypal_subscription_id)
             return {'status': 'success', 'message': 'Subscription marked as created'}
             
         except Exception as e:
-            logger.error(f"Error handling subscription created: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error handling subscription created: %s", e)
             return {'status': 'error', 'message': str(e)}
 
     def _handle_subscription_activated(self, payload):
@@ -693,29 +720,17 @@ class PayPalService(BaseSubscriptionService):
             subscription = self._get_subscription_by_paypal_id(paypal_subscription_id)
             
             if not subscription:
-                logger.error(f"Subscription not found for PayPal ID: {paypal_subscription_id}")
+                logger.error("Subscription not found for PayPal ID: %s", paypal_subscription_id)
                 return {'status': 'error', 'message': 'Subscription not found'}
             
             # Calculate subscription period
             start_date, period_end = self._calculate_subscription_period_from_resource(resource, subscription['plan_id'])
             
-            # Update subscription status and periods
-            self._activate_subscription_with_period(paypal_subscription_id, start_date, period_end, resource)
-            
-            # Initialize resource quota
-            quota_result = self.initialize_resource_quota(
-                subscription['user_id'], 
-                subscription['id'], 
-                subscription['app_id']
-            )
-            
-            if not quota_result:
-                logger.error(f"Failed to initialize resource quota for subscription {subscription['id']}")
-            
-            # Set metadata flag for first payment detection
-            self._set_first_payment_flag(subscription['id'], False)
+            # Activate with periods, initialize resource quota and reset the
+            # first payment flag together
+            self._activate_subscription_with_quota(subscription, start_date, period_end, resource)
             
-            logger.info(f"PayPal subscription activated: {paypal_subscription_id}")
+            logger.info("PayPal subscription activated: %s", paypal_subscription_id)
             return {
                 'status': 'success', 
                 'message': 'Subscription activated with resources (no invoice yet)',
@@ -724,9 +739,10 @@ class PayPalService(BaseSubscriptionService):
             }
             
         except Exception as e:
-            logger.error(f"Error handling subscription activated: {str(e)}")
-            logger.error(traceback.format_exc())
-            return {'status': 'error', 'message': str(e)}
+            # Nothing was committed: fail the event so its claim is released and
+            # PayPal's redelivery activates the subscription
+            logger.exception("Error handling subscription activated: %s", e)
+            raise
 
     def _handle_simple_upgrade_completion_payment(self, subscription, resource):
         """Handle first payment after simple upgrade - initialize full resources"""
@@ -735,7 +751,7 @@ class PayPalService(BaseSubscriptionService):
             amount = float(resource.get('amount', {}).get('total', 0))
             currency = resource.get('amount', {}).get('currency', 'USD')
             
-            logger.info(f"Processing simple upgrade completion payment: {payment_id} for subscription {subscription['id']}")
+            logger.info("Processing simple upgrade completion payment: %s for subscription %s", payment_id, subscription['id'])
             
             # Create invoice for simple upgrade completion
             invoice_id = self._create_subscription_invoice(
@@ -752,7 +768,7 @@ class PayPalService(BaseSubscriptionService):
             # Clear simple upgrade metadata
             self._clear_simple_upgrade_metadata(subscription['id'])
             
-            logger.info(f"Simple upgrade completed: subscription {subscription['id']} now has full resources for new plan")
+            logger.info("Simple upgrade completed: subscription %s now has full resources for new plan", subscription['id'])
             
             return {
                 'success': True,
@@ -764,7 +780,7 @@ class PayPalService(BaseSubscriptionService):
             }
             
         except Exception as e:
-            logger.error(f"Error handling simple upgrade completion payment: {str(e)}")
+            logger.error("Error handling simple upgrade completion payment: %s", e)
             raise
 
     def _handle_payment_sale_completed(self, payload):
@@ -773,7 +789,7 @@ class PayPalService(BaseSubscriptionService):
             resource = payload.get('resource', {})
             payment_id = resource.get('id')
             
-            logger.info(f"Processing PAYMENT.SALE.COMPLETED: {payment_id}")
+            logger.info("Processing PAYMENT.SALE.COMPLETED: %s", payment_id)
             
             # Detect payment context
             context = self._detect_payment_context(resource)
@@ -794,12 +810,11 @@ class PayPalService(BaseSubscriptionService):
                 return self._handle_one_time_payment(resource)
                 
             else:
-                logger.warning(f"Unknown payment context: {context}")
+                logger.warning("Unknown payment context: %s", context)
                 return {'status': 'ignored', 'reason': 'unknown_payment_context'}
             
         except Exception as e:
-            logger.error(f"Error handling payment sale completed: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error handling payment sale completed: %s", e)
             return {'status': 'error', 'message': str(e)}
     
     def _detect_payment_context(self, resource):
@@ -873,7 +888,7 @@ class PayPalService(BaseSubscriptionService):
             # Mark first payment as completed
             self._set_first_payment_flag(subscription['id'], True)
             
-            logger.info(f"Created invoice {invoice_id} for fresh subscription payment {payment_id}")
+            logger.info("Created invoice %s for fresh subscription payment %s", invoice_id, payment_id)
             
             return {
                 'success': True,
@@ -884,7 +899,7 @@ class PayPalService(BaseSubscriptionService):
             }
             
         except Exception as e:
-            logger.error(f"Error handling fresh subscription payment: {str(e)}")
+            logger.error("Error handling fresh subscription payment: %s", e)
             raise
 
     def _handle_renewal_payment(self, subscription, resource):
@@ -908,7 +923,7 @@ class PayPalService(BaseSubscriptionService):
             # Update subscription billing period
             self._update_subscription_billing_period(subscription)
             
-            logger.info(f"Processed renewal payment {payment_id} for subscription {subscription['id']}")
+            logger.info("Processed renewal payment %s for subscription %s", payment_id, subscription['id'])
             
             return {
                 'success': True,
@@ -919,7 +934,7 @@ class PayPalService(BaseSubscriptionService):
             }
             
         except Exception as e:
-            logger.error(f"Error handling renewal payment: {str(e)}")
+            logger.error("Error handling renewal payment: %s", e)
             raise
 
     def _handle_upgrade_completion_payment(self, subscription, resource):
@@ -940,7 +955,7 @@ class PayPalService(BaseSubscriptionService):
             time_factor = pending_upgrade.get('time_factor', 1.0)  # Get stored time factor
             
             if not new_plan_id:
-                logger.error(f"No pending upgrade found for subscription {subscription['id']}")
+                logger.error("No pending upgrade found for subscription %s", subscription['id'])
                 return {'status': 'error', 'message': 'No pending upgrade found'}
             
             # Create invoice for upgrade payment
@@ -948,13 +963,11 @@ class PayPalService(BaseSubscriptionService):
                 subscription, resource, 'upgrade'
             )
             
-            # Update subscription plan
-            self._update_subscription_plan(subscription['id'], new_plan_id)
-            
-            # Initialize quota with time factor for proportional allocation
-            self.initialize_resource_quota(
+            # Update subscription plan and initialize quota with time factor for proportional allocation
+            self.change_plan_and_reinit(
                 subscription['user_id'], 
                 subscription['id'], 
+                new_plan_id,
                 subscription['app_id'],
                 time_factor  # Use stored time factor instead of default 1.0
             )
@@ -962,7 +975,7 @@ class PayPalService(BaseSubscriptionService):
             # Clear pending upgrade metadata
             self._clear_pending_upgrade(subscription['id'])
             
-            logger.info(f"Completed upgrade payment {payment_id} for subscription {subscription['id']} with time factor {time_factor}")
+            logger.info("Completed upgrade payment %s for subscription %s with time factor %s", payment_id, subscription['id'], time_factor)
             
             return {
                 'success': True,
@@ -975,14 +988,14 @@ class PayPalService(BaseSubscriptionService):
             }
             
         except Exception as e:
-            logger.error(f"Error handling upgrade completion payment: {str(e)}")
+            logger.error("Error handling upgrade completion payment: %s", e)
             raise
 
     def _handle_one_time_payment(self, resource):
         """Handle one-time payment (addon, proration, etc.)"""
         try:
             payment_id = resource.get('id')
-            logger.info(f"Processed one-time payment: {payment_id}")
+            logger.info("Processed one-time payment: %s", payment_id)
             
             return {
                 'success': True,
@@ -991,7 +1004,7 @@ class PayPalService(BaseSubscriptionService):
             }
             
         except Exception as e:
-            logger.error(f"Error handling one-time payment: {str(e)}")
+            logger.error("Error handling one-time payment: %s", e)
             raise
 
     def _handle_subscription_payment_failed(self, payload):
@@ -1007,7 +1020,7 @@ class PayPalService(BaseSubscriptionService):
             subscription = self._get_subscription_by_paypal_id(paypal_subscription_id)
             
             if not subscription:
-                logger.error(f"Subscription not found for PayPal ID: {paypal_subscription_id}")
+                logger.error("Subscription not found for PayPal ID: %s", paypal_subscription_id)
                 return {'status': 'error', 'message': 'Subscription not found'}
             
             # Update subscription status
@@ -1025,12 +1038,11 @@ class PayPalService(BaseSubscriptionService):
                 'paypal_webhook'
             )
             
-            logger.info(f"PayPal subscription payment failed: {paypal_subscription_id}")
+            logger.info("PayPal subscription payment failed: %s", paypal_subscription_id)
             return {'status': 'success', 'message': 'Payment failure processed'}
             
         except Exception as e:
-            logger.error(f"Error handling subscription payment failed: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error handling subscription payment failed: %s", e)
             return {'status': 'error', 'message': str(e)}
 
     def _handle_subscription_cancelled(self, payload):
@@ -1053,9 +1065,9 @@ class PayPalService(BaseSubscriptionService):
                     SET metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s),
                         updated_at = NOW()
                     WHERE paypal_subscription_id = %s
-                """, (json.dumps({
+                """, (json_dumps({
                     'paypal_cancellation_confirmed': True,
-                    'paypal_cancelled_at': datetime.now().isoformat(),
+                    'paypal_cancelled_at': _utcnow_iso(),
                     'webhook_received': True
                 }), paypal_subscription_id))
                 
@@ -1071,12 +1083,12 @@ class PayPalService(BaseSubscriptionService):
                     'paypal_webhook'
                 )
                 
-                logger.info(f"PayPal cancellation confirmed (webhook): {paypal_subscription_id} - status remains active until period end")
+                logger.info("PayPal cancellation confirmed (webhook): %s - status remains active until period end", paypal_subscription_id)
             
             return {'status': 'success', 'message': 'Cancellation confirmed, access continues until period end'}
             
         except Exception as e:
-            logger.error(f"Error handling subscription cancelled: {str(e)}")
+            logger.error("Error handling subscription cancelled: %s", e)
             return {'status': 'error', 'message': str(e)}
 
     def _handle_subscription_suspended(self, payload):
@@ -1101,7 +1113,7 @@ class PayPalService(BaseSubscriptionService):
             return {'status': 'success', 'message': 'Suspension processed'}
             
         except Exception as e:
-            logger.error(f"Error handling subscription suspended: {str(e)}")
+            logger.error("Error handling subscription suspended: %s", e)
             return {'status': 'error', 'message': str(e)}
 
     # =============================================================================
@@ -1110,7 +1122,7 @@ class PayPalService(BaseSubscriptionService):
 
     def handle_upgrade(self, user_id, subscription_id, new_plan_id, app_id, billing_cycle_info, resource_info):
         """Handle PayPal subscription upgrade"""
-        logger.info(f"[PAYPAL UPGRADE] Started: user={user_id}, sub={subscription_id}, plan={new_plan_id}")
+        logger.info("[PAYPAL UPGRADE] Started: user=%s, sub=%s, plan=%s", user_id, subscription_id, new_plan_id)
         
         try:
             # Get subscription and plans
@@ -1152,7 +1164,7 @@ class PayPalService(BaseSubscriptionService):
                 )
 
         except Exception as e:
-            logger.error(f"[PAYPAL UPGRADE] Error: {str(e)}")
+            logger.error("[PAYPAL UPGRADE] Error: %s", e)
             raise
 
     def _handle_simple_upgrade(self, subscription, new_plan, app_id):
@@ -1161,7 +1173,7 @@ class PayPalService(BaseSubscriptionService):
             paypal_subscription_id = subscription['paypal_subscription_id']
             new_paypal_plan_id = new_plan['paypal_plan_id']
             
-            logger.info(f"[SIMPLE UPGRADE] Starting upgrade for {paypal_subscription_id} to plan {new_paypal_plan_id}")
+            logger.info("[SIMPLE UPGRADE] Starting upgrade for %s to plan %s", paypal_subscription_id, new_paypal_plan_id)
             
             # Update PayPal subscription plan
             result = self.paypal.update_subscription_plan_only(
@@ -1170,11 +1182,11 @@ class PayPalService(BaseSubscriptionService):
             )
             
             if result.get('error'):
-                logger.error(f"PayPal upgrade failed: {result['message']}")
+                logger.error("PayPal upgrade failed: %s", result['message'])
                 raise ValueError(f"PayPal upgrade failed: {result['message']}")
             
             if result.get('requires_approval'):
-                logger.info(f"[SIMPLE UPGRADE] Approval required - setting pending metadata")
+                logger.info("[SIMPLE UPGRADE] Approval required - setting pending metadata")
                 
                 # Set simple upgrade pending metadata
                 self._update_subscription_plan_and_metadata(
@@ -1183,7 +1195,7 @@ class PayPalService(BaseSubscriptionService):
                     upgrade_metadata={
                         'simple_upgrade_pending': True,
                         'upgraded_to_plan': new_plan['id'],
-                        'upgrade_timestamp': datetime.now().isoformat(),
+                        'upgrade_timestamp': _utcnow_iso(),
                         'upgrade_type': 'paypal_simple_with_approval',
                         'temporary_resources_added': True
                     }
@@ -1203,7 +1215,7 @@ class PayPalService(BaseSubscriptionService):
                     'temporary_resources_added': True
                 }
             else:
-                logger.info(f"[SIMPLE UPGRADE] No approval required - completing immediately")
+                logger.info("[SIMPLE UPGRADE] No approval required - completing immediately")
                 
                 # Set simple upgrade pending metadata (will be cleared by webhook)
                 self._update_subscription_plan_and_metadata(
@@ -1212,7 +1224,7 @@ class PayPalService(BaseSubscriptionService):
                     upgrade_metadata={
                         'simple_upgrade_pending': True,
                         'upgraded_to_plan': new_plan['id'],
-                        'upgrade_timestamp': datetime.now().isoformat(),
+                        'upgrade_timestamp': _utcnow_iso(),
                         'upgrade_type': 'paypal_simple_immediate',
                         'temporary_resources_added': True
                     }
@@ -1232,7 +1244,7 @@ class PayPalService(BaseSubscriptionService):
                 }
             
         except Exception as e:
-            logger.error(f"Error in simple PayPal upgrade: {str(e)}")
+            logger.error("Error in simple PayPal upgrade: %s", e)
             raise
 
 
@@ -1243,8 +1255,8 @@ class PayPalService(BaseSubscriptionService):
             remaining_values = self._calculate_value_remaining_percentage(billing_cycle_info, resource_info)
             
             # Calculate remaining values using separate percentages
-            current_plan_remaining_value = round(remaining_values['current_plan_remaining'] * self._ensure_float(current_plan['amount']), 2)
-            new_plan_remaining_value = round(remaining_values['time_remaining'] * self._ensure_float(new_plan['amount']), 2)
+            current_plan_remaining_value = round(remaining_values['current_plan_remaining'] * (current_plan['amount'] or 0.0), 2)
+            new_plan_remaining_value = round(remaining_values['time_remaining'] * (new_plan['amount'] or 0.0), 2)
             
             # Calculate the difference (what user actually needs to pay)
             proration_difference = new_plan_remaining_value - current_plan_remaining_value
@@ -1302,7 +1314,7 @@ class PayPalService(BaseSubscriptionService):
             }
             
         except Exception as e:
-            logger.error(f"Error in annual PayPal upgrade: {str(e)}")
+            logger.error("Error in annual PayPal upgrade: %s", e)
             raise
 
     # =============================================================================
@@ -1321,10 +1333,10 @@ class PayPalService(BaseSubscriptionService):
             result = self.paypal.cancel_subscription(paypal_subscription_id)
             
             if result.get('error'):
-                logger.error(f"PayPal cancellation failed: {result['message']}")
+                logger.error("PayPal cancellation failed: %s", result['message'])
                 raise ValueError(f"PayPal cancellation failed: {result['message']}")
             
-            logger.info(f"PayPal subscription cancelled: {paypal_subscription_id}")
+            logger.info("PayPal subscription cancelled: %s", paypal_subscription_id)
             
             # Mark as cancelled in database but keep active until period end
             cancellation_result = self._mark_subscription_cancelled(subscription['id'], subscription)
@@ -1344,8 +1356,7 @@ class PayPalService(BaseSubscriptionService):
             return cancellation_result
             
         except Exception as e:
-            logger.error(f"Error cancelling PayPal subscription: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error cancelling PayPal subscription: %s", e)
             raise
 
     def _mark_subscription_cancelled(self, subscription_id, subscription):
@@ -1354,14 +1365,14 @@ class PayPalService(BaseSubscriptionService):
             conn = self.db.get_connection()
             cursor = conn.cursor(dictionary=True)
             
-            current_time_str = datetime.now().isoformat()
+            current_time_str = _utcnow_iso()
             
             cursor.execute(f"""
                 UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
                 SET metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s), 
                     updated_at = NOW()
                 WHERE id = %s
-            """, (json.dumps({
+            """, (json_dumps({
                 'paypal_cancelled': True,
                 'cancelled_at': current_time_str,
                 'cancellation_type': 'immediate_with_access'
@@ -1381,7 +1392,7 @@ class PayPalService(BaseSubscriptionService):
             }
             
         except Exception as e:
-            logger.error(f"Error marking PayPal subscription cancelled: {str(e)}")
+            logger.error("Error marking PayPal subscription cancelled: %s", e)
             raise
 
 
@@ -1435,31 +1446,9 @@ class PayPalService(BaseSubscriptionService):
             return subscription
             
         except Exception as e:
-            logger.error(f"Error getting subscription by PayPal ID: {str(e)}")
+            logger.error("Error getting subscription by PayPal ID: %s", e)
             return None
 
-    def _get_free_plan(self, app_id):
-        """Get free plan with isolated connection"""
-        try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                SELECT * FROM {DB_TABLE_SUBSCRIPTION_PLANS}
-                WHERE app_id = %s AND amount = 0 AND is_active = TRUE
-                LIMIT 1
-            """, (app_id,))
-            
-            free_plan = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
-            return free_plan
-            
-        except Exception as e:
-            logger.error(f"Error getting free plan: {str(e)}")
-            raise
-
     def _update_subscription_status_by_id(self, subscription_id, status):
         """Update subscription status by ID"""
         try:
@@ -1477,7 +1466,7 @@ class PayPalService(BaseSubscriptionService):
             conn.close()
             
         except Exception as e:
-            logger.error(f"Error updating subscription status: {str(e)}")
+            logger.error("Error updating subscription status: %s", e)
 
     def _update_subscription_status_by_paypal_id(self, paypal_subscription_id, status, data):
         """Update subscription status by PayPal ID"""
@@ -1491,14 +1480,14 @@ class PayPalService(BaseSubscriptionService):
                     updated_at = NOW(),
                     metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s)
                 WHERE paypal_subscription_id = %s
-            """, (status, json.dumps(data), paypal_subscription_id))
+            """, (status, json_dumps(data), paypal_subscription_id))
             
             conn.commit()
             cursor.close()
             conn.close()
             
         except Exception as e:
-            logger.error(f"Error updating subscription status by PayPal ID: {str(e)}")
+            logger.error("Error updating subscription status by PayPal ID: %s", e)
             raise
 
     def _update_subscription_billing_period(self, subscription):
@@ -1507,7 +1496,7 @@ class PayPalService(BaseSubscriptionService):
             # Get plan details for proper interval calculation
             plan = self._get_plan(subscription['plan_id'])
             if not plan:
-                logger.error(f"Plan not found for subscription {subscription['id']}")
+                logger.error("Plan not found for subscription %s", subscription['id'])
                 return
             
             interval = plan.get('interval', 'month')
@@ -1521,7 +1510,7 @@ class PayPalService(BaseSubscriptionService):
             else:
                 # Fallback to monthly
                 sql_interval = "INTERVAL 1 MONTH"
-                logger.warning(f"Unknown interval '{interval}' for subscription {subscription['id']}, defaulting to monthly")
+                logger.warning("Unknown interval '%s' for subscription %s, defaulting to monthly", interval, subscription['id'])
             
             conn = self.db.get_connection()
             cursor = conn.cursor()
@@ -1538,10 +1527,10 @@ class PayPalService(BaseSubscriptionService):
             cursor.close()
             conn.close()
             
-            logger.info(f"Updated billing period for renewal with {sql_interval}")
+            logger.info("Updated billing period for renewal with %s", sql_interval)
             
         except Exception as e:
-            logger.error(f"Error updating subscription billing period: {str(e)}")
+            logger.error("Error updating subscription billing period: %s", e)
 
     def _set_first_payment_flag(self, subscription_id, completed):
         """Set first payment completed flag in metadata"""
@@ -1554,9 +1543,9 @@ class PayPalService(BaseSubscriptionService):
                 SET metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s),
                     updated_at = NOW()
                 WHERE id = %s
-            """, (json.dumps({
+            """, (json_dumps({
                 'first_payment_completed': completed,
-                'first_payment_date': datetime.now().isoformat() if completed else None
+                'first_payment_date': _utcnow_iso() if completed else None
             }), subscription_id))
             
             conn.commit()
@@ -1564,15 +1553,11 @@ class PayPalService(BaseSubscriptionService):
             conn.close()
             
         except Exception as e:
-            logger.error(f"Error setting first payment flag: {str(e)}")
+            logger.error("Error setting first payment flag: %s", e)
 
     def _create_subscription_invoice(self, subscription, resource, payment_type):
         """Create invoice for subscription payment"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor()
-            
-            invoice_id = generate_id('inv_')
             payment_id = resource.get('id')
             amount = float(resource.get('amount', {}).get('total', 0))
             currency = resource.get('amount', {}).get('currency', 'USD')
@@ -1585,32 +1570,13 @@ class PayPalService(BaseSubscriptionService):
                 'simple_upgrade_completion': 'paypal_simple_upgrade'
             }.get(payment_type, 'paypal')
             
-            cursor.execute("""
-                INSERT INTO subscription_invoices
-                (id, subscription_id, user_id, paypal_payment_id, amount, currency,
-                status, payment_method, invoice_date, paid_at, app_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW(), %s)
-            """, (
-                invoice_id,
-                subscription['id'],
-                subscription['user_id'],
-                payment_id,
-                amount,
-                currency,
-                'paid',
-                payment_method_description,
-                subscription['app_id']
-            ))
+            invoice_id = self._upsert_paypal_invoice(subscription, payment_id, amount, currency, payment_method_description)
             
-            conn.commit()
-            cursor.close()
-            conn.close()
-            
-            logger.info(f"Created invoice {invoice_id} for {payment_type} payment {payment_id}")
+            logger.info("Created invoice %s for %s payment %s", invoice_id, payment_type, payment_id)
             return invoice_id
             
         except Exception as e:
-            logger.error(f"Error creating subscription invoice: {str(e)}")
+            logger.error("Error creating subscription invoice: %s", e)
             raise
 
     def _calculate_subscription_period_from_resource(self, resource, plan_id):
@@ -1623,7 +1589,7 @@ class PayPalService(BaseSubscriptionService):
             try:
                 start_date = datetime.fromisoformat(start_time.replace('Z', '+00:00'))
             except (ValueError, TypeError):
-                logger.error(f"Invalid start_time value: {start_time}")
+                logger.error("Invalid start_time value: %s", start_time)
                 # Continue with current date as fallback
         
         # Get plan details for interval
@@ -1642,50 +1608,35 @@ class PayPalService(BaseSubscriptionService):
         
         return start_date, period_end
 
-    def _get_plan_interval_details(self, plan_id):
-        """Get plan interval details with isolated connection"""
+    def _activate_subscription_with_quota(self, subscription, start_date, period_end, resource):
+        """Activate a subscription, initialize its quota and clear the first payment flag in one transaction"""
+        # first_payment_date: None removes the key, as _set_first_payment_flag(..., False) does
+        metadata_patch = dict(resource, first_payment_completed=False, first_payment_date=None)
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                SELECT `interval`, interval_count
-                FROM {DB_TABLE_SUBSCRIPTION_PLANS}
-                WHERE id = %s
-            """, (plan_id,))
-            
-            plan_details = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
-            return plan_details
-            
-        except Exception as e:
-            logger.error(f"Error getting plan interval details: {str(e)}")
-            return None
-
-    def _activate_subscription_with_period(self, paypal_subscription_id, start_date, period_end, resource):
-        """Activate subscription with period dates"""
-        try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            cursor.execute(f"""
-                UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
-                SET status = 'active', 
-                    current_period_start = %s,
-                    current_period_end = %s,
-                    updated_at = NOW(),
-                    metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s)
-                WHERE paypal_subscription_id = %s
-            """, (start_date, period_end, json.dumps(resource), paypal_subscription_id))
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with self.db.get_connection() as conn, conn.cursor(dictionary=True) as cursor:
+                try:
+                    cursor.execute(f"""
+                        UPDATE {DB_TABLE_USER_SUBSCRIPTIONS}
+                        SET status = 'active', 
+                            current_period_start = %s,
+                            current_period_end = %s,
+                            updated_at = NOW(),
+                            metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s)
+                        WHERE paypal_subscription_id = %s
+                    """, (start_date, period_end, json_dumps(metadata_patch), subscription['paypal_subscription_id']))
+                    
+                    self._reset_quota_in_transaction(
+                        cursor, subscription['user_id'], subscription['id'], subscription['app_id']
+                    )
+                    
+                    conn.commit()
+                    
+                except Exception:
+                    conn.rollback()
+                    raise
             
         except Exception as e:
-            logger.error(f"Error activating subscription with period: {str(e)}")
+            logger.error("Error activating subscription with quota: %s", e)
             raise
 
     def _create_one_time_payment(self, amount, subscription, description):
@@ -1708,7 +1659,7 @@ class PayPalService(BaseSubscriptionService):
             return result
             
         except Exception as e:
-            logger.error(f"Error creating PayPal one-time payment: {str(e)}")
+            logger.error("Error creating PayPal one-time payment: %s", e)
             return {'error': True, 'message': str(e)}
 
     def _store_pending_upgrade(self, subscription_id, new_plan_id, order_id, time_factor=1.0):
@@ -1722,12 +1673,12 @@ class PayPalService(BaseSubscriptionService):
                 SET metadata = JSON_MERGE_PATCH(IFNULL(metadata, '{{}}'), %s),
                     updated_at = NOW()
                 WHERE id = %s
-            """, (json.dumps({
+            """, (json_dumps({
                 'pending_paypal_upgrade': {
                     'new_plan_id': new_plan_id,
                     'order_id': order_id,
                     'time_factor': time_factor,  # Store for proportional resource allocation
-                    'created_at': datetime.now().isoformat()
+                    'created_at': _utcnow_iso()
                 }
             }), subscription_id))
             
@@ -1736,7 +1687,7 @@ class PayPalService(BaseSubscriptionService):
             conn.close()
             
         except Exception as e:
-            logger.error(f"Error storing pending upgrade: {str(e)}")
+            logger.error("Error storing pending upgrade: %s", e)
 
 
     def _find_subscription_by_proration_payment(self, order_id):
@@ -1754,10 +1705,12 @@ class PayPalService(BaseSubscriptionService):
             cursor.close()
             conn.close()
             
+            if subscription:
+                subscription['metadata'] = parse_json_field(subscription.get('metadata'))
             return subscription
             
         except Exception as e:
-            logger.error(f"Error finding subscription by proration payment: {str(e)}")
+            logger.error("Error finding subscription by proration payment: %s", e)
             return None
 
     def _clear_pending_upgrade(self, subscription_id):
@@ -1778,7 +1731,7 @@ class PayPalService(BaseSubscriptionService):
            conn.close()
            
        except Exception as e:
-           logger.error(f"Error clearing pending upgrade: {str(e)}")
+           logger.error("Error clearing pending upgrade: %s", e)
 
 
 # Create PayPal service instance
@@ -5,14 +5,15 @@ Enhanced with full API integration
 import logging
 import json
 import traceback
-import requests
 import base64
+import hashlib
+import threading
 from datetime import datetime, timedelta
 from ..config import (
     PAYPAL_CLIENT_ID, PAYPAL_CLIENT_SECRET, PAYPAL_BASE_URL,
     get_paypal_return_url, get_paypal_cancel_url, FLASK_ENV, get_webhook_base_url 
 )
-from ..utils.helpers import generate_id
+from ..utils.helpers import generate_id, load_gateway_metadata, get_http_session
 
 logger = logging.getLogger('payment_gateway')
 
@@ -22,15 +23,17 @@ class PayPalProvider:
     Enhanced with full REST API integration
     """
     
-    def __init__(self):
-        """Initialize the PayPal client"""
+    def __init__(self, session=None):
+        """Initialize the PayPal client, using the shared PayPal HTTP session unless one is given"""
         self.client = None
+        self.session = session or get_http_session('paypal')
         self.client_id = PAYPAL_CLIENT_ID
         self.client_secret = PAYPAL_CLIENT_SECRET
         self.base_url = PAYPAL_BASE_URL
         self.is_sandbox = (FLASK_ENV == 'development')
         self.access_token = None
         self.token_expires_at = None
+        self._token_lock = threading.Lock()
         self.initialized = False
         self.init_client()
     
@@ -41,9 +44,12 @@ class PayPalProvider:
                 logger.warning("PayPal credentials not found. PayPal integration will not work.")
                 return False
             
-            # Test the connection by getting an access token
-            test_token = self._get_access_token()
-            if test_token:
+            # Credentials are verified with an access token request; the result is
+            # cached on disk so boots don't block on PayPal once it has succeeded
+            environment = 'sandbox' if self.is_sandbox else 'live'
+            client_key = hashlib.sha256(self.client_id.encode()).hexdigest()[:12]
+            metadata = load_gateway_metadata(f"paypal_{environment}_{client_key}", self._fetch_client_metadata)
+            if metadata:
                 self.initialized = True
                 logger.info(f"PayPal client initialized for {FLASK_ENV} environment")
                 logger.info(f"Using {'sandbox' if self.is_sandbox else 'live'} PayPal API")
@@ -57,43 +63,62 @@ class PayPalProvider:
             logger.error(traceback.format_exc())
             return False
     
+    def _fetch_client_metadata(self):
+        """Verify credentials against PayPal and return the metadata to cache"""
+        if not self._get_access_token():
+            return None
+        
+        return {
+            'environment': 'sandbox' if self.is_sandbox else 'live',
+            'verified_at': datetime.now().isoformat()
+        }
+    
+    def _has_valid_token(self):
+        """Whether the cached access token is good for at least five more minutes"""
+        return (self.access_token and self.token_expires_at and 
+                datetime.now() < self.token_expires_at - timedelta(minutes=5))
+    
     def _get_access_token(self):
         """Get or refresh PayPal access token"""
         try:
             # Check if current token is still valid
-            if (self.access_token and self.token_expires_at and 
-                datetime.now() < self.token_expires_at - timedelta(minutes=5)):
+            if self._has_valid_token():
                 return self.access_token
             
-            # Request new token
-            auth = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
-            
-            headers = {
-                "Accept": "application/json",
-                "Accept-Language": "en_US",
-                "Authorization": f"Basic {auth}"
-            }
-            
-            data = "grant_type=client_credentials"
-            
-            response = requests.post(
-                f"{self.base_url}/v1/oauth2/token",
-                headers=headers,
-                data=data,
-                timeout=60
-            )
-            
-            if response.status_code == 200:
-                token_data = response.json()
-                self.access_token = token_data['access_token']
-                expires_in = token_data.get('expires_in', 3600)
-                self.token_expires_at = datetime.now() + timedelta(seconds=expires_in)
+            # Concurrent requests wait for a single refresh instead of each fetching a token
+            with self._token_lock:
+                if self._has_valid_token():
+                    return self.access_token
                 
-                logger.info("PayPal access token obtained successfully")
-                return self.access_token
-            else:
-                logger.error(f"Failed to get PayPal access token: {response.status_code} {response.text}")
-                return None
+                # Request new token
+                auth = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
+                
+                headers = {
+                    "Accept": "application/json",
+                    "Accept-Language": "en_US",
+                    "Authorization": f"Basic {auth}"
+                }
+                
+                data = "grant_type=client_credentials"
+                
+                response = self.session.post(
+                    f"{self.base_url}/v1/oauth2/token",
+                    headers=headers,
+                    data=data,
+                    timeout=60
+                )
+                
+                if response.status_code == 200:
+                    token_data = response.json()
+                    expires_in = token_data.get('expires_in', 3600)
+                    self.token_expires_at = datetime.now() + timedelta(seconds=expires_in)
+                    self.access_token = token_data['access_token']
+                    
+                    logger.info("PayPal access token obtained successfully")
+                    return self.access_token
+                else:
+                    logger.error(f"Failed to get PayPal access token: {response.status_code} {response.text}")
+                    return None
                 
         except Exception as e:
             logger.error(f"Error getting PayPal access token: {str(e)}")
@@ -115,11 +140,11 @@ class PayPalProvider:
             url = f"{self.base_url}{endpoint}"
             
             if method == "GET":
-                response = requests.get(url, headers=headers, timeout=60)
+                response = self.session.get(url, headers=headers, timeout=60)
             elif method == "POST":
-                response = requests.post(url, headers=headers, data=json.dumps(data) if data else None, timeout=60)
+                response = self.session.post(url, headers=headers, data=json.dumps(data) if data else None, timeout=60)
             elif method == "PATCH":
-                response = requests.patch(url, headers=headers, data=json.dumps(data) if data else None, timeout=60)
+                response = self.session.patch(url, headers=headers, data=json.dumps(data) if data else None, timeout=60)
             else:
                 return {'error': True, 'message': f'Unsupported method: {method}'}
             
@@ -447,7 +472,6 @@ class PayPalProvider:
         except Exception as e:
             logger.error(f"❌ ERROR in approval URL extraction: {str(e)}")
             logger.error(f"Exception type: {type(e)}")
-            import traceback
             logger.error(f"Traceback: {traceback.format_exc()}")
             logger.info("=====================================")
             return None
\ No newline at end of file
@@ -7,6 +7,7 @@ import logging
 import traceback
 from datetime import datetime, timedelta
 from ..config import RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET, get_webhook_base_url
+from ..utils.helpers import get_http_session
 
 logger = logging.getLogger('payment_gateway')
 
@@ -15,9 +16,10 @@ class RazorpayProvider:
     Provider for Razorpay payment gateway integration
     """
     
-    def __init__(self):
-        """Initialize the Razorpay client"""
+    def __init__(self, session=None):
+        """Initialize the Razorpay client, using the shared Razorpay HTTP session unless one is given"""
         self.client = None
+        self.session = session
         self.initialized = False
         self.init_client()
     
@@ -28,7 +30,10 @@ class RazorpayProvider:
                 logger.warning("Razorpay credentials not found. Razorpay integration will not work.")
                 return False
                 
-            self.client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
+            self.client = razorpay.Client(
+                session=self.session or get_http_session('razorpay'),
+                auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET)
+            )
             self.initialized = True
             logger.info("Razorpay client initialized")
             return True
@@ -1,46 +1,52 @@
 """
 Flask routes for payment gateway integration
 """
-from .service import payment_service
-from .paypal_service import paypal_service
-from .utils.helpers import calculate_billing_cycle_info, calculate_resource_utilization
+from .utils.helpers import calculate_billing_cycle_info, calculate_resource_utilization, materialize_lazy_json
 from flask import Blueprint, request, jsonify, current_app,redirect
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import logging
 import traceback
-from .config import get_frontend_url
-from .webhooks.razorpay_handler import handle_razorpay_webhook, verify_razorpay_signature
-from .webhooks.paypal_handler import handle_paypal_webhook
+from .config import get_frontend_url, PAYMENT_ROUTES_PREFIX
 
 logger = logging.getLogger('payment_gateway')
 
-def init_payment_routes(app, payment_service, paypal_service=None):
+def init_payment_routes(app, payment_service=None, paypal_service=None):
     """
     Initialize payment routes with a Flask app
     
     Args:
         app: Flask application
-        payment_service: PaymentService instance
+        payment_service: PaymentService instance, or None for a PayPal-only app
+            (the Razorpay-specific routes are then not registered)
         paypal_service: PayPalService instance (optional for backward compatibility)
     """
+    if payment_service is None and paypal_service is None:
+        raise ValueError("init_payment_routes needs a PaymentService or a PayPalService")
+    
+    # Shared subscription, quota and billing routes work with either service
+    subscription_service = payment_service if payment_service is not None else paypal_service
+    
     # Create a Blueprint for subscription-related routes
-    payment_bp = Blueprint('payment_gateway', __name__, url_prefix='/api/subscriptions')
+    payment_bp = Blueprint('payment_gateway', __name__, url_prefix=PAYMENT_ROUTES_PREFIX)
     
-    # Ensure PayPal service is available
-    if paypal_service is None:
-        paypal_service = getattr(payment_service, 'paypal_service', None)
-        if paypal_service is None:
-            from .paypal_service import PayPalService
-            paypal_service = PayPalService(app)
+    def get_paypal_service():
+        """PayPal service for the views; built on first use when none was given"""
+        return paypal_service or payment_service.paypal_service
+    
+    def razorpay_route(rule, **options):
+        """Register a view that needs the Razorpay PaymentService; skipped without one"""
+        if payment_service is None:
+            return lambda view: view
+        return payment_bp.route(rule, **options)
     
     @payment_bp.route('/plans', methods=['GET'])
     def get_plans():
         """Get all available subscription plans for an app"""
         try:
             app_id = request.args.get('app_id', 'marketfit')
-            plans = payment_service.get_available_plans(app_id)
-            return jsonify({'plans': plans})
+            plans = subscription_service.get_available_plans(app_id)
+            return jsonify({'plans': materialize_lazy_json(plans)})
         except Exception as e:
             logger.error(f"Error getting plans: {str(e)}")
             logger.error(traceback.format_exc())
@@ -51,14 +57,14 @@ def init_payment_routes(app, payment_service, paypal_service=None):
         """Get a user's active subscription"""
         try:
             app_id = request.args.get('app_id', 'marketfit')
-            subscription = payment_service.get_user_subscription(user_id, app_id)
-            return jsonify({'subscription': subscription})
+            subscription = subscription_service.get_user_subscription(user_id, app_id)
+            return jsonify({'subscription': materialize_lazy_json(subscription)})
         except Exception as e:
             logger.error(f"Error getting user subscription: {str(e)}")
             logger.error(traceback.format_exc())
             return jsonify({'error': str(e)}), 500
 
-    @payment_bp.route('/create', methods=['POST'])
+    @razorpay_route('/create', methods=['POST'])
     def create_subscription():
         """Create a new subscription for a user"""
         try:
@@ -88,12 +94,14 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 return jsonify({'error': 'User ID is required'}), 400
             
             # Get subscription to determine gateway
-            subscription = payment_service._get_subscription_details(subscription_id)
+            subscription = subscription_service._get_subscription_details(subscription_id)
             
             if subscription.get('paypal_subscription_id'):
                 # Use PayPal service for PayPal subscriptions
-                result = paypal_service.cancel_subscription(user_id, subscription_id)
+                result = get_paypal_service().cancel_subscription(user_id, subscription_id)
             elif subscription.get('razorpay_subscription_id'):
+                if payment_service is None:
+                    return jsonify({'error': 'Razorpay payments are not enabled'}), 400
                 # Use main payment service for Razorpay
                 result = payment_service.cancel_subscription(user_id, subscription_id)
             else:
@@ -105,10 +113,11 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             logger.error(f"Error cancelling subscription: {str(e)}")
             return jsonify({'error': 'Unable to process cancellation request. Please try again or contact support for assistance.'}), 500
 
-    @payment_bp.route('/razorpay-webhook', methods=['POST'])
+    @razorpay_route('/razorpay-webhook', methods=['POST'])
     def razorpay_webhook():
         """Handle Razorpay webhook events"""
         logger.info("Received Razorpay webhook")
+        from .webhooks.razorpay_handler import handle_razorpay_webhook
         result, status_code = handle_razorpay_webhook(payment_service)
         return jsonify(result), status_code
 
@@ -116,13 +125,15 @@ def init_payment_routes(app, payment_service, paypal_service=None):
     def paypal_webhook():
         """Handle PayPal webhook events using PayPal service"""
         logger.info("Received PayPal webhook")
+        from .webhooks.paypal_handler import handle_paypal_webhook
         result, status_code = handle_paypal_webhook()  # Uses paypal_service internally
         return jsonify(result), status_code
 
 
-    @payment_bp.route('/verify-payment', methods=['POST'])
+    @razorpay_route('/verify-payment', methods=['POST'])
     def verify_payment():
         """Manually verify a Razorpay payment"""
+        from .webhooks.razorpay_handler import verify_razorpay_signature
         try:
             data = request.json
             payment_id = data.get('razorpay_payment_id')
@@ -161,7 +172,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             if not user_id:
                 return jsonify({'error': 'User ID is required'}), 400
                 
-            invoices = payment_service.get_billing_history(user_id, app_id)
+            invoices = subscription_service.get_billing_history(user_id, app_id)
             return jsonify({'invoices': invoices})
         except Exception as e:
             logger.error(f"Error getting billing history: {str(e)}")
@@ -185,7 +196,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 logger.warning("[AZURE DEBUG] Missing required parameters")
                 return jsonify({'error': 'User ID and resource type are required'}), 400
                 
-            result = payment_service.check_resource_availability(
+            result = subscription_service.check_resource_availability(
                 user_id, app_id, resource_type, count
             )
             logger.debug(f"[AZURE DEBUG] check_resource_availability result: {result}")
@@ -217,13 +228,13 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 logger.warning("[AZURE DEBUG] Missing required parameters")
                 return jsonify({'error': 'User ID and resource type are required'}), 400
                 
-            result = payment_service.decrement_resource_quota(
+            remaining = subscription_service.decrement_resource_quota_and_read(
                 user_id, app_id, resource_type, count
             )
-            logger.debug(f"[AZURE DEBUG] decrement_resource_quota result: {result}")
+            logger.debug(f"[AZURE DEBUG] decrement_resource_quota_and_read result: {remaining}")
             
-            if result:
-                return jsonify({'success': True})
+            if remaining is not None:
+                return jsonify({'success': True, 'quota': remaining})
             else:
                 return jsonify({
                     'success': False,
@@ -246,7 +257,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 logger.warning("[AZURE DEBUG] Missing user_id parameter")
                 return jsonify({'error': 'User ID is required'}), 400
                 
-            quota = payment_service.get_resource_quota(user_id, app_id)
+            quota = subscription_service.get_resource_quota(user_id, app_id)
             
             return jsonify({'quota': quota})
             
@@ -267,12 +278,12 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 return jsonify({'error': 'User ID is required'}), 400
             
             # Get the user's active subscription
-            subscription = payment_service.get_user_subscription(user_id, app_id)
+            subscription = subscription_service.get_user_subscription(user_id, app_id)
             
             if not subscription:
                 return jsonify({'error': 'No active subscription found'}), 404
             
-            result = payment_service.initialize_resource_quota(
+            result = subscription_service.initialize_resource_quota(
                 user_id, subscription['id'], app_id
             )
             
@@ -302,7 +313,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 logger.warning("[AZURE DEBUG] Missing user_id parameter")
                 return jsonify({'error': 'User ID is required'}), 400
                 
-            result = payment_service.ensure_user_has_resource_quota(user_id, app_id)
+            result = subscription_service.ensure_user_has_resource_quota(user_id, app_id)
             
             return jsonify({'success': result})
                 
@@ -325,7 +336,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 return jsonify({'error': 'User ID and plan ID are required'}), 400
             
             # Use PayPal service instead of main payment service
-            result = paypal_service.create_subscription(
+            result = get_paypal_service().create_subscription(
                 user_id, plan_id, app_id, customer_info
             )
             
@@ -348,7 +359,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             logger.info(f"Processing PayPal success for subscription: {subscription_id}")
             
             # Use PayPal ID lookup directly since PayPal returns PayPal subscription ID
-            subscription = paypal_service._get_subscription_by_paypal_id(subscription_id)
+            subscription = get_paypal_service()._get_subscription_by_paypal_id(subscription_id)
             
             if not subscription:
                 logger.error(f"Subscription not found by PayPal ID: {subscription_id}")
@@ -376,7 +387,6 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 
         except Exception as e:
             logger.error(f"Error in PayPal success handler: {str(e)}")
-            import traceback
             logger.error(traceback.format_exc())
             error_message = "An%20error%20occurred%20while%20processing%20your%20subscription.%20Please%20contact%20support%20if%20this%20persists."
             return redirect(f"{get_frontend_url()}/subscription-dashboard?error={error_message}")
@@ -389,7 +399,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             
             if subscription_id:
                 # ✅ CHANGE: Use PayPal ID lookup like the success handler
-                subscription = paypal_service._get_subscription_by_paypal_id(subscription_id)
+                subscription = get_paypal_service()._get_subscription_by_paypal_id(subscription_id)
                 if subscription:
                     metadata = subscription.get('metadata', {})
                     if isinstance(metadata, str):
@@ -400,13 +410,13 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                     
                     if metadata.get('upgrade_pending_approval'):
                         # Clear pending upgrade metadata
-                        paypal_service._clear_upgrade_pending_metadata(subscription['id'])  # Use internal ID
+                        get_paypal_service()._clear_upgrade_pending_metadata(subscription['id'])  # Use internal ID
                         logger.info(f"Cleared pending upgrade for cancelled approval: {subscription['id']}")
                         cancel_message = "Upgrade%20cancelled.%20Your%20current%20plan%20remains%20active."
                         return redirect(f"{get_frontend_url()}/subscription-dashboard?cancelled=upgrade&message={cancel_message}")
                     else:
                         # Regular subscription cancellation
-                        paypal_service.cancel_pending_subscription(subscription['id'])  # Use internal ID
+                        get_paypal_service().cancel_pending_subscription(subscription['id'])  # Use internal ID
                         cancel_message = "Subscription%20setup%20cancelled."
                         return redirect(f"{get_frontend_url()}/subscription-dashboard?cancelled=subscription&message={cancel_message}")
             
@@ -416,7 +426,6 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             
         except Exception as e:
             logger.error(f"Error handling PayPal cancel: {str(e)}")
-            import traceback
             logger.error(traceback.format_exc())
             error_message = "Cancellation%20processing%20failed.%20Please%20contact%20support%20if%20needed."
             return redirect(f"{get_frontend_url()}/subscription-dashboard?error={error_message}")
@@ -435,7 +444,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             
             if payment_type == 'proration' and token:
                 # Process the proration payment completion
-                result = paypal_service.handle_proration_completion(token)
+                result = get_paypal_service().handle_proration_completion(token)
                 
                 if result.get('success'):
                     if result.get('requires_additional_approval'):
@@ -477,7 +486,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             
             if subscription_id:
                 # Find subscription by PayPal ID
-                subscription = paypal_service._get_subscription_by_paypal_id(subscription_id)
+                subscription = get_paypal_service()._get_subscription_by_paypal_id(subscription_id)
                 
                 if not subscription:
                     logger.error(f"Subscription not found by PayPal ID: {subscription_id}")
@@ -497,7 +506,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                     logger.info(f"Processing simple upgrade approval completion for subscription {subscription['id']}")
                     
                     # Log the approval completion
-                    paypal_service.db.log_subscription_action(
+                    get_paypal_service().db.log_subscription_action(
                         subscription['id'],
                         'simple_upgrade_approved',
                         {
@@ -515,7 +524,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                     # Handle proration-based upgrade approval completion
                     logger.info(f"Processing proration upgrade approval completion for subscription {subscription['id']}")
                     
-                    result = paypal_service.complete_approved_upgrade(subscription['id'])
+                    result = get_paypal_service().complete_approved_upgrade(subscription['id'])
                     
                     if result.get('error'):
                         error_msg = result.get('message', 'Unknown error occurred during upgrade completion')
@@ -550,7 +559,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             if subscription_id:
                 # Clear the approval metadata since user cancelled
                 try:
-                    paypal_service._clear_approval_metadata(subscription_id)
+                    get_paypal_service()._clear_approval_metadata(subscription_id)
                     logger.info(f"Cleared approval metadata for cancelled approval: {subscription_id}")
                 except Exception as e:
                     logger.error(f"Error clearing approval metadata: {str(e)}")
@@ -561,7 +570,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             logger.error(f"Error handling PayPal approval cancel: {str(e)}")
             return redirect(f"{get_frontend_url()}/subscription-dashboard?upgrade=error&message=Cancellation processing failed.")
 
-    @payment_bp.route('/razorpay-payment-complete', methods=['GET'])
+    @razorpay_route('/razorpay-payment-complete', methods=['GET'])
     def razorpay_payment_complete():
         """Handle Razorpay payment link user redirects after payment completion"""
         try:
@@ -638,13 +647,13 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 return jsonify({'error': 'User ID, subscription ID, new plan ID, and current gateway are required'}), 400
             
             # ✅ ONLY CHANGE: Convert to internal ID
-            plan_record = payment_service._get_plan(new_plan_id)
+            plan_record = subscription_service._get_plan(new_plan_id)
             if not plan_record:
                 return jsonify({'error': 'Plan not found'}), 400
             internal_plan_id = plan_record['id']
             
             # Get subscription to validate gateway matches
-            subscription = payment_service._get_subscription_details(subscription_id)
+            subscription = subscription_service._get_subscription_details(subscription_id)
             if not subscription or subscription['user_id'] != user_id:
                 return jsonify({'error': 'Subscription not found or access denied'}), 400
             
@@ -660,7 +669,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             # Route to appropriate service based on current gateway
             if current_gateway == 'paypal':
                 # Get usage data for PayPal upgrade
-                usage_data = paypal_service.get_current_usage(user_id, subscription_id, app_id)
+                usage_data = get_paypal_service().get_proration_usage(user_id, subscription_id, app_id)
                 if not usage_data:
                     raise ValueError("Usage data not found")
 
@@ -670,8 +679,6 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 logger.info(f"[DEBUG] Raw billing_period_end: {billing_period_end}")
 
                 if billing_period_end:
-                    from datetime import datetime, timedelta
-                    
                     # Handle both datetime objects and strings
                     if isinstance(billing_period_end, str):
                         logger.info(f"[DEBUG] Converting string to datetime: {billing_period_end}")
@@ -705,7 +712,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 
                 if paypal_subscription_id and not billing_period_end:
                     # Get PayPal subscription details directly
-                    paypal_details = paypal_service.paypal.get_subscription(paypal_subscription_id)
+                    paypal_details = get_paypal_service().paypal.get_subscription(paypal_subscription_id)
                     logger.info(f"[DEBUG] PayPal subscription details response: {json.dumps(paypal_details, indent=2, default=str)}")
                     
                     if not paypal_details.get('error'):
@@ -713,7 +720,6 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                         next_billing_time = billing_info.get('next_billing_time')
                         
                         if next_billing_time:
-                            from datetime import datetime, timedelta
                             next_billing = datetime.fromisoformat(next_billing_time.replace('Z', '+00:00'))
                             now = datetime.now(next_billing.tzinfo)
                             two_days_from_now = now + timedelta(days=2)
@@ -740,7 +746,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 logger.info(f"[DEBUG] Billing check completed, proceeding with upgrade")
 
                 # Get current plan for resource calculation
-                current_plan = paypal_service._get_plan(subscription['plan_id'])
+                current_plan = get_paypal_service()._get_plan(subscription['plan_id'])
 
                 billing_cycle_info = calculate_billing_cycle_info(
                     usage_data['billing_period_start'],
@@ -754,13 +760,15 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 )
                 
                 # Use PayPal service for upgrade
-                result = paypal_service.handle_upgrade(
+                result = get_paypal_service().handle_upgrade(
                     user_id, subscription_id, internal_plan_id, app_id,  # ← Changed to internal_plan_id
                     billing_cycle_info, resource_info
                 )
                 logger.info("[UPGRADE] PayPal service returned successfully")
                 
             elif current_gateway == 'razorpay':
+                if payment_service is None:
+                    return jsonify({'error': 'Razorpay payments are not enabled'}), 400
                 # Use main payment service for Razorpay
                 result = payment_service.upgrade_subscription(user_id, subscription_id, internal_plan_id, app_id)  # ← Changed to internal_plan_id
                 logger.info("[UPGRADE] Payment service returned successfully")
@@ -773,7 +781,6 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             logger.error(f"[UPGRADE] Route exception: {str(e)}")
             logger.error(f"[UPGRADE] Exception type: {type(e)}")
             logger.error(f"[UPGRADE] Exception args: {e.args}")
-            import traceback
             logger.error(f"[UPGRADE] Traceback: {traceback.format_exc()}")
             return jsonify({'error': str(e)}), 500
         
@@ -788,7 +795,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             app_id = data.get('app_id', 'marketfit')
             
             # Log the downgrade request
-            payment_service.db.log_subscription_action(
+            subscription_service.db.log_subscription_action(
                 subscription_id,
                 'downgrade_requested',
                 {
@@ -809,7 +816,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
-    @payment_bp.route('/purchase-addon', methods=['POST'])
+    @razorpay_route('/purchase-addon', methods=['POST'])
     def purchase_addon():
         """Purchase additional resources"""
         try:
@@ -844,7 +851,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             if not user_id:
                 return jsonify({'error': 'User ID is required'}), 400
             
-            usage = payment_service.get_current_usage(user_id, subscription_id, app_id)
+            usage = subscription_service.get_current_usage(user_id, subscription_id, app_id)
             
             if not usage:
                 return jsonify({'error': 'Usage data not found'}), 404
@@ -862,7 +869,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
         try:
             app_id = request.args.get('app_id', 'marketfit')
             
-            conn = payment_service.db.get_connection()
+            conn = subscription_service.db.get_connection()
             cursor = conn.cursor(dictionary=True)
             
             cursor.execute("""
@@ -893,12 +900,12 @@ def init_payment_routes(app, payment_service, paypal_service=None):
                 return jsonify({'error': 'User ID is required'}), 400
             
             # Verify user owns subscription
-            subscription = payment_service._get_subscription_details(subscription_id)
+            subscription = subscription_service._get_subscription_details(subscription_id)
             if not subscription or subscription['user_id'] != user_id:
                 return jsonify({'error': 'Subscription not found or access denied'}), 404
             
             # Get audit log
-            conn = payment_service.db.get_connection()
+            conn = subscription_service.db.get_connection()
             cursor = conn.cursor(dictionary=True)
             
             cursor.execute("""
@@ -927,7 +934,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
         try:
             status_filter = request.args.get('status', 'scheduled')
             
-            conn = payment_service.db.get_connection()
+            conn = subscription_service.db.get_connection()
             cursor = conn.cursor(dictionary=True)
             
             cursor.execute("""
@@ -958,7 +965,7 @@ def init_payment_routes(app, payment_service, paypal_service=None):
             admin_notes = data.get('admin_notes', '')
             new_status = data.get('status', 'completed')
             
-            conn = payment_service.db.get_connection()
+            conn = subscription_service.db.get_connection()
             cursor = conn.cursor()
             
             cursor.execute("""
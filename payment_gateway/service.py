@@ -5,13 +5,14 @@ import json
 import logging
 import traceback
 import os
+import threading
 from datetime import datetime, timedelta, timezone
-from .base_subscription_service import BaseSubscriptionService
+from .base_subscription_service import BaseSubscriptionService, invalidate_active_subscription_cache, SQL_ADD_ADDON_TO_QUOTA
 from .db import DatabaseManager
 from .providers.razorpay_provider import RazorpayProvider
 from .providers.paypal_provider import PayPalProvider
 from .utils.helpers import generate_id, calculate_period_end, calculate_billing_cycle_info, calculate_resource_utilization, calculate_advanced_proration,parse_json_field
-from .config import setup_logging, DB_TABLE_SUBSCRIPTION_PLANS, DB_TABLE_USER_SUBSCRIPTIONS, DB_TABLE_RESOURCE_USAGE
+from .config import setup_logging, DB_TABLE_USER_SUBSCRIPTIONS, DB_TABLE_RESOURCE_USAGE
 logger = logging.getLogger('payment_gateway')
 
 class PaymentService(BaseSubscriptionService):
@@ -20,20 +21,39 @@ class PaymentService(BaseSubscriptionService):
     This service is designed to work across multiple applications.
     """
     
-    def __init__(self, app=None, db_config=None):
-        """Initialize the payment service"""
+    __slots__ = ('razorpay', 'paypal', 'app', '_paypal_service')
+    
+    _paypal_service_lock = threading.Lock()
+    
+    def __init__(self, app=None, db_config=None, session=None):
+        """Initialize the payment service; providers share per-gateway HTTP sessions unless session is given"""
         # Initialize base service
         super().__init__(db_config)
 
         # Initialize providers
-        self.razorpay = RazorpayProvider()
-        self.paypal = PayPalProvider()
+        self.razorpay = RazorpayProvider(session)
+        self.paypal = PayPalProvider(session)
+        self._paypal_service = None
         
         # Initialize Flask app if provided
         self.app = app
         if app is not None:
             self.init_app(app)
     
+    @property
+    def paypal_service(self):
+        """PayPalService sharing this service's app and database, built on first access unless init_payment_gateway attached one"""
+        if self._paypal_service is None:
+            with self._paypal_service_lock:
+                if self._paypal_service is None:
+                    from .paypal_service import PayPalService
+                    self._paypal_service = PayPalService(self.app, self.db.db_config)
+        return self._paypal_service
+    
+    @paypal_service.setter
+    def paypal_service(self, paypal_service):
+        self._paypal_service = paypal_service
+    
     def init_app(self, app):
         """Initialize with Flask app context"""
         self.app = app
@@ -1166,29 +1186,6 @@ class PaymentService(BaseSubscriptionService):
             logger.error(f"Error in activation transaction: {str(e)}")
             raise
 
-    def _get_free_plan(self, app_id):
-       """Get free plan with isolated connection"""
-       try:
-           conn = self.db.get_connection()
-           cursor = conn.cursor(dictionary=True)
-           
-           cursor.execute(f"""
-               SELECT id FROM {DB_TABLE_SUBSCRIPTION_PLANS}
-               WHERE app_id = %s AND amount = 0 AND is_active = TRUE
-               LIMIT 1
-           """, (app_id,))
-           
-           free_plan = cursor.fetchone()
-           
-           cursor.close()
-           conn.close()
-           return free_plan
-           
-       except Exception as e:
-           logger.error(f"Error getting free plan: {str(e)}")
-           raise
-
-
     # NEW WEBHOOK HANDLERS FOR MISSING RAZORPAY EVENTS
 
     def _handle_razorpay_subscription_pending(self, payload):
@@ -1407,7 +1404,8 @@ class PaymentService(BaseSubscriptionService):
     def process_webhook_event(self, provider, event_type, event_id, payload):
         """
         Centralized webhook event processing - replaces handle_webhook()
-        All webhook business logic happens here
+        All webhook business logic happens here. The caller claims event_id
+        first (DatabaseManager.claim_event).
         """
         try:
             # Extract entity and user IDs for logging
@@ -1432,8 +1430,9 @@ class PaymentService(BaseSubscriptionService):
             else:
                 result = {'success': False, 'message': f'Unknown provider: {provider}'}
             
-            # Mark event as processed
-            self.db.mark_event_processed(event_id, provider)
+            # The user's subscription rows may have changed status - drop their cached
+            # active ids (all of them if the payload did not identify the user)
+            invalidate_active_subscription_cache(user_id)
             
             # Log completion
             self.db.log_event(
@@ -1787,8 +1786,8 @@ class PaymentService(BaseSubscriptionService):
             # Calculate value remaining and discount
             remaining_values = self._calculate_value_remaining_percentage(billing_cycle_info, resource_info)
             value_remaining_pct = remaining_values['current_plan_remaining']  # Use the correct key
-            value_remaining_amount = value_remaining_pct * self._ensure_float(current_plan['amount'])
-            discount_pct_of_new_plan = (value_remaining_amount / self._ensure_float(new_plan['amount'])) * 100
+            value_remaining_amount = value_remaining_pct * (current_plan['amount'] or 0.0)
+            discount_pct_of_new_plan = (value_remaining_amount / (new_plan['amount'] or 0.0)) * 100
             
             discount_result = self._get_discount_offer_for_value(discount_pct_of_new_plan)
             
@@ -1801,7 +1800,7 @@ class PaymentService(BaseSubscriptionService):
                 # It's an integer from test discount function
                 discount_offer_pct = discount_result
                 
-            discount_amount = (discount_offer_pct / 100) * self._ensure_float(new_plan['amount'])
+            discount_amount = (discount_offer_pct / 100) * (new_plan['amount'] or 0.0)
             
             # Detect payment method
             payment_method = self._get_subscription_payment_method(subscription)
@@ -2032,7 +2031,7 @@ class PaymentService(BaseSubscriptionService):
                 }
 
             # Phase 2: Get usage and billing data
-            usage_data = self.get_current_usage(user_id, subscription_id, app_id)
+            usage_data = self.get_proration_usage(user_id, subscription_id, app_id)
             if not usage_data:
                 raise ValueError("Usage data not found")
 
@@ -2123,8 +2122,7 @@ class PaymentService(BaseSubscriptionService):
                 raise ValueError(f"Razorpay upgrade failed: {response.get('error', {}).get('description')}")
             
             # Update local database and initialize full quota immediately
-            self._update_subscription_plan(subscription['id'], new_plan_id)
-            self.initialize_resource_quota(subscription['user_id'], subscription['id'], subscription['app_id'])
+            self.change_plan_and_reinit(subscription['user_id'], subscription['id'], new_plan_id, subscription['app_id'])
             
             return {
                 'success': True,
@@ -2170,7 +2168,7 @@ class PaymentService(BaseSubscriptionService):
                 
                 # Calculate additional payment
                 excess_consumption_pct = (time_remaining_pct - resource_remaining_pct) - 0.05
-                additional_amount = excess_consumption_pct * self._ensure_float(current_plan['amount'])
+                additional_amount = excess_consumption_pct * (current_plan['amount'] or 0.0)
                 
                 # Store time factor for payment completion processing
                 self._store_razorpay_annual_upgrade_metadata(
@@ -2188,7 +2186,7 @@ class PaymentService(BaseSubscriptionService):
                 message = (
                     f'Subscription upgraded with temporary resources. Additional payment of ${additional_amount:.2f} required. '
                     f'Calculation: You have {time_remaining_pct:.1%} time remaining but only {resource_remaining_pct:.1%} resources left. '
-                    f'The excess consumption of {excess_consumption_pct:.1%} × ${current_plan["amount"]} = ${additional_amount:.2f}.'
+                    f'The excess consumption of {excess_consumption_pct:.1%} × ${current_plan["amount"] or 0.0:.2f} = ${additional_amount:.2f}.'
                 )
                 
                 return {
@@ -2363,12 +2361,7 @@ class PaymentService(BaseSubscriptionService):
                 return {'error': True, 'message': 'Subscription not found'}
             
             # Get stored time factor from metadata
-            metadata = subscription.get('metadata', {})
-            if isinstance(metadata, str):
-                try:
-                    metadata = json.loads(metadata)
-                except:
-                    metadata = {}
+            metadata = subscription['metadata']
             
             # Extract time factor from Razorpay annual upgrade metadata
             razorpay_upgrade = metadata.get('razorpay_annual_upgrade', {})
@@ -2513,24 +2506,14 @@ class PaymentService(BaseSubscriptionService):
     def _add_addon_to_quota(self, user_id, subscription_id, app_id, addon_type, quantity):
         """Add addon quantity to main quota columns"""
         try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor(dictionary=True)
+            # Pre-built statement per addon type; unknown types are rejected
+            sql = SQL_ADD_ADDON_TO_QUOTA.get(addon_type)
+            if sql is None:
+                raise ValueError(f"Invalid addon type '{addon_type}'")
             
-            # Map addon_type to quota column
-            quota_column = f"{addon_type}_quota"
-            addon_tracking_column = f"current_addon_{addon_type}"
-            
-            cursor.execute(f"""
-                UPDATE {DB_TABLE_RESOURCE_USAGE}
-                SET {quota_column} = {quota_column} + %s,
-                    {addon_tracking_column} = {addon_tracking_column} + %s,
-                    updated_at = NOW()
-                WHERE user_id = %s AND subscription_id = %s AND app_id = %s
-            """, (quantity, quantity, user_id, subscription_id, app_id))
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with self.db.get_connection() as conn:
+                self.db.execute_prepared_write(conn, sql, (quantity, quantity, user_id, subscription_id, app_id))
+                conn.commit()
             
             logger.info(f"Added {quantity} {addon_type} to user {user_id} quota")
             
@@ -1,9 +1,42 @@
 """
 Helper utilities for payment gateway operations
 """
+import copy
 import json
+import logging
+import os
+import tempfile
+import threading
+import time
 import uuid
 from datetime import datetime, timedelta
+from ..config import GATEWAY_METADATA_CACHE_DIR, GATEWAY_METADATA_TTL, HTTP_POOL_SIZE
+
+logger = logging.getLogger('payment_gateway')
+
+# Use orjson for JSON columns when it is installed - same results, faster parsing
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+
+def json_dumps(obj):
+    """Serialize obj to a JSON string, with orjson when it is installed"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            # Types orjson rejects (e.g. non-string keys) - keep the stdlib behaviour
+            pass
+    return json.dumps(obj)
+
+_metadata_refresh_lock = threading.Lock()
+_metadata_refreshing = set()
+
+_http_sessions_lock = threading.Lock()
+_http_sessions = {}
 
 def generate_id(prefix=''):
     """Generate a unique ID with optional prefix"""
@@ -39,6 +72,9 @@ def parse_json_field(data, default=None):
     Returns:
         dict or list: Parsed JSON data or default
     """
+    if isinstance(data, LazyJSON):
+        return data.materialize() or default or {}
+    
     if not data:
         return default or {}
         
@@ -46,10 +82,221 @@ def parse_json_field(data, default=None):
         return data
         
     try:
-        return json.loads(data)
-    except (json.JSONDecodeError, TypeError):
+        return json_loads(data)
+    except (ValueError, TypeError):
         return default or {}
 
+class LazyJSON:
+    """
+    JSON column value that is only parsed when first read
+    
+    Supports the read-only mapping operations callers use on parsed
+    features/metadata; anything that needs a real dict (jsonify, models)
+    should call materialize() or go through materialize_lazy_json().
+    """
+    
+    __slots__ = ('_raw', '_data')
+    
+    def __init__(self, raw):
+        self._raw = raw
+        self._data = None
+    
+    def materialize(self):
+        """Parse (once) and return the underlying dict"""
+        if self._data is None:
+            self._data = parse_json_field(self._raw)
+            self._raw = None
+        return self._data
+    
+    def __getitem__(self, key):
+        return self.materialize()[key]
+    
+    def get(self, key, default=None):
+        return self.materialize().get(key, default)
+    
+    def __contains__(self, key):
+        return key in self.materialize()
+    
+    def __iter__(self):
+        return iter(self.materialize())
+    
+    def __len__(self):
+        return len(self.materialize())
+    
+    def keys(self):
+        return self.materialize().keys()
+    
+    def items(self):
+        return self.materialize().items()
+    
+    def values(self):
+        return self.materialize().values()
+    
+    def __eq__(self, other):
+        if isinstance(other, LazyJSON):
+            other = other.materialize()
+        return self.materialize() == other
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return f"LazyJSON({self.materialize()!r})"
+    
+    def __deepcopy__(self, memo):
+        # Cached rows are deep-copied on every hit - an unparsed value just
+        # shares the (immutable) raw string
+        clone = LazyJSON(self._raw)
+        if self._data is not None:
+            clone._data = copy.deepcopy(self._data, memo)
+        return clone
+
+def materialize_lazy_json(value):
+    """Replace LazyJSON values in a row (or list of rows) with plain dicts for serialization"""
+    if isinstance(value, LazyJSON):
+        return value.materialize()
+    if isinstance(value, dict):
+        return {key: materialize_lazy_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [materialize_lazy_json(item) for item in value]
+    return value
+
+def load_gateway_metadata(name, fetch, ttl=None):
+    """
+    Load gateway metadata from the on-disk cache (stale-while-revalidate)
+    
+    Args:
+        name: Cache entry name, stored as {GATEWAY_METADATA_CACHE_DIR}/{name}.json
+        fetch: Callable returning a JSON-serializable dict, or None on failure
+        ttl: Seconds before a cached entry is refreshed in the background
+        
+    Returns:
+        dict or None: Cached data (fetched synchronously only when no cache exists)
+    """
+    ttl = GATEWAY_METADATA_TTL if ttl is None else ttl
+    path = os.path.join(GATEWAY_METADATA_CACHE_DIR, f"{name}.json")
+    
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        age = time.time() - os.path.getmtime(path)
+    except (OSError, ValueError):
+        # No usable cache yet - nothing to serve stale, so fetch inline
+        return _refresh_gateway_metadata(name, fetch, path)
+    
+    if age > ttl:
+        with _metadata_refresh_lock:
+            refreshing = name in _metadata_refreshing
+            _metadata_refreshing.add(name)
+        if not refreshing:
+            threading.Thread(
+                target=_refresh_gateway_metadata,
+                args=(name, fetch, path),
+                daemon=True,
+                name=f"pg-metadata-{name}"
+            ).start()
+    
+    return data
+
+def _refresh_gateway_metadata(name, fetch, path):
+    """Fetch metadata and atomically replace the cache file; keeps stale data on failure"""
+    try:
+        data = fetch()
+        if data is None:
+            logger.warning(f"Refreshing {name} metadata failed, keeping cached data")
+            return None
+        
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+        return data
+        
+    except Exception as e:
+        logger.warning(f"Error refreshing {name} metadata, keeping cached data: {str(e)}")
+        return None
+    finally:
+        with _metadata_refresh_lock:
+            _metadata_refreshing.discard(name)
+
+def get_http_session(name):
+    """
+    Get the process-wide requests.Session for a payment gateway
+    
+    Sessions are created once per gateway name and shared by every provider
+    instance, so TLS connections are pooled per worker rather than per service.
+    
+    Args:
+        name: Gateway name, e.g. 'paypal' or 'razorpay'
+        
+    Returns:
+        requests.Session: Shared session with a pooled, retrying adapter
+    """
+    with _http_sessions_lock:
+        session = _http_sessions.get(name)
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            
+            # Retry only idempotent methods on gateway-side errors (urllib3 default
+            # allowed_methods excludes POST/PATCH), returning the final response
+            retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            
+            session = requests.Session()
+            session.mount('https://', adapter)
+            _http_sessions[name] = session
+        
+        return session
+
+class TTLCache:
+    """
+    Small thread-safe in-process cache whose entries expire after ttl seconds
+    
+    Entries are kept in insertion order, which with a fixed ttl is also expiry
+    order, so when full the oldest entry is evicted to make room.
+    """
+    
+    def __init__(self, maxsize=256, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._data) >= self.maxsize:
+                del self._data[next(iter(self._data))]
+            self._data[key] = (time.monotonic() + self.ttl, value)
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[1] if entry is not None else default
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def evict_where(self, predicate):
+        """Drop every entry whose key satisfies predicate"""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
 def format_subscription_price(amount, currency='INR', interval=None):
     """
     Format a subscription price for display
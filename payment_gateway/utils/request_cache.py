@@ -0,0 +1,53 @@
+"""
+Request-scoped memoization for payment gateway lookups
+"""
+import copy
+import functools
+from contextvars import ContextVar
+
+# Cache for the current request; None outside a request, which disables caching
+_request_cache = ContextVar('payment_gateway_request_cache', default=None)
+
+def reset_request_cache():
+    """Start an empty cache for the current request (Flask before_request hook)"""
+    _request_cache.set({})
+
+def clear_request_cache(*args):
+    """Drop the current request's cache and stop caching (Flask teardown_request hook)"""
+    _request_cache.set(None)
+
+def invalidate_request_cache():
+    """Forget everything cached so far in the current request (after writes)"""
+    cache = _request_cache.get()
+    if cache is not None:
+        cache.clear()
+
+def request_cached(func):
+    """
+    Memoize a service method for the duration of the current request
+
+    Results are keyed by method name, the service's database manager and the
+    arguments, so services on different databases never share entries; None
+    results are not cached. Callers get a copy, so mutating a result does
+    not affect later lookups in the same request.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        cache = _request_cache.get()
+        if cache is None:
+            return func(self, *args, **kwargs)
+
+        key = (func.__qualname__, id(self.db), args, tuple(sorted(kwargs.items())))
+        try:
+            if key in cache:
+                return copy.deepcopy(cache[key])
+        except TypeError:
+            # Unhashable arguments - skip the cache
+            return func(self, *args, **kwargs)
+
+        result = func(self, *args, **kwargs)
+        if result is not None:
+            cache[key] = copy.deepcopy(result)
+        return result
+
+    return wrapper
@@ -7,9 +7,11 @@ import hmac
 import hashlib
 import base64
 import requests
+from datetime import datetime, timezone
 from flask import request, current_app
 from ..paypal_service import paypal_service
 from ..config import PAYPAL_WEBHOOK_ID, FLASK_ENV
+from ..utils.helpers import get_http_session
 
 logger = logging.getLogger('payment_gateway')
 
@@ -120,8 +122,8 @@ def _download_and_verify_certificate(cert_url):
             logger.error(f"Invalid PayPal certificate URL: {cert_url}")
             return None
         
-        # Download certificate with timeout
-        response = requests.get(cert_url, timeout=20)
+        # Download certificate with timeout, over the shared PayPal connection pool
+        response = get_http_session('paypal').get(cert_url, timeout=20)
         response.raise_for_status()
         
         # Parse X.509 certificate
@@ -129,7 +131,6 @@ def _download_and_verify_certificate(cert_url):
         certificate = x509.load_pem_x509_certificate(cert_data.encode('utf-8'))
         
         # Validate certificate is not expired
-        from datetime import datetime, timezone
         now = datetime.now(timezone.utc)
         
         if certificate.not_valid_after.replace(tzinfo=timezone.utc) < now:
@@ -215,8 +216,8 @@ def handle_paypal_webhook():
         
         logger.info(f"Processing PayPal webhook: {event_type}, ID: {event_id}")
         
-        # Check idempotency using PayPal service
-        if paypal_service.db.is_event_processed(event_id, 'paypal'):
+        # Check idempotency using PayPal service - claims the event in the same round-trip
+        if not paypal_service.db.claim_event(event_id, 'paypal'):
             logger.info(f"PayPal event {event_id} already processed")
             return {'status': 'already_processed'}, 200
         
@@ -227,6 +228,9 @@ def handle_paypal_webhook():
             event_id=event_id,
             payload=webhook_data
         )
+        if not result.get('success'):
+            # A redelivery of this event should be processed again
+            paypal_service.db.release_event(event_id, 'paypal')
         
         return {
             'status': 'success' if result.get('success') else 'processed',
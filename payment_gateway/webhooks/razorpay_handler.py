@@ -73,8 +73,8 @@ def handle_razorpay_webhook(payment_service):
         
         logger.info(f"Processing Razorpay webhook: {event_type}, Event ID: {event_id}")
         
-        # 4. Idempotency check
-        if payment_service.db.is_event_processed(event_id, 'razorpay'):
+        # 4. Idempotency check - claims the event in the same round-trip
+        if not payment_service.db.claim_event(event_id, 'razorpay'):
             logger.info(f"Razorpay event {event_id} already processed")
             return {'status': 'already_processed'}, 200
         
@@ -85,6 +85,9 @@ def handle_razorpay_webhook(payment_service):
             event_id=event_id,
             payload=webhook_data
         )
+        if not result.get('success'):
+            # Let Razorpay's retry process the event again
+            payment_service.db.release_event(event_id, 'razorpay')
         
         # 6. Return HTTP response
         return {
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Utility script to precompile the payment gateway package for frozen deployments.
+Compiles every module listed in payment_gateway._MANIFEST and can bundle them
+into a single zip archive of bytecode importable via sys.path / zipimport.
+"""
+import os
+import sys
+import argparse
+import compileall
+import zipfile
+
+# Add the parent directory to the path so we can import the package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import payment_gateway
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Precompile the payment gateway package')
+    parser.add_argument('--output', help='Write a bytecode zip archive to this path', default=None)
+    parser.add_argument('--optimize', help='Optimization level passed to the compiler', type=int, default=-1)
+    return parser.parse_args()
+
+def module_path(package_dir, module_name):
+    """Resolve a relative manifest entry (e.g. '.providers.paypal_provider') to its source file"""
+    parts = module_name.lstrip('.').split('.')
+    base = os.path.join(package_dir, *parts)
+    if os.path.isdir(base):
+        return os.path.join(base, '__init__.py')
+    return f"{base}.py"
+
+def unlisted_modules(package_dir, sources):
+    """Package source files that are not in the manifest"""
+    listed = {os.path.normpath(path) for path in sources}
+    missing = []
+    for dirpath, dirnames, filenames in os.walk(package_dir):
+        dirnames[:] = [name for name in dirnames if name != '__pycache__']
+        for filename in filenames:
+            path = os.path.normpath(os.path.join(dirpath, filename))
+            if filename.endswith('.py') and path not in listed:
+                missing.append(os.path.relpath(path, package_dir))
+    return sorted(missing)
+
+def freeze(output=None, optimize=-1):
+    """Compile the manifest modules and optionally bundle them into a zip archive"""
+    package_dir = os.path.dirname(os.path.abspath(payment_gateway.__file__))
+    sources = [os.path.join(package_dir, '__init__.py')]
+    sources += [module_path(package_dir, name) for name in payment_gateway._MANIFEST]
+    
+    # A module left out of the manifest would be missing from the archive
+    missing = unlisted_modules(package_dir, sources)
+    if missing:
+        print(f"Modules missing from payment_gateway._MANIFEST: {', '.join(missing)}")
+        return False
+    
+    compiled = all(compileall.compile_file(path, quiet=1, optimize=optimize) for path in sources)
+    if not compiled:
+        return False
+    
+    if output:
+        root = os.path.dirname(package_dir)
+        with zipfile.PyZipFile(output, 'w', optimize=optimize) as archive:
+            for path in sources:
+                archive.writepy(path, basename=os.path.relpath(os.path.dirname(path), root))
+        print(f"Wrote {len(sources)} modules to {output}")
+    
+    return True
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    try:
+        sys.exit(0 if freeze(output=args.output, optimize=args.optimize) else 1)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
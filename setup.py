@@ -12,6 +12,9 @@ setup(
         "requests==2.31.0",
         "python-dotenv==1.1.1",
     ],
+    extras_require={
+        "fast-json": ["orjson>=3.9"],         # Faster parsing of JSON columns
+    },
     author="Manu Goel",
     author_email="manu@mgimpacts.com",
     description="A shared payment gateway integration for Flask applications",